@@ -0,0 +1,232 @@
+"""Benchmarks of the hot paths of the exchange and the simulator.
+
+Every scenario is seeded, so it does the same work on every run. The wall time is the best of a few repeats, and the peak memory
+is measured on a separate run with tracemalloc (which slows the code down). Results can be saved as a baseline and later runs
+compared against it:
+
+    python benchmarks.py --save benchmarks.json
+    python benchmarks.py --baseline benchmarks.json
+
+Timings are only comparable on the same machine, so no baseline is kept in the repository. In CI, produce it on the same runner
+from the target branch before running the changes against it:
+
+    git checkout main && python benchmarks.py --save /tmp/baseline.json
+    git checkout - && python benchmarks.py --baseline /tmp/baseline.json
+"""
+import argparse
+import json
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List
+import numpy as np
+from source.qmr_exchange import Exchange, Simulator
+from source.agents import NaiveMarketMaker, RandomMarketTaker, RandomMarketTakerPopulation
+from source.profiling import Profiler
+
+
+class Scenario():
+    """A benchmark: setup(scale) builds the state, outside of the measurements, and run(state) does the measured work and
+    returns the counts of instructions (orders, cancels and amendments), trades and steps it processed.
+    """
+    def __init__(self, name:str, setup:Callable, run:Callable):
+        self.name = name
+        self.setup = setup
+        self.run = run
+
+    def __repr__(self):
+        return f'<Scenario: {self.name}>'
+
+
+def _n(base:int, scale:float) -> int:
+    return max(1, int(base * scale))
+
+
+def _setup_deep_book(scale):
+    exchange = Exchange(datetime(2022, 1, 1))
+    exchange.create_asset('XYZ')
+    rng = np.random.default_rng(0)
+    n = _n(200_000, scale)
+    # bids below and asks above the seed orders over a thousand levels each, so that nothing crosses
+    bids = (99 - rng.integers(0, 1000, n) * 0.01).round(2).tolist()
+    asks = (101 + rng.integers(0, 1000, n) * 0.01).round(2).tolist()
+    return exchange, bids, asks, rng.permutation(2 * n).tolist()
+
+
+def _run_deep_book(state):
+    exchange, bids, asks, cancel_order = state
+    orders = []
+    for bid, ask in zip(bids, asks):
+        orders.append(exchange.limit_buy('XYZ', bid, 1, 'bidder'))
+        orders.append(exchange.limit_sell('XYZ', ask, 1, 'asker'))
+    # cancel half of them in random order, then sweep what is left of the asks
+    for idx in cancel_order[:len(orders) // 2]:
+        exchange.cancel_order(orders[idx].id)
+    n_trades = len(exchange.trade_log)
+    exchange.market_buy('XYZ', len(asks), 'taker')
+    return {'instructions': len(orders) + len(orders) // 2 + 1, 'trades': len(exchange.trade_log) - n_trades}
+
+
+def _build_simulator(days, tickers, seed=1):
+    sim = Simulator(datetime(2022, 1, 1), datetime(2022, 1, 1) + timedelta(days=days), 'minute', seed=seed)
+    for ticker in tickers:
+        sim.exchange.create_asset(ticker)
+    return sim
+
+
+def _setup_market_makers(scale):
+    tickers = ['XYZ', 'ABC', 'DEF']
+    sim = _build_simulator(_n(20, scale) / 10, tickers)
+    for i in range(20):
+        sim.add_agent(NaiveMarketMaker(name=f'market_maker_{i}', tickers=tickers, aum=10_000, spread_pct=0.002 * (i + 1), qty_per_order=5))
+    sim.add_agent(RandomMarketTaker(name='market_taker', tickers=tickers, aum=10_000, prob_buy=.3, prob_sell=.3, qty_per_order=3))
+    return sim
+
+
+def _setup_taker_crowd(scale):
+    tickers = ['XYZ', 'ABC']
+    sim = _build_simulator(_n(10, scale) / 10, tickers)
+    sim.add_agent(NaiveMarketMaker(name='market_maker', tickers=tickers, aum=1_000_000, spread_pct=0.005, qty_per_order=1_000))
+    for i in range(1_000):
+        sim.add_agent(RandomMarketTaker(name=f'market_taker_{i}', tickers=tickers, aum=1_000, prob_buy=.01, prob_sell=.01))
+    return sim
+
+
+def _setup_population(scale):
+    tickers = ['XYZ', 'ABC']
+    sim = _build_simulator(_n(10, scale) / 10, tickers)
+    sim.add_agent(NaiveMarketMaker(name='market_maker', tickers=tickers, aum=1_000_000, spread_pct=0.005, qty_per_order=10_000))
+    sim.add_agent(RandomMarketTakerPopulation('crowd', tickers, 100_000, aum=1_000, prob_buy=.001, prob_sell=.001))
+    return sim
+
+
+def _run_simulator(sim):
+    # the entry points of the exchange are wrapped by a profiler, which counts every instruction once, whether it is sent on its
+    # own or in a batch. The wrappers are part of the measured time
+    profiler = Profiler(capacity=1)
+    profiler.attach(sim.exchange)
+    n_trades = len(sim.exchange.trade_log)
+    steps = 0
+    try:
+        while sim.next():
+            steps += 1
+    finally:
+        profiler.detach(sim.exchange)
+    return {'instructions': sum(profiler._instructions.values()), 'trades': len(sim.exchange.trade_log) - n_trades, 'steps': steps}
+
+
+def _setup_analytics(scale):
+    sim = _setup_market_makers(scale)
+    sim.run()
+    return sim
+
+
+def _run_analytics(sim):
+    # drop the bars kept up to date during the run, so they are rebuilt from the trade log
+    sim.exchange._bar_aggregators.clear()
+    for ticker in sim.exchange.books:
+        sim.exchange.get_price_bars(ticker, '1h')
+        sim.exchange.get_price_bars(ticker, '1min')
+    sim.get_portfolio_histories()
+    for agent in sim.agents:
+        sim.get_portfolio_history(agent.name)
+    return {'trades': len(sim.exchange.trade_log)}
+
+
+SCENARIOS: List[Scenario] = [
+    Scenario('deep_book', _setup_deep_book, _run_deep_book),
+    Scenario('market_makers', _setup_market_makers, _run_simulator),
+    Scenario('taker_crowd', _setup_taker_crowd, _run_simulator),
+    Scenario('population', _setup_population, _run_simulator),
+    Scenario('analytics', _setup_analytics, _run_analytics),
+]
+
+
+def run_scenario(scenario:Scenario, scale:float=1, repeat:int=3) -> Dict[str, float]:
+    """Runs a scenario and returns its wall time in seconds, its throughput per second and the peak memory allocated while it runs, in MB.
+    """
+    seconds = float('inf')
+    for _ in range(repeat):
+        state = scenario.setup(scale)
+        start = time.perf_counter()
+        counts = scenario.run(state)
+        seconds = min(seconds, time.perf_counter() - start)
+    state = scenario.setup(scale)
+    tracemalloc.start()
+    try:
+        scenario.run(state)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    result = {'seconds': seconds, 'peak_mb': peak / 2 ** 20}
+    for name, count in counts.items():
+        result[name] = count
+        result[f'{name}_per_sec'] = count / seconds
+    return result
+
+
+def run_benchmarks(names:List[str]=None, scale:float=1, repeat:int=3) -> Dict[str, Dict[str, float]]:
+    """Runs the given scenarios (all by default) and returns their results by name.
+    """
+    return {
+        scenario.name: run_scenario(scenario, scale, repeat)
+        for scenario in SCENARIOS if names is None or scenario.name in names
+    }
+
+
+def compare(results:Dict[str, Dict[str, float]], baseline:Dict[str, Dict[str, float]], tolerance:float=0.2) -> List[str]:
+    """Returns the regressions of the results against a baseline: scenarios more than tolerance slower, or using more than
+    tolerance more peak memory.
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        for metric in ('seconds', 'peak_mb'):
+            if base[metric] > 0 and result[metric] > base[metric] * (1 + tolerance):
+                regressions.append(f'{name}: {metric} {result[metric]:.3f} vs {base[metric]:.3f} ({result[metric] / base[metric] - 1:+.0%})')
+    return regressions
+
+
+def _print_results(results, baseline):
+    for name, result in results.items():
+        rates = ', '.join(f'{k} {v:,.0f}' for k, v in result.items() if k.endswith('_per_sec'))
+        line = f'{name:<15} {result["seconds"]:8.3f}s {result["peak_mb"]:8.1f}MB  {rates}'
+        if baseline and name in baseline:
+            line += f'  ({result["seconds"] / baseline[name]["seconds"] - 1:+.0%} time vs baseline)'
+        print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('scenarios', nargs='*', help='the scenarios to run (all by default): ' + ', '.join(s.name for s in SCENARIOS))
+    parser.add_argument('--scale', type=float, default=1, help='multiplies the size of every scenario')
+    parser.add_argument('--repeat', type=int, default=3, help='number of timed runs, the best one is kept')
+    parser.add_argument('--baseline', help='a JSON file of results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='relative slowdown or memory growth reported as a regression')
+    parser.add_argument('--save', help='writes the results to this JSON file')
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.scenarios or None, args.scale, args.repeat)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            stored = json.load(f)
+        if stored['scale'] != args.scale:
+            parser.error(f"the baseline was run with --scale {stored['scale']}")
+        baseline = stored['results']
+    _print_results(results, baseline)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'scale': args.scale, 'results': results}, f, indent=2)
+    if baseline:
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print('REGRESSION', regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
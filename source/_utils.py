@@ -1,15 +1,8 @@
 from datetime import timedelta
-import random, string
+import numpy as np
+import pandas as pd
 
 
-def get_pandas_time(time_unit):
-    return {
-        'second': '1s',
-        'minute': '1Min',
-        'hour': '1H',
-        'day': '1Day',
-    }[time_unit]
-
 def get_timedelta(time_unit):
     return {
         'second': timedelta(seconds=1),
@@ -18,15 +11,53 @@ def get_timedelta(time_unit):
         'day': timedelta(days=1),
     }[time_unit]
 
-def get_datetime_range(start_date, end_date,time_unit='day'):
-    date_range =[]
-    delta = get_timedelta(time_unit)
-    while start_date < end_date:
-        date_range.append(start_date)
-        start_date += delta
-    return date_range
+class DatetimeRange():
+    """Lazy sequence of the timestamps from start_date (included) to end_date (excluded) every time_unit.
+
+    Timestamps are computed on demand, so memory does not depend on the length of the range. The whole grid can be
+    materialized in a single vectorized call with to_numpy or to_index.
+    """
+    def __init__(self, start_date, end_date, time_unit='day'):
+        self.start_date = start_date
+        self.end_date = end_date
+        self.time_unit = time_unit
+        self.delta = get_timedelta(time_unit)
+        self._len = max(0, -(-(end_date - start_date) // self.delta))
+
+    def __repr__(self):
+        return f'<DatetimeRange: {self.start_date} - {self.end_date} every {self.time_unit}>'
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        dt, delta = self.start_date, self.delta
+        for _ in range(self._len):
+            yield dt
+            dt += delta
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += self._len
+        if not 0 <= idx < self._len:
+            raise IndexError('DatetimeRange index out of range')
+        return self.start_date + idx * self.delta
+
+    def index_of(self, dt) -> int:
+        """Returns the position of the last timestamp at or before dt (-1 if dt is before the start).
+        """
+        return max(-1, min((dt - self.start_date) // self.delta, self._len - 1))
+
+    def to_numpy(self) -> np.ndarray:
+        """Returns all the timestamps as a datetime64[ns] array.
+        """
+        return np.datetime64(self.start_date, 'ns') + np.arange(self._len) * np.timedelta64(self.delta).astype('timedelta64[ns]')
+
+    def to_index(self) -> pd.DatetimeIndex:
+        """Returns all the timestamps as a DatetimeIndex.
+        """
+        return pd.DatetimeIndex(self.to_numpy(), name='dt')
 
 
-def get_random_string(length=9):
-    x = ''.join(random.choice(string.ascii_uppercase + string.ascii_lowercase + string.digits) for _ in range(length))
-    return x
\ No newline at end of file
+def get_datetime_range(start_date, end_date,time_unit='day') -> DatetimeRange:
+    return DatetimeRange(start_date, end_date, time_unit)
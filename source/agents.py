@@ -1,9 +1,11 @@
+import numpy as np
+import pandas as pd
 from .qmr_exchange import Agent
-import random
 
 class RandomMarketTaker(Agent):
     def __init__(self,name,tickers, aum=10_000,prob_buy=.2,prob_sell=.2,qty_per_order=1,seed=None):
-        Agent.__init__(self, name, tickers, aum)
+        # seed sets an independent generator (self.rng) for this instance only
+        Agent.__init__(self, name, tickers, aum, seed=seed)
         if  prob_buy + prob_sell> 1:
             raise ValueError("Sum of probabilities cannot be greater than 1.") 
         self.prob_buy = prob_buy
@@ -12,19 +14,14 @@ class RandomMarketTaker(Agent):
         self.tickers
         self.aum = aum
 
-        # Allows for setting a different independent seed to each instance
-        self.random = random
-        if seed is not None:
-            self.random.seed = seed
-
     
     def next(self):
-        for ticker in self.tickers:
-            action = random.choices(
-                ['buy','close',None], weights=[self.prob_buy, self.prob_sell, 1 - self.prob_buy - self.prob_sell])[0]
-            if action == 'buy':
+        # one uniform draw per ticker: buy below prob_buy, close below prob_buy + prob_sell, otherwise do nothing
+        draws = self.rng.random(len(self.tickers))
+        for ticker, draw in zip(self.tickers, draws):
+            if draw < self.prob_buy:
                 self.market_buy(ticker,self.qty_per_order)
-            elif action == 'close':
+            elif draw < self.prob_buy + self.prob_sell:
                 self.exchange.market_sell(ticker,self.get_position(ticker),self.name)
 
 
@@ -44,5 +41,142 @@ class NaiveMarketMaker(Agent):
             self.limit_sell(ticker, price * (1+self.spread_pct/2), qty=self.qty_per_order)
 
 
+class RandomMarketTakerPopulation(Agent):
+    """A population of n RandomMarketTakers held in NumPy arrays and trading as a single agent.
+
+    Every step each member buys qty_per_order with probability prob_buy, or closes its position with probability prob_sell.
+    The orders of all the members are aggregated into one market buy and one market sell per ticker, and the fills are then
+    allocated back to the members in a random order at the average price of the fills. The ledger of the agent holds the totals
+    of the population, and get_member_portfolios / get_member_fills report the individual members.
+    """
+    def __init__(self, name, tickers, n, aum=10_000, prob_buy=.2, prob_sell=.2, qty_per_order=1, seed=None, keep_transactions=True):
+        """_summary_
+
+        Args:
+            name (str): the name of the population, which is the creator of all its orders.
+            tickers (List[str]): the tickers of the assets the members trade.
+            n (int): the number of members.
+            aum (optional): the initial cash of each member, a scalar or an array of length n. Defaults to 10_000.
+            prob_buy (optional): the probability of buying, a scalar or an array of length n. Defaults to .2.
+            prob_sell (optional): the probability of closing the position, a scalar or an array of length n. Defaults to .2.
+            qty_per_order (optional): the quantity of each purchase, a scalar or an array of length n. Defaults to 1.
+            seed (int, optional): the seed of the generator of the population. Defaults to None.
+            keep_transactions (bool, optional): whether the fills of the population and of every member are kept. Defaults to True.
+        """
+        prob_buy = np.broadcast_to(np.asarray(prob_buy, dtype=float), (n,)).copy()
+        prob_sell = np.broadcast_to(np.asarray(prob_sell, dtype=float), (n,)).copy()
+        if np.any(prob_buy + prob_sell > 1):
+            raise ValueError("Sum of probabilities cannot be greater than 1.")
+        member_cash = np.broadcast_to(np.asarray(aum, dtype=float), (n,)).copy()
+        Agent.__init__(self, name, tickers, float(member_cash.sum()), keep_transactions, seed)
+        self.n = n
+        self.prob_buy = prob_buy
+        self.prob_sell = prob_sell
+        self.qty_per_order = np.broadcast_to(np.asarray(qty_per_order, dtype=np.int64), (n,)).copy()
+        self.member_cash = member_cash
+        self.member_initial_cash = member_cash.copy()
+        self.member_positions = np.zeros((n, len(tickers)), dtype=np.int64)
+        self._ticker_idx = {ticker: j for j, ticker in enumerate(tickers)}
+        # members behind the aggregated orders of the current step: ticker -> (buyers, their qty, sellers, their qty)
+        self._pending = {}
+        # per-member fills, one chunk of arrays per (step, ticker, side)
+        self._member_fills = []
+
+    def __repr__(self):
+        return f'<RandomMarketTakerPopulation: {self.name}, {self.n} members>'
+
+    def __getstate__(self):
+        # the fills of the members are pickled as a few long arrays instead of one small chunk per step
+        state = self.__dict__.copy()
+        chunks = self._member_fills
+        state['_member_fills'] = (
+            [c[0] for c in chunks],
+            [c[1] for c in chunks],
+            np.array([len(c[2]) for c in chunks], dtype=np.int64),
+            np.concatenate([c[2] for c in chunks]) if chunks else np.array([], dtype=np.int64),
+            np.concatenate([c[3] for c in chunks]) if chunks else np.array([], dtype=np.int64),
+            np.concatenate([c[4] for c in chunks]) if chunks else np.array([], dtype=float),
+        )
+        return state
+
+    def __setstate__(self, state):
+        dts, tickers, sizes, members, qty, cash_flow = state['_member_fills']
+        splits = np.cumsum(sizes)[:-1]
+        state['_member_fills'] = list(zip(dts, tickers, np.split(members, splits), np.split(qty, splits), np.split(cash_flow, splits)))
+        self.__dict__.update(state)
+
+    def next(self):
+        draws = self.rng.random((self.n, len(self.tickers)))
+        buying = draws < self.prob_buy[:, None]
+        closing = ~buying & (draws < (self.prob_buy + self.prob_sell)[:, None]) & (self.member_positions > 0)
+        self._pending = {}
+        orders = []
+        for j, ticker in enumerate(self.tickers):
+            buyers = self.rng.permutation(np.flatnonzero(buying[:, j]))
+            sellers = self.rng.permutation(np.flatnonzero(closing[:, j]))
+            buy_qty = self.qty_per_order[buyers]
+            sell_qty = self.member_positions[sellers, j]
+            self._pending[ticker] = (buyers, buy_qty, sellers, sell_qty)
+            if len(buyers):
+                orders.append({'type': 'market_buy', 'ticker': ticker, 'qty': int(buy_qty.sum())})
+            if len(sellers):
+                orders.append({'type': 'market_sell', 'ticker': ticker, 'qty': int(sell_qty.sum())})
+        if orders:
+            self.submit_batch(orders)
+
+    def _settle(self, dt, fills):
+        Agent._settle(self, dt, fills)
+        # total qty and cash flow of each side of each ticker
+        totals = {}
+        for ticker, qty, cash_flow in fills:
+            if qty:
+                total = totals.setdefault((ticker, qty > 0), [0, 0.0])
+                total[0] += abs(qty)
+                total[1] += cash_flow
+        for ticker, (buyers, buy_qty, sellers, sell_qty) in self._pending.items():
+            j = self._ticker_idx[ticker]
+            for members, qty, sign in ((buyers, buy_qty, 1), (sellers, sell_qty, -1)):
+                total = totals.get((ticker, sign > 0))
+                if total is None or not len(members):
+                    continue
+                filled, cash_flow = total
+                # the members are filled one after the other until the filled quantity runs out
+                allocated = np.clip(filled - (np.cumsum(qty) - qty), 0, qty)
+                member_cash_flow = allocated * (cash_flow / filled)
+                self.member_positions[members, j] += sign * allocated
+                self.member_cash[members] += member_cash_flow
+                if self.ledger.keep_history:
+                    mask = allocated > 0
+                    self._member_fills.append((dt, ticker, members[mask], sign * allocated[mask], member_cash_flow[mask]))
+        self._pending = {}
+
+    def get_member_portfolios(self) -> pd.DataFrame:
+        """Returns the current portfolio of every member, valued at the latest trade of each asset.
+
+        Returns:
+            pd.DataFrame: a dataframe indexed by member with the value of each ticker, the cash and the aum.
+        """
+        prices = np.array([self.get_latest_trade(ticker).price for ticker in self.tickers])
+        holdings = self.member_positions * prices
+        df = pd.DataFrame(holdings, columns=self.tickers, index=pd.RangeIndex(self.n, name='member'))
+        df['cash'] = self.member_cash
+        df['aum'] = holdings.sum(axis=1) + self.member_cash
+        return df
+
+    def get_member_fills(self) -> pd.DataFrame:
+        """Returns the fills allocated to the members.
 
-            
\ No newline at end of file
+        Returns:
+            pd.DataFrame: a dataframe indexed by datetime with the columns member, ticker, qty and cash_flow.
+        """
+        chunks = self._member_fills
+        sizes = [len(members) for _, _, members, _, _ in chunks]
+        return pd.DataFrame(
+            {
+                'member': np.concatenate([c[2] for c in chunks]) if chunks else np.array([], dtype=np.int64),
+                'ticker': np.repeat([c[1] for c in chunks], sizes) if chunks else np.array([], dtype=object),
+                'qty': np.concatenate([c[3] for c in chunks]) if chunks else np.array([], dtype=np.int64),
+                'cash_flow': np.concatenate([c[4] for c in chunks]) if chunks else np.array([], dtype=float),
+            },
+            index=pd.DatetimeIndex(np.repeat(np.array([c[0] for c in chunks], dtype='datetime64[ns]'), sizes), name='dt'),
+        )
@@ -0,0 +1,162 @@
+from datetime import datetime
+from typing import Dict, List
+import numpy as np
+import pandas as pd
+
+
+BAR_COLUMNS = ['open', 'high', 'low', 'close', 'volume']
+
+
+def get_bar_nanos(bar_size:str) -> int:
+    """Returns the length in nanoseconds of a fixed-size pandas frequency string such as '15Min' or '1D'.
+
+    Raises:
+        ValueError: if the frequency does not have a fixed length (e.g. weeks or months).
+    """
+    return pd.tseries.frequencies.to_offset(bar_size).nanos
+
+
+class _TickerBars():
+    """OHLCV bars of a single asset. Bars are stored as parallel lists, the last one being the bar that is currently open.
+    """
+    __slots__ = ('origin', 'bucket', 'open', 'high', 'low', 'close', 'volume')
+
+    def __init__(self, origin:int):
+        # bars are aligned to the midnight of the first trade, like pandas' resample(origin='start_day')
+        self.origin = origin
+        self.bucket: List[int] = []
+        self.open: List[float] = []
+        self.high: List[float] = []
+        self.low: List[float] = []
+        self.close: List[float] = []
+        self.volume: List[int] = []
+
+
+class BarAggregator():
+    """Builds fixed-size OHLCV bars incrementally, as trades are printed.
+
+    Updating the current bar is O(1), and the result matches resampling the trades with pandas (empty bars have NaN prices and zero volume).
+    """
+    def __init__(self, bar_size:str='1D'):
+        """_summary_
+
+        Args:
+            bar_size (str, optional): a fixed-size pandas frequency string. Defaults to '1D'.
+        """
+        self.bar_size = bar_size
+        self._step = get_bar_nanos(bar_size)
+        self._bars: Dict[str, _TickerBars] = {}
+        self._last_dt = None
+        self._last_ns = None
+
+    def __repr__(self):
+        return f'<BarAggregator: {self.bar_size}>'
+
+    def update(self, ticker:str, dt:datetime, price:float, qty:int):
+        """Adds a trade to the current bar of its asset, or opens a new bar if the trade falls outside of it. Trades must arrive in chronological order.
+        """
+        if dt is not self._last_dt:
+            self._last_dt = dt
+            self._last_ns = pd.Timestamp(dt).value
+        bars = self._bars.get(ticker)
+        if bars is None:
+            bars = self._bars[ticker] = _TickerBars(self._start_day(self._last_ns))
+        bucket = (self._last_ns - bars.origin) // self._step
+        if bars.bucket and bars.bucket[-1] == bucket:
+            if price > bars.high[-1]:
+                bars.high[-1] = price
+            elif price < bars.low[-1]:
+                bars.low[-1] = price
+            bars.close[-1] = price
+            bars.volume[-1] += qty
+        else:
+            bars.bucket.append(bucket)
+            bars.open.append(price)
+            bars.high.append(price)
+            bars.low.append(price)
+            bars.close.append(price)
+            bars.volume.append(qty)
+
+    def extend(self, ticker:str, dt:np.ndarray, price:np.ndarray, qty:np.ndarray):
+        """Adds a chronologically sorted batch of trades of an asset in a single vectorized pass.
+
+        Args:
+            ticker (str): the ticker of the asset
+            dt (np.ndarray): datetime64[ns] timestamps of the trades
+            price (np.ndarray): the prices of the trades
+            qty (np.ndarray): the quantities of the trades
+        """
+        if not len(dt):
+            return
+        ns = dt.astype('datetime64[ns]').astype(np.int64)
+        bars = self._bars.get(ticker)
+        if bars is None:
+            bars = self._bars[ticker] = _TickerBars(self._start_day(int(ns[0])))
+        buckets = (ns - bars.origin) // self._step
+        # trades belonging to the currently open bar are added one by one
+        n_open = 0
+        if bars.bucket:
+            n_open = int(np.searchsorted(buckets, bars.bucket[-1], side='right'))
+            for i in range(n_open):
+                self._update_open_bar(bars, float(price[i]), int(qty[i]))
+            buckets, price, qty = buckets[n_open:], price[n_open:], qty[n_open:]
+            if not len(buckets):
+                return
+        starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+        ends = np.r_[starts[1:], len(buckets)] - 1
+        bars.bucket.extend(buckets[starts].tolist())
+        bars.open.extend(price[starts].tolist())
+        bars.high.extend(np.maximum.reduceat(price, starts).tolist())
+        bars.low.extend(np.minimum.reduceat(price, starts).tolist())
+        bars.close.extend(price[ends].tolist())
+        bars.volume.extend(np.add.reduceat(qty, starts).tolist())
+
+    def get_bars(self, ticker:str) -> pd.DataFrame:
+        """Returns all the bars of an asset, including the one that is currently open.
+
+        Args:
+            ticker (str): the ticker of the asset
+
+        Returns:
+            pd.DataFrame: a dataframe indexed by the start of each bar with the columns open, high, low, close and volume.
+        """
+        bars = self._bars.get(ticker)
+        if bars is None or not bars.bucket:
+            return pd.DataFrame(columns=BAR_COLUMNS, index=pd.DatetimeIndex([], name='dt'))
+        buckets = np.asarray(bars.bucket, dtype=np.int64)
+        positions = buckets - buckets[0]
+        n = int(positions[-1]) + 1
+        columns = {}
+        for name in ('open', 'high', 'low', 'close'):
+            column = np.full(n, np.nan)
+            column[positions] = getattr(bars, name)
+            columns[name] = column
+        columns['volume'] = np.zeros(n, dtype=np.int64)
+        columns['volume'][positions] = bars.volume
+        index = pd.to_datetime(bars.origin + (buckets[0] + np.arange(n)) * self._step)
+        return pd.DataFrame(columns, index=pd.DatetimeIndex(index, name='dt'), copy=False)
+
+    def get_current_bar(self, ticker:str) -> dict:
+        """Returns the bar that is currently open for an asset, or None if the asset has not traded yet.
+        """
+        bars = self._bars.get(ticker)
+        if bars is None or not bars.bucket:
+            return None
+        return {
+            'dt': pd.Timestamp(bars.origin + bars.bucket[-1] * self._step),
+            'open': bars.open[-1],
+            'high': bars.high[-1],
+            'low': bars.low[-1],
+            'close': bars.close[-1],
+            'volume': bars.volume[-1],
+        }
+
+    def _update_open_bar(self, bars:_TickerBars, price:float, qty:int):
+        bars.high[-1] = max(bars.high[-1], price)
+        bars.low[-1] = min(bars.low[-1], price)
+        bars.close[-1] = price
+        bars.volume[-1] += qty
+
+    @staticmethod
+    def _start_day(ns:int) -> int:
+        return ns - ns % (24 * 3600 * 10**9)
@@ -0,0 +1,75 @@
+from typing import Dict, List
+import numpy as np
+import pandas as pd
+from ._utils import DatetimeRange
+
+# fields of each level in the recorded arrays
+DEPTH_FIELDS = ['bid_p', 'bid_qty', 'bid_count', 'ask_p', 'ask_qty', 'ask_count']
+
+
+class DepthRecorder():
+    """Samples the aggregated depth of the best price levels of a group of assets at every step of a simulation.
+
+    The samples of each ticker go into a (steps, levels, fields) array, where the fields are DEPTH_FIELDS and the levels missing
+    from the book are NaN. Steps skipped by the event-driven clock keep the state of the last step that ran. The arrays start with
+    room for chunk_size steps and double in length when they are full (up to the length of the clock), so memory follows the
+    steps actually recorded rather than the length of the simulation.
+    """
+    def __init__(self, clock:DatetimeRange, tickers:List[str], n_levels:int=10, dtype=np.float64, chunk_size:int=4096):
+        """_summary_
+
+        Args:
+            clock (DatetimeRange): the clock of the simulation, one sample per timestamp.
+            tickers (List[str]): the tickers of the assets to record.
+            n_levels (int, optional): the number of price levels of each side. Defaults to 10.
+            dtype (optional): the dtype of the arrays, e.g. np.float32 to halve their size. Defaults to np.float64.
+            chunk_size (int, optional): the number of steps the arrays have room for initially. Defaults to 4096.
+        """
+        self.clock = clock
+        self.tickers = list(tickers)
+        self.n_levels = n_levels
+        self.chunk_size = chunk_size
+        size = min(chunk_size, len(clock))
+        self.data: Dict[str, np.ndarray] = {ticker: np.full((size, n_levels, len(DEPTH_FIELDS)), np.nan, dtype=dtype) for ticker in self.tickers}
+        # last step that was recorded
+        self._last = -1
+
+    def __repr__(self):
+        return f'<DepthRecorder: {len(self.tickers)} tickers, {self.n_levels} levels>'
+
+    def record(self, step:int, exchange):
+        """Samples the books of the exchange at a given position of the clock.
+        """
+        if self.data and step >= len(next(iter(self.data.values()))):
+            self._grow(step + 1)
+        for ticker, data in self.data.items():
+            if self._last >= 0 and step > self._last + 1:
+                data[self._last + 1:step] = data[self._last]
+            depth = exchange.get_depth(ticker, self.n_levels)
+            row = data[step]
+            row.fill(np.nan)
+            row[:len(depth['bids']), :3] = depth['bids']
+            row[:len(depth['asks']), 3:] = depth['asks']
+        self._last = step
+
+    def get(self, ticker:str) -> np.ndarray:
+        """Returns the (steps, levels, fields) array of an asset, up to the last recorded step. The array is a view and must not be modified.
+        """
+        return self.data[ticker][:self._last + 1]
+
+    def to_frame(self, ticker:str) -> pd.DataFrame:
+        """Returns the recorded depth of an asset as a dataframe indexed by datetime, with (level, field) columns.
+        """
+        data = self.get(ticker)
+        return pd.DataFrame(
+            data.reshape(len(data), -1),
+            index=self.clock.to_index()[:len(data)],
+            columns=pd.MultiIndex.from_product([range(self.n_levels), DEPTH_FIELDS], names=['level', 'field']),
+        )
+
+    def _grow(self, size:int):
+        size = min(max(size, 2 * len(next(iter(self.data.values())))), len(self.clock))
+        for ticker, data in self.data.items():
+            grown = np.full((size,) + data.shape[1:], np.nan, dtype=data.dtype)
+            grown[:len(data)] = data
+            self.data[ticker] = grown
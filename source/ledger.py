@@ -0,0 +1,138 @@
+from array import array
+from datetime import datetime
+from typing import Dict, Iterable, List, Tuple
+import numpy as np
+import pandas as pd
+
+
+class Ledger():
+    """Keeps the cash, positions, average costs and realized PnL of an agent up to date as its fills are settled.
+
+    All balances are O(1) lookups. The individual fills can optionally be kept as a compact columnar history, which can be
+    written in chunks to an ArrowSink to keep memory bounded.
+    """
+    def __init__(self, cash:float=0, keep_history:bool=True):
+        """_summary_
+
+        Args:
+            cash (float, optional): the initial cash. Defaults to 0.
+            keep_history (bool, optional): whether every settled fill is stored. Defaults to True.
+        """
+        self.cash = cash
+        self.positions: Dict[str, int] = {}
+        self.avg_cost: Dict[str, float] = {}
+        self.realized_pnl: Dict[str, float] = {}
+        self.keep_history = keep_history
+        self._dt: List[datetime] = []
+        self._ticker: List[str] = []
+        self._qty = array('q')
+        self._cash_flow = array('d')
+        # number of fills written to the sink, which are no longer held in memory
+        self._offset = 0
+        self._sink = None
+        self._name = None
+
+    def __repr__(self):
+        return f'<Ledger: cash {self.cash} {self.positions}>'
+
+    def __len__(self):
+        return self._offset + len(self._qty)
+
+    def record(self, dt:datetime, ticker:str, qty:int, cash_flow:float):
+        """Settles a single fill. qty is positive for purchases and negative for sales, and cash_flow has the opposite sign.
+        """
+        self.cash += cash_flow
+        position = self.positions.get(ticker, 0)
+        if qty:
+            price = -cash_flow / qty
+            avg_cost = self.avg_cost.get(ticker, 0)
+            new_position = position + qty
+            if position == 0 or (position > 0) == (qty > 0):
+                # opening or increasing the position
+                avg_cost = (avg_cost * abs(position) + price * abs(qty)) / abs(new_position)
+            else:
+                # reducing, closing or reversing the position
+                closed = min(abs(qty), abs(position))
+                direction = 1 if position > 0 else -1
+                self.realized_pnl[ticker] = self.realized_pnl.get(ticker, 0) + (price - avg_cost) * closed * direction
+                if new_position == 0:
+                    avg_cost = 0
+                elif (new_position > 0) != (position > 0):
+                    avg_cost = price
+            self.positions[ticker] = new_position
+            self.avg_cost[ticker] = avg_cost
+        if self.keep_history:
+            self._dt.append(dt)
+            self._ticker.append(ticker)
+            self._qty.append(qty)
+            self._cash_flow.append(cash_flow)
+
+    def settle(self, dt:datetime, fills:Iterable[Tuple[str, int, float]]):
+        """Settles a batch of (ticker, qty, cash_flow) fills that happened at the same time.
+        """
+        for ticker, qty, cash_flow in fills:
+            self.record(dt, ticker, qty, cash_flow)
+
+    def get_position(self, ticker:str) -> int:
+        return self.positions.get(ticker, 0)
+
+    def get_avg_cost(self, ticker:str) -> float:
+        return self.avg_cost.get(ticker, 0)
+
+    def get_realized_pnl(self, ticker:str=None) -> float:
+        if ticker is None:
+            return sum(self.realized_pnl.values())
+        return self.realized_pnl.get(ticker, 0)
+
+    def attach_sink(self, sink, name:str):
+        """Sets the ArrowSink that the fills are written to by spill(), under the name of the agent.
+        """
+        self._sink = sink
+        self._name = name
+
+    def spill(self, force:bool=False):
+        """Writes the fills held in memory to the sink and drops them, once there are at least chunk_size of them (or any, if forced).
+        """
+        n = len(self._qty)
+        if self._sink is None or not n or (n < self._sink.chunk_size and not force):
+            return
+        self._sink.write(
+            'fills',
+            {'agent': np.zeros(n, dtype=np.int32), 'dt': np.array(self._dt, dtype='datetime64[ns]'), 'ticker': self._ticker,
+             'qty': np.frombuffer(self._qty, dtype=np.int64), 'cash_flow': np.frombuffer(self._cash_flow, dtype=np.float64)},
+            dictionaries={'agent': [self._name]},
+        )
+        self._offset += n
+        self._dt, self._ticker = [], []
+        self._qty, self._cash_flow = array('q'), array('d')
+
+    @property
+    def transactions(self) -> List[dict]:
+        """The settled fills as a list of dictionaries with the keys dt, cash_flow, ticker and qty.
+        """
+        if self._offset:
+            df = self.to_frame()
+            return [
+                {'dt': dt, 'cash_flow': cash_flow, 'ticker': ticker, 'qty': qty}
+                for dt, cash_flow, ticker, qty in zip(df.index, df['cash_flow'].tolist(), df['ticker'], df['qty'].tolist())
+            ]
+        return [
+            {'dt': dt, 'cash_flow': cash_flow, 'ticker': ticker, 'qty': qty}
+            for dt, cash_flow, ticker, qty in zip(self._dt, self._cash_flow, self._ticker, self._qty)
+        ]
+
+    def to_frame(self) -> pd.DataFrame:
+        """Returns the settled fills as a dataframe indexed by datetime, with the columns cash_flow, ticker and qty.
+        """
+        df = pd.DataFrame(
+            {'cash_flow': self._cash_flow, 'ticker': self._ticker, 'qty': self._qty},
+            index=pd.DatetimeIndex(np.array(self._dt, dtype='datetime64[ns]'), name='dt'),
+        )
+        if self._offset:
+            written = self._sink.read('fills', where=('agent', self._name))
+            written = pd.DataFrame(
+                {'cash_flow': written['cash_flow'], 'ticker': written['ticker'], 'qty': written['qty']},
+                index=pd.DatetimeIndex(written['dt'], name='dt'),
+            )
+            df = pd.concat([written, df])
+        return df
@@ -0,0 +1,141 @@
+import multiprocessing as mp
+from datetime import datetime
+from typing import Dict, List
+import numpy as np
+from .trade_log import Trade
+
+
+class MarketSnapshot():
+    """A read-only view of the market at the start of a step, handed to Agent.decide.
+
+    It holds the quotes and latest trade of every asset plus the positions and cash of the agent it was built for, and can be
+    pickled to worker processes.
+    """
+    def __init__(self, dt:datetime, quotes:Dict[str, dict], latest_trades:Dict[str, Trade], positions:Dict[str, int]=None, cash:float=None):
+        self.dt = dt
+        self._quotes = quotes
+        self._latest_trades = latest_trades
+        self.positions: Dict[str, int] = positions if positions is not None else {}
+        self.cash = cash
+
+    def __repr__(self):
+        return f'<MarketSnapshot: {self.dt}>'
+
+    @classmethod
+    def from_exchange(cls, exchange, agent=None, tickers:List[str]=None) -> 'MarketSnapshot':
+        """Takes a snapshot of the assets of an exchange (all of them unless tickers is given), and of the balances of an agent if given.
+        """
+        if tickers is None:
+            tickers = exchange.books
+        quotes = {ticker: exchange.get_quotes(ticker) for ticker in tickers}
+        latest_trades = {ticker: exchange.get_latest_trade(ticker) for ticker in tickers}
+        snapshot = cls(exchange.datetime, quotes, latest_trades)
+        return snapshot.for_agent(agent) if agent is not None else snapshot
+
+    def for_agent(self, agent) -> 'MarketSnapshot':
+        """Returns a copy of the snapshot (sharing the market data) with the balances of an agent.
+        """
+        return MarketSnapshot(self.dt, self._quotes, self._latest_trades, dict(agent.ledger.positions), agent.cash)
+
+    def get_quotes(self, ticker:str) -> dict:
+        """Returns the best bid and ask prices of an asset and the total quantities at those prices (None for an empty side).
+        """
+        return self._quotes[ticker]
+
+    def get_latest_trade(self, ticker:str) -> Trade:
+        return self._latest_trades[ticker]
+
+    def get_midprice(self, ticker:str) -> float:
+        quotes = self._quotes[ticker]
+        if quotes['bid_p'] is None or quotes['ask_p'] is None:
+            return None
+        return (quotes['bid_p'] + quotes['ask_p']) / 2
+
+    def get_position(self, ticker:str) -> int:
+        return self.positions.get(ticker, 0)
+
+
+def _decide(payload):
+    cls, state, snapshot = payload
+    agent = cls.__new__(cls)
+    agent.__dict__.update(state)
+    intents = agent.decide(snapshot)
+    return intents, agent.__dict__
+
+
+class AgentPool():
+    """Runs the decision phase of agents that implement Agent.decide in a pool of worker processes.
+
+    Every step, each agent receives a snapshot of the market taken at the start of the step and returns its intents
+    (instructions in the format of Exchange.submit_batch) together with its updated state. The intents are then applied to the
+    exchange one agent at a time, in an order that only depends on the step number and the seed, so runs are reproducible: the
+    Simulator fills the places of the deciding agents in the registration order with their intents, taken in that order.
+    """
+    INTENT_ORDERS = ('fixed', 'round_robin', 'random')
+
+    # attributes that stay in the parent process and are not sent to the workers
+    _LOCAL_ATTRIBUTES = ('exchange', 'ledger')
+
+    def __init__(self, processes:int=None, intent_order:str='round_robin', seed:int=None):
+        """_summary_
+
+        Args:
+            processes (int, optional): the number of worker processes. Defaults to None (the number of CPUs).
+            intent_order (str, optional): the order in which the intents of the agents are applied: 'fixed' (order of registration),
+                'round_robin' (registration order rotated by one agent every step) or 'random' (seeded shuffle every step). Defaults to 'round_robin'.
+            seed (int, optional): the seed (or np.random.SeedSequence) of the 'random' intent order. Defaults to None.
+        """
+        if intent_order not in self.INTENT_ORDERS:
+            raise ValueError(f"intent_order must be one of {self.INTENT_ORDERS}.")
+        self.processes = processes
+        self.intent_order = intent_order
+        self._rng = np.random.default_rng(seed)
+        self._pool = None
+        self._step = 0
+
+    def __repr__(self):
+        return f'<AgentPool: {self.processes} processes, {self.intent_order}>'
+
+    def __getstate__(self):
+        # the worker processes are started again on the next step
+        state = self.__dict__.copy()
+        state['_pool'] = None
+        return state
+
+    def decide(self, agents:list, snapshot:MarketSnapshot):
+        """Starts the decision phase of the agents in the background, and returns a handle for collect().
+        """
+        if self._pool is None:
+            self._pool = mp.Pool(self.processes)
+        payloads = [
+            (type(agent), {k: v for k, v in agent.__dict__.items() if k not in self._LOCAL_ATTRIBUTES}, snapshot.for_agent(agent))
+            for agent in agents
+        ]
+        return self._pool.map_async(_decide, payloads)
+
+    def collect(self, agents:list, pending) -> List[List[dict]]:
+        """Waits for the decisions started by decide() and updates the state of the agents.
+
+        Returns:
+            List[List[dict]]: the intents of each agent (with the creator set), in the order they are to be applied.
+        """
+        results = pending.get()
+        for agent, (_, state) in zip(agents, results):
+            agent.__dict__.update(state)
+        order = self._get_order(len(agents))
+        self._step += 1
+        return [[dict(intent, creator=agents[idx].name) for intent in results[idx][0]] for idx in order]
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def _get_order(self, n:int) -> List[int]:
+        if self.intent_order == 'random':
+            return self._rng.permutation(n).tolist()
+        if self.intent_order == 'round_robin' and n:
+            start = self._step % n
+            return list(range(start, n)) + list(range(start))
+        return list(range(n))
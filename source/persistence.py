@@ -0,0 +1,153 @@
+import os
+import shutil
+from typing import Dict, List, Sequence, Tuple, Union
+import numpy as np
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow is optional, it is only needed to persist simulations
+    pa = pc = pq = None
+
+
+class ArrowSink():
+    """Writes the trade log and the fills of the agents to a directory of Parquet or Arrow IPC files while a simulation runs.
+
+    The TradeLog and the Ledgers attached to the sink hand over their rows in chunks of chunk_size, one file per chunk, and only
+    keep the rows that were not written yet. Queries that need the older rows read the files back, memory-mapped.
+    Tickers and agent names are stored as dictionary-encoded strings, so the files are readable without this library.
+    """
+    FORMATS = ('parquet', 'arrow')
+
+    def __init__(self, path:str, format:str='parquet', chunk_size:int=100_000):
+        """_summary_
+
+        Args:
+            path (str): the directory of the files. It is created if it does not exist.
+            format (str, optional): 'parquet' or 'arrow' (Arrow IPC files, which are read back without any copy). Defaults to 'parquet'.
+            chunk_size (int, optional): the number of rows held in memory before they are written to a new file. Defaults to 100_000.
+
+        Raises:
+            ImportError: if pyarrow is not installed.
+        """
+        if pa is None:
+            raise ImportError("ArrowSink requires pyarrow.")
+        if format not in self.FORMATS:
+            raise ValueError(f"format must be one of {self.FORMATS}.")
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.format = format
+        self.chunk_size = chunk_size
+        # files written so far, by dataset
+        self._files: Dict[str, List[str]] = {}
+
+    def __repr__(self):
+        return f'<ArrowSink: {self.path} ({self.format})>'
+
+    def files(self, dataset:str) -> List[str]:
+        """Returns the paths of the files of a dataset ('trades' or 'fills'), in the order they were written.
+        """
+        return list(self._files.get(dataset, []))
+
+    def relocate(self, path:str):
+        """Copies the files written so far to another directory, where the sink writes from then on.
+
+        Raises:
+            ValueError: if the directory is the current one or already holds files.
+        """
+        if os.path.abspath(path) == os.path.abspath(self.path):
+            raise ValueError("The sink already writes to this directory.")
+        os.makedirs(path, exist_ok=True)
+        if os.listdir(path):
+            raise ValueError(f"The directory {path} is not empty.")
+        for dataset, files in self._files.items():
+            self._files[dataset] = [shutil.copy2(file, os.path.join(path, os.path.basename(file))) for file in files]
+        self.path = path
+
+    def write(self, dataset:str, columns:Dict[str, Sequence], dictionaries:Dict[str, List[str]]=None):
+        """Writes a chunk of rows to a new file of a dataset.
+
+        Args:
+            dataset (str): the name of the dataset.
+            columns (Dict[str, Sequence]): the values of each column.
+            dictionaries (Dict[str, List[str]], optional): for the columns given as integer codes, the strings they stand for. Defaults to None.
+        """
+        dictionaries = dictionaries or {}
+        arrays = {}
+        for name, values in columns.items():
+            if name in dictionaries:
+                arrays[name] = pa.DictionaryArray.from_arrays(pa.array(values, pa.int32()), pa.array(dictionaries[name], pa.string()))
+            else:
+                arrays[name] = pa.array(values)
+        table = pa.table(arrays)
+        files = self._files.setdefault(dataset, [])
+        path = os.path.join(self.path, f'{dataset}-{len(files):06d}.{self.format}')
+        if self.format == 'parquet':
+            pq.write_table(table, path)
+        else:
+            with pa.OSFile(path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        files.append(path)
+
+    def read(self, dataset:str, codes:Dict[str, Dict[str, int]]=None, where:Tuple[str, str]=None, file:int=None) -> Union[Dict[str, np.ndarray], None]:
+        """Reads back the files of a dataset.
+
+        Args:
+            dataset (str): the name of the dataset.
+            codes (Dict[str, Dict[str, int]], optional): for the string columns that must be returned as integer codes, the code of each string. Defaults to None.
+            where (Tuple[str, str], optional): a (column, value) pair, to only read the rows where the column equals the value. Defaults to None.
+            file (int, optional): only read the file at this position in files(dataset). Defaults to None (all the files).
+
+        Returns:
+            Union[Dict[str, np.ndarray], None]: the values of each column (other string columns as object arrays), None if nothing was written.
+        """
+        files = self._files.get(dataset)
+        if files and file is not None:
+            files = files[file:file + 1]
+        if not files:
+            return None
+        table = pa.concat_tables([self._read_file(path, where) for path in files])
+        codes = codes or {}
+        result = {}
+        for name in table.column_names:
+            column = table.column(name)
+            if name in codes:
+                result[name] = _to_codes(column, codes[name])
+            elif pa.types.is_dictionary(column.type) or pa.types.is_string(column.type):
+                result[name] = np.array(column.to_pylist(), dtype=object)
+            else:
+                result[name] = column.to_numpy()
+        return result
+
+    def _read_file(self, path, where):
+        if self.format == 'parquet':
+            # the filter is pushed down to the reader, which skips the row groups without the value
+            return pq.read_table(path, memory_map=True, filters=None if where is None else [(where[0], '=', where[1])])
+        table = pa.ipc.open_file(pa.memory_map(path)).read_all()
+        if where is not None:
+            table = table.filter(_equal(table.column(where[0]), where[1]))
+        return table
+
+
+def _equal(column, value:str):
+    # compares the indices of dictionary-encoded chunks with the index of the value, without decoding the strings
+    masks = []
+    for chunk in column.chunks:
+        if pa.types.is_dictionary(chunk.type):
+            idx = pc.index(chunk.dictionary, value).as_py()
+            masks.append(pc.equal(chunk.indices, pa.scalar(idx, chunk.indices.type)) if idx >= 0 else pa.array(np.zeros(len(chunk), dtype=bool)))
+        else:
+            masks.append(pc.equal(chunk, value))
+    return pa.chunked_array(masks, pa.bool_())
+
+
+def _to_codes(column, codes:Dict[str, int]) -> np.ndarray:
+    # the dictionaries of the files may differ from the intern table, so each chunk is mapped through its own dictionary
+    parts = []
+    for chunk in column.chunks:
+        if not pa.types.is_dictionary(chunk.type):
+            chunk = chunk.dictionary_encode()
+        lookup = np.array([codes[value] for value in chunk.dictionary.to_pylist()], dtype=np.int32)
+        parts.append(lookup[chunk.indices.to_numpy(zero_copy_only=False)])
+    return np.concatenate(parts) if parts else np.empty(0, dtype=np.int32)
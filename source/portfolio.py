@@ -0,0 +1,73 @@
+from typing import List
+import numpy as np
+import pandas as pd
+from .trade_log import TradeLog
+
+
+def get_portfolio_histories(trade_log:TradeLog, agents:List[str], tickers:List[str], grid:pd.DatetimeIndex) -> pd.DataFrame:
+    """Values the holdings of many agents at once over a shared time grid.
+
+    Positions and cash flows are taken from the trades in which each agent was the buyer or the seller. Each trade is assigned to the
+    last grid timestamp at or before it, holdings and cash are accumulated with cumulative sums and assets are valued at the last
+    traded price of each period (forward filled, 0 before the first trade).
+
+    Args:
+        trade_log (TradeLog): the trade log of the exchange
+        agents (List[str]): the names of the agents
+        tickers (List[str]): the tickers of the assets to be valued
+        grid (pd.DatetimeIndex): the timestamps at which portfolios are valued
+
+    Returns:
+        pd.DataFrame: a dataframe indexed by the grid, with (agent, field) columns where field is each ticker, 'cash' and 'aum'.
+    """
+    grid = pd.DatetimeIndex(grid, name='dt')
+    n_periods, n_agents, n_tickers = len(grid), len(agents), len(tickers)
+    columns = trade_log.columns()
+    grid_ns = grid.values.astype('datetime64[ns]').astype(np.int64)
+    # trades printed before the first grid timestamp are assigned to it
+    periods = np.maximum(np.searchsorted(grid_ns, columns['dt'].astype(np.int64), side='right') - 1, 0)
+
+    # map the interned codes of the log to positions in the requested agents and tickers (-1 if not requested)
+    agent_codes = np.full(len(trade_log._agents) + 1, -1, dtype=np.int64)
+    for idx, agent in enumerate(agents):
+        code = trade_log._agent_codes.get(agent)
+        if code is not None:
+            agent_codes[code] = idx
+    ticker_codes = np.full(len(trade_log._tickers) + 1, -1, dtype=np.int64)
+    for idx, ticker in enumerate(tickers):
+        code = trade_log._ticker_codes.get(ticker)
+        if code is not None:
+            ticker_codes[code] = idx
+    ticker_idx = ticker_codes[columns['ticker']]
+    valid = ticker_idx >= 0
+
+    # last traded price of each period, forward filled
+    close = np.full((n_periods, n_tickers), np.nan)
+    last_row = np.full((n_periods, n_tickers), -1, dtype=np.int64)
+    rows = np.flatnonzero(valid)
+    np.maximum.at(last_row, (periods[rows], ticker_idx[rows]), rows)
+    traded = last_row >= 0
+    close[traded] = columns['price'][last_row[traded]]
+    filled = np.where(traded, np.arange(n_periods)[:, None], 0)
+    np.maximum.accumulate(filled, axis=0, out=filled)
+    close = close[filled, np.arange(n_tickers)]
+
+    qty = np.zeros((n_periods, n_agents, n_tickers))
+    cash = np.zeros((n_periods, n_agents))
+    notional = columns['qty'] * columns['price']
+    for side, sign in (('buyer', 1), ('seller', -1)):
+        agent_idx = agent_codes[columns[side]]
+        rows = np.flatnonzero(valid & (agent_idx >= 0))
+        np.add.at(qty, (periods[rows], agent_idx[rows], ticker_idx[rows]), sign * columns['qty'][rows])
+        np.add.at(cash, (periods[rows], agent_idx[rows]), -sign * notional[rows])
+    np.cumsum(qty, axis=0, out=qty)
+    np.cumsum(cash, axis=0, out=cash)
+
+    holdings = np.nan_to_num(qty * close[:, None, :])
+    aum = holdings.sum(axis=2) + cash
+    values = np.concatenate([holdings, cash[:, :, None], aum[:, :, None]], axis=2)
+    return pd.DataFrame(
+        values.reshape(n_periods, n_agents * (n_tickers + 2)),
+        index=grid,
+        columns=pd.MultiIndex.from_product([agents, list(tickers) + ['cash', 'aum']], names=['agent', 'field']),
+    )
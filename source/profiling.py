@@ -0,0 +1,190 @@
+import json
+from time import perf_counter_ns
+from typing import Dict, List
+import numpy as np
+import pandas as pd
+from ._utils import DatetimeRange
+
+
+class Profiler():
+    """Records where the time of a simulation goes, step by step, into a fixed-size ring buffer.
+
+    Every step produces one row per phase of Simulator.next (agents, flush, settle, schedule, persist, depth and the whole step),
+    one row per agent that acted (sequential runs only), one row per exchange entry point that was called (number of calls and
+    total time) and one row per counter: orders, cancels, fills, resting orders, price levels and rebuilds of cached market data.
+    Once the buffer is full the oldest rows are overwritten.
+
+    The exchange entry points are only wrapped while the profiler is attached, so a simulation without profiler runs the plain methods.
+    """
+    CATEGORIES = ('phase', 'agent', 'exchange', 'counter')
+    ENTRY_POINTS = ('limit_buy', 'limit_sell', 'market_buy', 'market_sell', 'cancel_order', 'amend_order', 'cancel_all_orders', 'submit_batch')
+    # instruction types (as in Exchange.submit_batch) of the direct calls
+    _INSTRUCTIONS = {'cancel_order': 'cancel', 'amend_order': 'amend', 'cancel_all_orders': 'cancel_all'}
+
+    def __init__(self, clock:DatetimeRange=None, capacity:int=1_000_000):
+        """_summary_
+
+        Args:
+            clock (DatetimeRange, optional): the clock of the simulation, used to add the datetime of each step to to_frame(). Defaults to None.
+            capacity (int, optional): the number of rows kept. Defaults to 1_000_000.
+        """
+        self.clock = clock
+        self.capacity = capacity
+        self._step = np.empty(capacity, dtype=np.int64)
+        self._category = np.empty(capacity, dtype=np.int8)
+        self._name = np.empty(capacity, dtype=np.int32)
+        self._start = np.empty(capacity, dtype=np.int64)
+        self._duration = np.empty(capacity, dtype=np.int64)
+        self._value = np.empty(capacity, dtype=np.int64)
+        # number of rows ever written
+        self._n = 0
+        self._names: List[str] = []
+        self._name_codes: Dict[str, int] = {}
+        self._origin = perf_counter_ns()
+        # state of the current step
+        self._current = 0
+        self._step_start = 0
+        self._mark = 0
+        self._first_trade = 0
+        self._builds = 0
+        # entry point -> [calls, nanoseconds], and instruction type -> count
+        self._calls: Dict[str, list] = {}
+        self._instructions: Dict[str, int] = {}
+        # depth of the wrapped calls in progress, entry points called by other entry points are not counted again
+        self._depth = 0
+
+    def __repr__(self):
+        return f'<Profiler: {len(self)} rows>'
+
+    def __len__(self):
+        return min(self._n, self.capacity)
+
+    def attach(self, exchange):
+        """Wraps the order entry points of an exchange, so that their calls are counted and timed.
+        """
+        for name in self.ENTRY_POINTS:
+            setattr(exchange, name, self._wrap(name, getattr(type(exchange), name).__get__(exchange)))
+
+    def detach(self, exchange):
+        """Restores the plain entry points of an exchange.
+        """
+        for name in self.ENTRY_POINTS:
+            exchange.__dict__.pop(name, None)
+
+    def start_step(self, step:int, exchange):
+        self._current = step
+        self._step_start = self._mark = perf_counter_ns()
+        self._first_trade = len(exchange.trade_log)
+        self._builds = exchange._market_data_builds
+
+    def mark(self, phase:str):
+        """Records the time since the previous mark (or the start of the step) as a phase.
+        """
+        now = perf_counter_ns()
+        self._write(0, phase, self._mark, now - self._mark, 0)
+        self._mark = now
+
+    def record_agent(self, name:str, start:int, end:int):
+        self._write(1, name, start, end - start, 0)
+
+    def end_step(self, exchange):
+        now = perf_counter_ns()
+        self._write(0, 'step', self._step_start, now - self._step_start, 0)
+        for name, (calls, duration) in self._calls.items():
+            self._write(2, name, self._step_start, duration, calls)
+        instructions = self._instructions
+        books = exchange.books.values()
+        counters = {
+            'orders': sum(instructions.get(kind, 0) for kind in ('limit_buy', 'limit_sell', 'market_buy', 'market_sell')),
+            'cancels': instructions.get('cancel', 0) + instructions.get('cancel_all', 0),
+            'fills': len(exchange.trade_log) - self._first_trade,
+            'resting_orders': sum(len(book.bids) + len(book.asks) for book in books),
+            'price_levels': sum(len(book.bids._keys) + len(book.asks._keys) for book in books),
+            'rebuilds': exchange._market_data_builds - self._builds,
+        }
+        for name, value in counters.items():
+            self._write(3, name, self._step_start, 0, value)
+        self._calls = {}
+        self._instructions = {}
+
+    def to_frame(self) -> pd.DataFrame:
+        """Returns the rows in the buffer, oldest first.
+
+        Returns:
+            pd.DataFrame: the columns step (and dt if the profiler has a clock), category, name, start and duration (in nanoseconds
+            since the profiler was created) and value (calls for the exchange rows, the count for the counters).
+        """
+        n = len(self)
+        order = np.arange(self._n - n, self._n) % self.capacity
+        df = pd.DataFrame({
+            'step': self._step[order],
+            'category': pd.Categorical.from_codes(self._category[order], categories=self.CATEGORIES),
+            'name': pd.Categorical.from_codes(self._name[order], categories=self._names),
+            'start': self._start[order] - self._origin,
+            'duration': self._duration[order],
+            'value': self._value[order],
+        })
+        if self.clock is not None:
+            df.insert(1, 'dt', self.clock.to_numpy()[df['step'].to_numpy()])
+        return df
+
+    def to_chrome_trace(self, path:str):
+        """Writes the rows to a JSON file in the Chrome trace event format (chrome://tracing, Perfetto).
+
+        Phases and agents are complete events, on separate threads; the exchange calls and the counters are counter events.
+        """
+        df = self.to_frame()
+        events = []
+        for category, name, start, duration, value, step in zip(df['category'], df['name'], df['start'].tolist(), df['duration'].tolist(),
+                                                               df['value'].tolist(), df['step'].tolist()):
+            ts = start / 1000
+            if category in ('phase', 'agent'):
+                events.append({'name': name, 'cat': category, 'ph': 'X', 'ts': ts, 'dur': duration / 1000, 'pid': 0,
+                               'tid': 0 if category == 'phase' else 1, 'args': {'step': step}})
+            elif category == 'exchange':
+                events.append({'name': name, 'cat': category, 'ph': 'C', 'ts': ts, 'pid': 0, 'args': {'calls': value, 'us': duration / 1000}})
+            else:
+                events.append({'name': name, 'cat': category, 'ph': 'C', 'ts': ts, 'pid': 0, 'args': {name: value}})
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+    def _wrap(self, name, method):
+        instruction = self._INSTRUCTIONS.get(name, name)
+
+        def wrapper(*args, **kwargs):
+            if self._depth:
+                return method(*args, **kwargs)
+            self._depth += 1
+            start = perf_counter_ns()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                duration = perf_counter_ns() - start
+                self._depth -= 1
+                calls = self._calls.get(name)
+                if calls is None:
+                    calls = self._calls[name] = [0, 0]
+                calls[0] += 1
+                calls[1] += duration
+                if name == 'submit_batch':
+                    orders = args[0] if args else kwargs['orders']
+                    for order in orders:
+                        self._instructions[order['type']] = self._instructions.get(order['type'], 0) + 1
+                else:
+                    self._instructions[instruction] = self._instructions.get(instruction, 0) + 1
+        wrapper.__wrapped__ = method
+        return wrapper
+
+    def _write(self, category:int, name:str, start:int, duration:int, value:int):
+        code = self._name_codes.get(name)
+        if code is None:
+            code = self._name_codes[name] = len(self._names)
+            self._names.append(name)
+        idx = self._n % self.capacity
+        self._step[idx] = self._current
+        self._category[idx] = category
+        self._name[idx] = code
+        self._start[idx] = start
+        self._duration[idx] = duration
+        self._value[idx] = value
+        self._n += 1
@@ -1,21 +1,42 @@
-from datetime import datetime
+from bisect import bisect_left, insort
+from collections import deque
+from datetime import datetime, timedelta
 from decimal import Decimal
-from typing import List, Union
+from itertools import count, islice
+import pickle
+from time import perf_counter_ns
+from typing import Deque, Dict, Iterator, List, Tuple, Union
+import numpy as np
 import pandas as pd
 from enum import Enum
-from ._utils import get_datetime_range, get_random_string, get_pandas_time
+from ._utils import DatetimeRange, get_datetime_range
+from .bars import BarAggregator, get_bar_nanos
+from .depth import DepthRecorder
+from .ledger import Ledger
+from .parallel import AgentPool, MarketSnapshot
+from .portfolio import get_portfolio_histories
+from .profiling import Profiler
+from .scheduler import EventScheduler
+from .trade_log import Trade, TradeLog
 
 class OrderSide(Enum):
     BUY = 'buy'
     SELL = 'sell'
 
 
+# ids of orders created outside of an Exchange
+_order_ids = count(1)
+
+
 class LimitOrder():
+    __slots__ = ('id', 'ticker', 'price', 'ticks', 'type', 'qty', 'creator', 'dt')
 
-    def __init__(self, ticker, price, qty, creator, side, dt=None):
-        self.id = get_random_string()
+    def __init__(self, ticker, price, qty, creator, side, dt=None, id=None, ticks=None):
+        self.id: int = id if id is not None else next(_order_ids)
         self.ticker: str = ticker
-        self.price: Decimal = price
+        self.price: float = price
+        # the price as an integer number of ticks of the asset, used for matching
+        self.ticks: int = ticks if ticks is not None else round(price * 100)
         self.type: OrderSide = side
         self.qty: int = qty
         self.creator: str = creator
@@ -38,18 +59,227 @@ class LimitOrder():
         return f'<LimitOrder: {self.ticker} {self.qty}@{self.price}>'
 
 
+class PriceLevel():
+    """A PriceLevel holds all the resting orders of one side of the book at a single price, in FIFO order.
+    """
+    __slots__ = ('price', 'ticks', 'orders', 'qty', 'count')
+
+    def __init__(self, price, ticks):
+        self.price = price
+        self.ticks = ticks
+        # may still hold orders cancelled from the middle of the queue, see BookSide.remove
+        self.orders: Deque[LimitOrder] = deque()
+        self.qty: int = 0
+        self.count: int = 0
+
+    def __repr__(self):
+        return f'<PriceLevel: {self.qty}@{self.price} ({self.count} orders)>'
+
+
+class BookSide():
+    """One side (bids or asks) of an OrderBook. Orders are grouped in price levels, which are kept sorted so that the best price can be accessed in constant time.
+    """
+    def __init__(self, side: OrderSide):
+        """_summary_
+
+        Args:
+            side (OrderSide): BUY for the bids and SELL for the asks.
+        """
+        self.side = side
+        # Level keys are signed so that the best price is always the last element of the sorted list
+        self._sign = 1 if side == OrderSide.BUY else -1
+        self._keys: List[int] = []
+        self._levels: Dict[int, PriceLevel] = {}
+        self._n_orders = 0
+        # orders cancelled from the middle of a queue, skipped and discarded lazily once they reach its front
+        self._cancelled = set()
+        # number of changes, see OrderBook.version
+        self.version = 0
+
+    def __repr__(self):
+        return f'<BookSide: {self.side.value} {self._n_orders} orders>'
+
+    def __getstate__(self):
+        # stored as columns of the resting orders in queue order, without the lazily cancelled ones
+        orders = list(self)
+        return {
+            'side': self.side,
+            'ticker': orders[0].ticker if orders else None,
+            'id': np.array([o.id for o in orders], dtype=np.int64),
+            'ticks': np.array([o.ticks for o in orders], dtype=np.int64),
+            'price': np.array([o.price for o in orders], dtype=np.float64),
+            'qty': np.array([o.qty for o in orders], dtype=np.int64),
+            'creator': [o.creator for o in orders],
+            'dt': [o.dt for o in orders],
+        }
+
+    def __setstate__(self, state):
+        self.__init__(state['side'])
+        ticker, side = state['ticker'], state['side']
+        for id, ticks, price, qty, creator, dt in zip(state['id'].tolist(), state['ticks'].tolist(), state['price'].tolist(),
+                                                      state['qty'].tolist(), state['creator'], state['dt']):
+            self.insert(LimitOrder(ticker, price, qty, creator, side, dt, id, ticks))
+
+    def __len__(self):
+        return self._n_orders
+
+    def __bool__(self):
+        return self._n_orders > 0
+
+    def __iter__(self) -> Iterator[LimitOrder]:
+        """Iterates over the orders by their place in the queue (best price first, then time priority).
+        """
+        cancelled = self._cancelled
+        for key in reversed(self._keys):
+            for order in self._levels[key].orders:
+                if order not in cancelled:
+                    yield order
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return list(self)[idx]
+        if idx == 0 and self._keys:
+            return self.best()
+        if idx < 0:
+            return list(self)[idx]
+        order = next(islice(iter(self), idx, None), None)
+        if order is None:
+            raise IndexError('BookSide index out of range')
+        return order
+
+    @property
+    def levels(self) -> Iterator[PriceLevel]:
+        """Iterates over the price levels, best price first.
+        """
+        return (self._levels[key] for key in reversed(self._keys))
+
+    def best(self) -> Union[LimitOrder, None]:
+        """Returns the order at the front of the queue of the best price level, if any.
+        """
+        if self._keys:
+            orders = self._levels[self._keys[-1]].orders
+            if self._cancelled:
+                while orders[0] in self._cancelled:
+                    self._cancelled.discard(orders.popleft())
+            return orders[0]
+
+    def depth(self, n_levels:int) -> np.ndarray:
+        """Returns the n best price levels as a (levels, 3) array with the price, the total quantity and the number of orders of each level.
+        """
+        levels = self._levels
+        keys = reversed(self._keys[-n_levels:]) if n_levels > 0 else ()
+        return np.array([(levels[key].price, levels[key].qty, levels[key].count) for key in keys], dtype=np.float64).reshape(-1, 3)
+
+    def best_level(self) -> Union[PriceLevel, None]:
+        """Returns the best price level, if any.
+        """
+        if self._keys:
+            return self._levels[self._keys[-1]]
+
+    def insert(self, order: LimitOrder):
+        """Adds an order at the back of the queue of its price level, creating the level if needed.
+        """
+        key = self._sign * order.ticks
+        level = self._levels.get(key)
+        if level is None:
+            level = PriceLevel(order.price, order.ticks)
+            self._levels[key] = level
+            insort(self._keys, key)
+        level.orders.append(order)
+        level.qty += order.qty
+        level.count += 1
+        self._n_orders += 1
+        self.version += 1
+
+    def fill(self, order: LimitOrder, qty: int):
+        """Reduces the quantity of the order returned by best(), removing it once it is completely filled.
+        """
+        key = self._keys[-1]
+        level = self._levels[key]
+        order.qty -= qty
+        level.qty -= qty
+        self.version += 1
+        if order.qty <= 0:
+            level.orders.popleft()
+            level.count -= 1
+            self._n_orders -= 1
+            if not level.count:
+                self._drop_level(key)
+
+    def reduce(self, order: LimitOrder, qty: int):
+        """Reduces the quantity of a resting order without changing its place in the queue.
+        """
+        order.qty -= qty
+        self._levels[self._sign * order.ticks].qty -= qty
+        self.version += 1
+
+    def remove(self, order: LimitOrder):
+        """Removes a resting order from the book, wherever it is in the queue.
+        """
+        key = self._sign * order.ticks
+        level = self._levels[key]
+        level.qty -= order.qty
+        level.count -= 1
+        self._n_orders -= 1
+        self.version += 1
+        if not level.count:
+            self._drop_level(key)
+        elif order is level.orders[-1]:
+            level.orders.pop()
+        elif order is level.orders[0]:
+            level.orders.popleft()
+        else:
+            self._cancelled.add(order)
+
+    def _drop_level(self, key):
+        level = self._levels.pop(key)
+        if self._cancelled:
+            for order in level.orders:
+                self._cancelled.discard(order)
+        if key == self._keys[-1]:
+            self._keys.pop()
+        else:
+            del self._keys[bisect_left(self._keys, key)]
+
+
 class OrderBook():
     """An OrderBook contains all the relevant trading data of a given asset. It contains the list of bids and asks, ordered by their place in the queue.
     """
-    def __init__(self, ticker:str):
+    def __init__(self, ticker:str, tick_size:float=0.01):
         """_summary_
 
         Args:
             ticker (str): the corresponding asset that is going to be traded in the OrderBook.
+            tick_size (float, optional): the minimum price increment of the asset. Defaults to 0.01.
         """
         self.ticker = ticker
-        self.bids: List[LimitOrder] = []
-        self.asks: List[LimitOrder] = []
+        self.tick_size = tick_size
+        # decimals of the tick size, used to turn ticks back into clean float prices
+        self._decimals = max(0, -Decimal(str(tick_size)).as_tuple().exponent)
+        self.bids: BookSide = BookSide(OrderSide.BUY)
+        self.asks: BookSide = BookSide(OrderSide.SELL)
+        # number of trades of the asset printed by the exchange
+        self.n_trades = 0
+
+    @property
+    def version(self) -> int:
+        """A counter that increases whenever an order is added, filled, amended or cancelled, or the asset trades.
+        Market data computed from the book stays valid as long as the version does not change.
+        """
+        return self.n_trades + self.bids.version + self.asks.version
+
+    def to_ticks(self, price:float) -> int:
+        """Rounds a price to the nearest tick and returns it as an integer number of ticks.
+        """
+        return round(price / self.tick_size)
+
+    def to_price(self, ticks:int) -> float:
+        return round(ticks * self.tick_size, self._decimals)
+
+    def get_side(self, side: OrderSide) -> BookSide:
+        """Returns the bids for OrderSide.BUY and the asks for OrderSide.SELL
+        """
+        return self.bids if side == OrderSide.BUY else self.asks
 
     def __repr__(self):
         return f'<OrderBook: {self.ticker}>'
@@ -72,41 +302,62 @@ class OrderBook():
         }
 
 
-class Trade():
-    def __init__(self, ticker, qty, price, buyer, seller, dt=None):
-        self.ticker = ticker
-        self.qty = qty
-        self.price = price
-        self.buyer = buyer
-        self.seller = seller
-        self.dt = dt if dt else datetime.now()
-
-    def __repr__(self):
-        return f'<Trade: {self.ticker} {self.qty}@{self.price} {self.dt}>'
-
-    def to_dict(self):
-        return {
-            'dt': self.dt,
-            'ticker': self.ticker,
-            'qty': self.qty,
-            'price': self.price,
-            'buyer': self.buyer,
-            'seller': self.seller
-        }
-
-
 class Exchange():
-    
+    # parameters required by each type of instruction of submit_batch
+    _BATCH_KEYS = {
+        'limit_buy': ('ticker', 'price', 'qty', 'creator'),
+        'limit_sell': ('ticker', 'price', 'qty', 'creator'),
+        'market_buy': ('ticker', 'qty', 'creator'),
+        'market_sell': ('ticker', 'qty', 'creator'),
+        'cancel': ('id',),
+        'amend': ('id',),
+        'cancel_all': ('ticker', 'creator'),
+    }
+
     def __init__(self, datetime= None):
         self.books = {}
-        self.trade_log: List[Trade] = []
+        # resting orders by id, kept up to date on every insert, fill and cancel
+        self._orders: Dict[int, LimitOrder] = {}
+        # resting orders of each (agent, ticker), in order of submission
+        self._agent_orders: Dict[Tuple[str, str], Dict[int, LimitOrder]] = {}
+        self._order_ids = count(1)
+        self.trade_log: TradeLog = TradeLog()
+        # bars kept up to date on every trade, by bar length in nanoseconds
+        self._bar_aggregators: Dict[int, BarAggregator] = {}
         self.datetime = datetime
         self.agents_cash_updates = []
+        # market data computed from the books, by (ticker, kind): (book, book version, value)
+        self._market_data: Dict[tuple, tuple] = {}
+        # number of cache misses of the market data, reported by the Profiler
+        self._market_data_builds = 0
 
     def __str__(self):
         return ', '.join(ob for ob in self.books)
 
-    def create_asset(self, ticker: str, seed_price=100, seed_bid=.99, seed_ask=1.01):
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # the order indexes are rebuilt from the books, and the id counter is stored as the next id
+        del state['_orders'], state['_agent_orders'], state['_market_data']
+        # entry points wrapped by a Profiler are not saved
+        for name in [name for name in state if hasattr(type(self), name)]:
+            del state[name]
+        next_id = next(self._order_ids)
+        self._order_ids = count(next_id)
+        state['_order_ids'] = next_id
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._order_ids = count(state['_order_ids'])
+        self._market_data = {}
+        self._orders = {}
+        self._agent_orders = {}
+        resting = [order for book in self.books.values() for side in (book.bids, book.asks) for order in side]
+        # ids are assigned in order of submission
+        for order in sorted(resting, key=lambda order: order.id):
+            self._index_order(order)
+
+    def create_asset(self, ticker: str, seed_price=100, seed_bid=.99, seed_ask=1.01, tick_size=0.01):
         """_summary_
 
         Args:
@@ -114,8 +365,9 @@ class Exchange():
             seed_price (int, optional): Price of an initial trade that is created for ease of use. Defaults to 100.
             seed_bid (float, optional): Limit price of an initial buy order, expressed as percentage of the seed_price. Defaults to .99.
             seed_ask (float, optional): Limit price of an initial sell order, expressed as percentage of the seed_price. Defaults to 1.01.
+            tick_size (float, optional): the minimum price increment of the asset. Limit prices are rounded to the nearest tick. Defaults to 0.01.
         """
-        self.books[ticker] = OrderBook(ticker)
+        self.books[ticker] = OrderBook(ticker, tick_size)
         self._process_trade(ticker, 1, seed_price, 'init_seed', 'init_seed',)
         self.limit_buy(ticker, seed_price * seed_bid, 1, 'init_seed')
         self.limit_sell(ticker, seed_price * seed_ask, 1, 'init_seed')
@@ -133,9 +385,11 @@ class Exchange():
         return self.books[ticker]
 
     def _process_trade(self, ticker, qty, price, buyer, seller):
-        self.trade_log.append(
-            Trade(ticker, qty, price, buyer, seller,self.datetime)
-        )
+        dt = self.datetime if self.datetime else datetime.now()
+        self.trade_log.append(ticker, qty, price, buyer, seller, dt)
+        self.books[ticker].n_trades += 1
+        for bars in self._bar_aggregators.values():
+            bars.update(ticker, dt, price, qty)
         self.agents_cash_updates.extend([
             {'agent':buyer,'cash_flow':-qty*price,'ticker':ticker,'qty': qty},
             {'agent':seller,'cash_flow':qty*price,'ticker':ticker,'qty': -qty}
@@ -143,6 +397,31 @@ class Exchange():
         
     
 
+    def record_trades(self, ticker:str, qty:np.ndarray, price:np.ndarray, creator:str):
+        """Prints trades of an agent with itself at given prices, without going through the book, e.g. to replay recorded trades.
+
+        The trades are stamped with the current datetime and show in the trade log, the bars and the latest trade like any
+        other, but no resting order is filled. Both sides are the creator, so they are not settled.
+
+        Args:
+            ticker (str): the ticker of the asset
+            qty (np.ndarray): the quantities of the trades
+            price (np.ndarray): the prices of the trades
+            creator (str): the name of the agent, which is both the buyer and the seller
+        """
+        if not len(qty):
+            return
+        book = self.books[ticker]
+        dt = self.datetime if self.datetime else datetime.now()
+        qty = np.asarray(qty, dtype=np.int64)
+        price = np.asarray(price, dtype=np.float64)
+        self.trade_log.extend(ticker, qty, price, creator, creator, dt)
+        book.n_trades += len(qty)
+        if self._bar_aggregators:
+            dts = np.full(len(qty), np.datetime64(dt, 'ns'))
+            for bars in self._bar_aggregators.values():
+                bars.extend(ticker, dts, price, qty)
+
     def get_latest_trade(self, ticker:str) -> Trade:
         """Retrieves the most recent trade of a given asset
 
@@ -152,7 +431,7 @@ class Exchange():
         Returns:
             Trade
         """
-        return next(trade for trade in self.trade_log[::-1] if trade.ticker == ticker)
+        return self.trade_log.last(ticker)
 
     def get_trades(self, ticker:str) -> pd.DataFrame:
         """Retrieves all past trades of a given asset
@@ -161,24 +440,63 @@ class Exchange():
             ticker (str): the ticker of the asset
 
         Returns:
-            pd.DataFrame: a dataframe containing all trades
+            pd.DataFrame: a dataframe containing all trades. It is shared with other callers until the asset trades again, and must not be modified.
         """
-        return pd.DataFrame.from_records([t.to_dict() for t in self.trade_log if t.ticker == ticker]).set_index('dt').sort_index()
+        return self._get_market_data(ticker, 'trades', self._build_trades_frame, self.books[ticker].n_trades)
+
+    def _build_trades_frame(self, book):
+        trades = self.trade_log.to_frame(book.ticker)
+        if not trades.index.is_monotonic_increasing:
+            trades = trades.sort_index(kind='stable')
+        return trades
 
     def get_quotes(self, ticker):
-        # TODO: if more than one order has the best price, add the quantities.
-        # TODO: check if corresponding quotes exist in order to avoid exceptions
-        best_bid = self.books[ticker].bids[0]
-        best_ask = self.books[ticker].asks[0]
+        """Returns the best bid and ask prices of an asset and the total quantities at those prices (None for an empty side).
+        The dictionary is a copy of the cached quotes, so callers may modify it.
+        """
+        return dict(self._get_market_data(ticker, 'quotes', self._build_quotes))
+
+    def _build_quotes(self, book):
+        # quantities are the totals of the best price levels, and empty sides are quoted as None
+        best_bid = book.bids.best_level()
+        best_ask = book.asks.best_level()
         quotes = {
-            'ticker': ticker,
-            'bid_qty': best_bid.qty,
-            'bid_p': best_bid.price,
-            'ask_qty': best_ask.qty,
-            'ask_p': best_ask.price,
+            'ticker': book.ticker,
+            'bid_qty': best_bid.qty if best_bid else None,
+            'bid_p': best_bid.price if best_bid else None,
+            'ask_qty': best_ask.qty if best_ask else None,
+            'ask_p': best_ask.price if best_ask else None,
         }
         return quotes
 
+    def get_depth(self, ticker:str, n_levels:int=10) -> Dict[str, np.ndarray]:
+        """Returns the aggregated depth of the best price levels of an asset.
+
+        Args:
+            ticker (str): the ticker of the asset
+            n_levels (int, optional): the number of price levels of each side. Defaults to 10.
+
+        Returns:
+            Dict[str, np.ndarray]: the 'bids' and 'asks', each a (levels, 3) array with the price, the total quantity and the number of orders
+            of each level, best price first. The arrays are shared with other callers until the book changes, and must not be modified.
+        """
+        return self._get_market_data(ticker, ('depth', n_levels), lambda book: {'bids': book.bids.depth(n_levels), 'asks': book.asks.depth(n_levels)})
+
+    def _get_market_data(self, ticker:str, kind, build, version:int=None):
+        """Returns a value computed from the book of an asset by build(book), reusing the last result while the book is unchanged
+        (or while the given version is, for values that only depend on part of the book). Cached values are shared between callers and must not be modified.
+        """
+        book = self.books[ticker]
+        if version is None:
+            version = book.version
+        cached = self._market_data.get((ticker, kind))
+        if cached is not None and cached[0] is book and cached[1] == version:
+            return cached[2]
+        value = build(book)
+        self._market_data_builds += 1
+        self._market_data[(ticker, kind)] = (book, version, value)
+        return value
+
     def get_best_bid(self, ticker:str) -> LimitOrder:
         """retrieves the current best bid in the orderbook of an asset
 
@@ -188,8 +506,7 @@ class Exchange():
         Returns:
             LimitOrder
         """
-        if self.books[ticker].bids:
-            return self.books[ticker].bids[0]
+        return self.books[ticker].bids.best()
 
     def get_best_ask(self, ticker:str) -> LimitOrder:
         """retrieves the current best ask in the orderbook of an asset
@@ -200,8 +517,7 @@ class Exchange():
         Returns:
             LimitOrder
         """
-        if self.books[ticker].asks:
-            return self.books[ticker].asks[0]
+        return self.books[ticker].asks.best()
 
     def get_midprice(self, ticker:str) -> float:
         """Returns the current midprice of the best bid and ask quotes.
@@ -210,106 +526,316 @@ class Exchange():
             ticker (str): the ticker of the asset
 
         Returns:
-            float: the current midprice
+            float: the current midprice, None if a side of the book is empty
         """
-        quotes = self.get_quotes(ticker)
+        return self._get_market_data(ticker, 'midprice', self._build_midprice)
+
+    def _build_midprice(self, book):
+        quotes = self._get_market_data(book.ticker, 'quotes', self._build_quotes)
+        if quotes['bid_p'] is None or quotes['ask_p'] is None:
+            return None
         return (quotes['bid_p'] + quotes['ask_p']) / 2
 
     def limit_buy(self, ticker: str, price: float, qty: int, creator: str):
-        price = round(price,2)
+        book = self.books[ticker]
+        return self._limit_buy(book, book.to_ticks(price), qty, creator)
+
+    def _limit_buy(self, book: OrderBook, ticks: int, qty: int, creator: str, id: int = None) -> LimitOrder:
+        ticker = book.ticker
+        asks = book.asks
         # check if we can match trades before submitting the limit order
         while qty > 0:
-            best_ask = self.get_best_ask(ticker)
-            if best_ask and price >= best_ask.price:
+            best_ask = asks.best()
+            if best_ask and ticks >= best_ask.ticks:
                 trade_qty = min(qty, best_ask.qty)
                 self._process_trade(ticker, trade_qty,
                                     best_ask.price, creator, best_ask.creator)
                 qty -= trade_qty
-                self.books[ticker].asks[0].qty -= trade_qty
-                self.books[ticker].asks = [
-                    ask for ask in self.books[ticker].asks if ask.qty > 0]
+                asks.fill(best_ask, trade_qty)
+                if best_ask.qty == 0:
+                    self._unindex_order(best_ask)
             else:
                 break
-        queue = len(self.books[ticker].bids)
-        for idx, order in enumerate(self.books[ticker].bids):
-            if price > order.price:
-                queue = idx
-                break
-        new_order = LimitOrder(ticker, price, qty, creator, OrderSide.BUY, self.datetime)
-        self.books[ticker].bids.insert(queue, new_order)
+        if id is None:
+            id = next(self._order_ids)
+        new_order = LimitOrder(ticker, book.to_price(ticks), qty, creator, OrderSide.BUY, self.datetime, id, ticks)
+        # completely filled orders do not rest in the book
+        if qty > 0:
+            book.bids.insert(new_order)
+            self._index_order(new_order)
         return new_order
 
 
     def limit_sell(self, ticker: str, price: float, qty: int, creator: str):
-        price = round(price,2)
+        book = self.books[ticker]
+        return self._limit_sell(book, book.to_ticks(price), qty, creator)
+
+    def _limit_sell(self, book: OrderBook, ticks: int, qty: int, creator: str, id: int = None) -> LimitOrder:
+        ticker = book.ticker
+        bids = book.bids
         # check if we can match trades before submitting the limit order
         while qty > 0:
-            best_bid = self.get_best_bid(ticker)
-            if best_bid and price <= best_bid.price:
+            best_bid = bids.best()
+            if best_bid and ticks <= best_bid.ticks:
                 trade_qty = min(qty, best_bid.qty)
                 self._process_trade(ticker, trade_qty,
                                     best_bid.price, best_bid.creator, creator)
                 qty -= trade_qty
-                self.books[ticker].bids[0].qty -= trade_qty
-                self.books[ticker].bids = [
-                    bid for bid in self.books[ticker].bids if bid.qty > 0]
+                bids.fill(best_bid, trade_qty)
+                if best_bid.qty == 0:
+                    self._unindex_order(best_bid)
             else:
                 break
-        queue = len(self.books[ticker].asks)
-        for idx, order in enumerate(self.books[ticker].asks):
-            if price < order.price:
-                queue = idx
-                break
-        new_order = LimitOrder(ticker, price, qty, creator, OrderSide.SELL, self.datetime)
-        self.books[ticker].asks.insert(queue, new_order)
+        if id is None:
+            id = next(self._order_ids)
+        new_order = LimitOrder(ticker, book.to_price(ticks), qty, creator, OrderSide.SELL, self.datetime, id, ticks)
+        # completely filled orders do not rest in the book
+        if qty > 0:
+            book.asks.insert(new_order)
+            self._index_order(new_order)
         return new_order
 
-    def cancel_order(self, id):
-        for book in self.exchange.books:
-            bid = next(([idx,o] for idx, o in enumerate(self.exchange.books[book].bids) if o.id == id),None)
-            if bid:
-                self.exchange.books[book].bids[bid[0]]
-                self.exchange.books[book].bids.pop(bid[0])
-                return bid
-            ask = next(([idx,o] for idx, o in enumerate(self.exchange.books[book].asks) if o.id == id),None)
-            if ask:
-                self.exchange.books[book].asks.pop(ask[0])
-                return ask
-        return None
+    def get_order(self, id:int) -> Union[LimitOrder,None]:
+        """Returns a resting order by its id
+
+        Args:
+            id (int): the id of the limit order
+
+        Returns:
+            Union[LimitOrder,None]: the order if it is still pending. None if it does not exists or has already been filled/cancelled
+        """
+        return self._orders.get(id)
+
+    def cancel_order(self, id:int) -> Union[LimitOrder,None]:
+        """Cancels the order with a given id (if it exists)
+
+        Args:
+            id (int): the id of the limit order
+
+        Returns:
+            Union[LimitOrder,None]: the cancelled order if it is still pending. None if it does not exists or has already been filled/cancelled
+        """
+        order = self._orders.get(id)
+        if order is None:
+            return None
+        self._unindex_order(order)
+        self.books[order.ticker].get_side(order.type).remove(order)
+        return order
+
+    def amend_order(self, id:int, price:float=None, qty:int=None) -> Union[LimitOrder,None]:
+        """Modifies the price and/or quantity of a resting order. Reducing the quantity keeps the place of the order in the queue.
+        Changing the price or increasing the quantity cancels the order and submits a new one (with a new id) at the back of the queue, which may trade immediately.
+
+        Args:
+            id (int): the id of the limit order
+            price (float, optional): the new limit price. Defaults to None (unchanged).
+            qty (int, optional): the new quantity. Defaults to None (unchanged). A quantity of 0 cancels the order.
+
+        Returns:
+            Union[LimitOrder,None]: the amended (or replacing) order. None if the order does not exist or has already been filled/cancelled
+        """
+        return self._amend_order(id, price, qty)
+
+    def _amend_order(self, id:int, price:float=None, qty:int=None, new_id:int=None) -> Union[LimitOrder,None]:
+        # new_id is the id of the replacing order, None so that the exchange assigns it
+        order = self._orders.get(id)
+        if order is None:
+            return None
+        book = self.books[order.ticker]
+        ticks = order.ticks if price is None else book.to_ticks(price)
+        qty = order.qty if qty is None else qty
+        if qty <= 0:
+            self.cancel_order(id)
+            return None
+        if ticks == order.ticks and qty <= order.qty:
+            book.get_side(order.type).reduce(order, order.qty - qty)
+            return order
+        self.cancel_order(id)
+        if order.type == OrderSide.BUY:
+            return self._limit_buy(book, ticks, qty, order.creator, new_id)
+        return self._limit_sell(book, ticks, qty, order.creator, new_id)
 
     def cancel_all_orders(self, agent, ticker):
-        self.books[ticker].bids = [b for b in self.books[ticker].bids if b.creator != agent]
-        self.books[ticker].asks = [a for a in self.books[ticker].asks if a.creator != agent]
+        orders = self._agent_orders.pop((agent, ticker), None)
+        if not orders:
+            return None
+        book = self.books[ticker]
+        for order in orders.values():
+            del self._orders[order.id]
+            book.get_side(order.type).remove(order)
         return None
 
+    def get_open_orders(self, agent:str, ticker:str) -> List[LimitOrder]:
+        """Returns the resting orders of an agent on a given asset
+
+        Args:
+            agent (str): the name of the agent
+            ticker (str): the ticker of the asset
+
+        Returns:
+            List[LimitOrder]: the pending orders, in order of submission
+        """
+        return list(self._agent_orders.get((agent, ticker), {}).values())
+
+    def _index_order(self, order:LimitOrder):
+        self._orders[order.id] = order
+        self._agent_orders.setdefault((order.creator, order.ticker), {})[order.id] = order
+
+    def _unindex_order(self, order:LimitOrder):
+        del self._orders[order.id]
+        del self._agent_orders[(order.creator, order.ticker)][order.id]
+
     def market_buy(self, ticker: str, qty: int, buyer: str):
-        for idx, ask in enumerate(self.books[ticker].asks):
+        self._market_buy(self.books[ticker], qty, buyer)
+
+    def _market_buy(self, book: OrderBook, qty: int, buyer: str):
+        ticker = book.ticker
+        asks = book.asks
+        while asks:
+            ask = asks.best()
             trade_qty = min(ask.qty, qty)
-            self.books[ticker].asks[idx].qty -= trade_qty
             qty -= trade_qty
             self._process_trade(ticker, trade_qty,
                                 ask.price, buyer, ask.creator)
+            asks.fill(ask, trade_qty)
+            if ask.qty == 0:
+                self._unindex_order(ask)
             if qty == 0:
                 break
-        self.books[ticker].asks = [
-            ask for ask in self.books[ticker].asks if ask.qty > 0]
 
     def market_sell(self, ticker: str, qty: int, seller: str):
-        for idx, bid in enumerate(self.books[ticker].bids):
+        self._market_sell(self.books[ticker], qty, seller)
+
+    def _market_sell(self, book: OrderBook, qty: int, seller: str):
+        ticker = book.ticker
+        bids = book.bids
+        while bids:
+            bid = bids.best()
             trade_qty = min(bid.qty, qty)
-            self.books[ticker].bids[idx].qty -= trade_qty
             qty -= trade_qty
             self._process_trade(ticker, trade_qty,
                                 bid.price, bid.creator, seller)
+            bids.fill(bid, trade_qty)
+            if bid.qty == 0:
+                self._unindex_order(bid)
             if qty == 0:
                 break
-        self.books[ticker].bids = [
-            bid for bid in self.books[ticker].bids if bid.qty > 0]
 
+    def submit_batch(self, orders: List[dict]) -> List[dict]:
+        """Applies many instructions at once, validating all of them before applying any.
 
-    def get_price_bars(self, ticker, bar_size='1D'):
-        trades = self.trades
-        trades = trades[trades['ticker']== ticker]
+        Each instruction is a dictionary with a 'type' and its parameters:
+            - 'limit_buy' / 'limit_sell': 'ticker', 'price', 'qty' and 'creator'
+            - 'market_buy' / 'market_sell': 'ticker', 'qty' and 'creator'
+            - 'cancel': 'id'
+            - 'amend': 'id' and optionally 'price' and 'qty'
+            - 'cancel_all': 'ticker' and 'creator'
+        Instructions are applied in the order they were given, so the outcome is the same as submitting them one by one: an
+        instruction can cancel or amend an order placed earlier in the same batch, and new orders get their ids in that order.
+
+        Args:
+            orders (List[dict]): the instructions
+
+        Raises:
+            ValueError: if an instruction has an unknown type, lacks one of its parameters or refers to an unknown ticker.
+                Nothing is applied in that case.
+
+        Returns:
+            List[dict]: one dictionary per instruction, in the same order, with the resulting 'order' (the new or cancelled
+            LimitOrder, None for market orders and unknown ids) and its 'fills' (the list of Trades it produced).
+        """
+        for idx, order in enumerate(orders):
+            self._check_instruction(idx, order)
+
+        results = []
+        books = self.books
+        trade_log = self.trade_log
+        for order in orders:
+            first_trade = len(trade_log)
+            kind = order['type']
+            if kind == 'limit_buy':
+                book = books[order['ticker']]
+                result = self._limit_buy(book, book.to_ticks(order['price']), order['qty'], order['creator'], self._batch_order_id(order))
+            elif kind == 'limit_sell':
+                book = books[order['ticker']]
+                result = self._limit_sell(book, book.to_ticks(order['price']), order['qty'], order['creator'], self._batch_order_id(order))
+            elif kind == 'market_buy':
+                result = self._market_buy(books[order['ticker']], order['qty'], order['creator'])
+            elif kind == 'market_sell':
+                result = self._market_sell(books[order['ticker']], order['qty'], order['creator'])
+            elif kind == 'cancel':
+                # the order is looked up when the instruction is applied, so it may come from this batch
+                result = self.cancel_order(order['id'])
+            elif kind == 'amend':
+                result = self._amend_order(order['id'], order.get('price'), order.get('qty'), self._batch_order_id(order))
+            else:
+                result = self.cancel_all_orders(order['creator'], order['ticker'])
+            fills = [trade_log[i] for i in range(first_trade, len(trade_log))] if len(trade_log) > first_trade else []
+            results.append({'order': result, 'fills': fills})
+        return results
+
+    def _check_instruction(self, idx:int, order:dict):
+        # raises ValueError for an instruction of submit_batch that cannot be applied
+        keys = self._BATCH_KEYS.get(order.get('type'))
+        if keys is None:
+            raise ValueError(f"Unknown order type '{order.get('type')}'.")
+        missing = [key for key in keys if key not in order]
+        if missing:
+            raise ValueError(f"Instruction {idx} ('{order['type']}') has no {', '.join(missing)}.")
+        if 'ticker' in keys and order['ticker'] not in self.books:
+            raise ValueError(f"Instruction {idx} refers to the unknown ticker '{order['ticker']}'.")
+
+    def _batch_order_id(self, order:dict) -> Union[int, None]:
+        # the id of the order created by a limit or amend instruction of a batch: None, so that the exchange assigns it. See _ShardExchange
+        return None
+
+    def get_price_bars(self, ticker:str, bar_size:str='1D') -> pd.DataFrame:
+        """Returns the OHLCV bars of an asset. Fixed-size bars are served by a BarAggregator that is created on the first request and then updated as trades print.
+
+        Args:
+            ticker (str): the ticker of the asset
+            bar_size (str, optional): a pandas frequency string. Defaults to '1D'.
+
+        Returns:
+            pd.DataFrame: a dataframe indexed by the start of each bar with the columns open, high, low, close and volume.
+        """
+        try:
+            bars = self.get_bar_aggregator(bar_size)
+        except ValueError:
+            # calendar frequencies (weeks, months...) do not have a fixed length
+            return self._resample_price_bars(ticker, bar_size)
+        return bars.get_bars(ticker)
+
+    def get_current_bar(self, ticker:str, bar_size:str='1D') -> dict:
+        """Returns the bar that is currently open for an asset
+
+        Args:
+            ticker (str): the ticker of the asset
+            bar_size (str, optional): a fixed-size pandas frequency string. Defaults to '1D'.
+
+        Returns:
+            dict: the start (dt), open, high, low, close and volume of the bar. None if the asset has not traded yet.
+        """
+        return self.get_bar_aggregator(bar_size).get_current_bar(ticker)
+
+    def get_bar_aggregator(self, bar_size:str) -> BarAggregator:
+        """Returns the BarAggregator of a given bar size, building it from the trade log if it did not exist yet.
+
+        Raises:
+            ValueError: if the bar size does not have a fixed length.
+        """
+        step = get_bar_nanos(bar_size)
+        bars = self._bar_aggregators.get(step)
+        if bars is None:
+            bars = BarAggregator(bar_size)
+            for ticker in self.trade_log.tickers:
+                columns = self.trade_log.columns(ticker)
+                bars.extend(ticker, columns['dt'], columns['price'], columns['qty'])
+            self._bar_aggregators[step] = bars
+        return bars
+
+    def _resample_price_bars(self, ticker, bar_size):
+        trades = self.trade_log.to_frame(ticker)
         df = trades.resample(bar_size).agg({'price': 'ohlc', 'qty': 'sum'})
         df.columns = df.columns.droplevel()
         df.rename(columns={'qty':'volume'},inplace=True)
@@ -317,9 +843,20 @@ class Exchange():
 
     @property
     def trades(self):
-        return pd.DataFrame.from_records([t.to_dict() for t in self.trade_log]).set_index('dt')
+        # rebuilt only when new trades were printed
+        cached = self._market_data.get((None, 'trades'))
+        if cached is None or cached[1] != len(self.trade_log):
+            cached = (None, len(self.trade_log), self.trade_log.to_frame())
+            self._market_data[(None, 'trades')] = cached
+        return cached[2]
 
 
+    def flush(self):
+        """Applies the instructions that are still pending at the end of a simulation step.
+        Orders sent to this exchange are matched as soon as they are received, so there is nothing to do; see ShardedExchange.
+        """
+        pass
+
     def _set_datetime(self, dt):
         self.datetime = dt
 
@@ -328,13 +865,30 @@ class Exchange():
 class Agent():
     """The Agent class is the base class for developing different traders that participate in the simulated exchange.
     """
-    def __init__(self, name:str, tickers:List[str], aum:int=10_000):
+    # whether the agent acts at every step of the simulation. Agents that set it to False only act at the steps requested with
+    # wake_at / wake_in and after the trades or quote changes they subscribed to with wake_on_trade / wake_on_quote.
+    wake_every_step = True
+
+    def __init__(self, name:str, tickers:List[str], aum:int=10_000, keep_transactions:bool=True, seed:int=None):
+        """_summary_
+
+        Args:
+            name (str): the name of the agent, unique within a simulation.
+            tickers (List[str]): the tickers of the assets the agent trades.
+            aum (int, optional): the initial cash. Defaults to 10_000.
+            keep_transactions (bool, optional): whether every settled fill is kept in the ledger history. Defaults to True.
+            seed (int, optional): the seed of the random generator of the agent (self.rng). Defaults to None, in which case the
+                Simulator gives the agent its own stream derived from the seed of the simulation.
+        """
         self.name = name
         self.tickers = tickers
         self.exchange:Exchange = None
-        self.cash = aum
+        self.ledger = Ledger(cash=aum, keep_history=keep_transactions)
         self.initial_cash = aum
-        self._transactions = []
+        self.seed = seed
+        self.rng: np.random.Generator = np.random.default_rng(seed)
+        # wake-up requests and subscriptions not yet seen by the scheduler of the simulation
+        self._events: List[tuple] = []
 
     def __repr__(self):
         return f'<Agent: {self.name}>'
@@ -342,6 +896,18 @@ class Agent():
     def __str__(self):
         return f'<Agent: {self.name}>'
 
+    @property
+    def cash(self) -> float:
+        return self.ledger.cash
+
+    @cash.setter
+    def cash(self, value:float):
+        self.ledger.cash = value
+
+    @property
+    def _transactions(self) -> List[dict]:
+        return self.ledger.transactions
+
     def get_latest_trade(self, ticker:str) -> Trade:
         """Returns the most recent trade of a given asset
 
@@ -395,7 +961,7 @@ class Agent():
         Returns:
             float: the current midprice
         """
-        return self.get_midprice(ticker)
+        return self.exchange.get_midprice(ticker)
 
     def get_order_book(self,ticker):
         return self.exchange.get_order_book(ticker)
@@ -454,30 +1020,90 @@ class Agent():
 
 
     def get_position(self,ticker):
-        return sum(t['qty'] for t in self._transactions if t['ticker'] == ticker)
+        return self.ledger.get_position(ticker)
 
-    def get_cash_history(self):
-        return pd.DataFrame(self.__cash_history).set_index('dt')
+    def get_avg_cost(self, ticker:str) -> float:
+        """Returns the average price paid for the current position of an asset (or received, for short positions).
+        """
+        return self.ledger.get_avg_cost(ticker)
+
+    def get_realized_pnl(self, ticker:str=None) -> float:
+        """Returns the profit or loss realized by reducing positions, for an asset or for all of them.
+        """
+        return self.ledger.get_realized_pnl(ticker)
+
+    def get_cash_history(self) -> pd.DataFrame:
+        """Returns the cash of the agent after each settled transaction. Requires keep_transactions.
+        """
+        transactions = self.ledger.to_frame()
+        return pd.DataFrame({'cash': self.initial_cash + transactions['cash_flow'].cumsum()})
 
     @property
     def trades(self):
-        trades = self.exchange.trades
-        trades = trades[trades[['buyer','seller']].isin([self.name]).any(axis=1)]
-        return trades
+        return self.exchange.trade_log.to_frame(agent=self.name)
 
     def _set_exchange(self,exchange):
         self.exchange = exchange
 
-    def cancel_order(self, id:str) -> Union[LimitOrder,None]:
+    def wake_at(self, dt:datetime):
+        """Asks to act at the first step at or after a given datetime. Only used by agents that do not wake every step.
+        """
+        self._events.append(('at', dt))
+
+    def wake_in(self, delta:timedelta):
+        """Asks to act again after a given time has passed since the current step. Only used by agents that do not wake every step.
+        """
+        self._events.append(('in', delta))
+
+    def wake_on_trade(self, ticker:str, enabled:bool=True):
+        """Subscribes to (or unsubscribes from) the trades of an asset: the agent acts at the step after any trade of the asset.
+        """
+        self._events.append(('trade', ticker, enabled))
+
+    def wake_on_quote(self, ticker:str, enabled:bool=True):
+        """Subscribes to (or unsubscribes from) the quotes of an asset: the agent acts at the step after its best bid or ask changes.
+        """
+        self._events.append(('quote', ticker, enabled))
+
+    def _settle(self, dt:datetime, fills:List[Tuple[str, int, float]]):
+        """Called by the Simulator at the end of each step with the (ticker, qty, cash_flow) fills of the agent.
+        """
+        self.ledger.settle(dt, fills)
+
+    def cancel_order(self, id:int) -> Union[LimitOrder,None]:
         """Cancels the order with a given id (if it exists)
 
         Args:
-            id (str): the id of the limit order
+            id (int): the id of the limit order
 
         Returns:
             Union[LimitOrder,None]: the cancelled order if it is still pending. None if it does not exists or has already been filled/cancelled
         """
-        self.exchange.cancel_order(id=id)
+        return self.exchange.cancel_order(id=id)
+
+    def amend_order(self, id:int, price:float=None, qty:int=None) -> Union[LimitOrder,None]:
+        """Modifies the price and/or quantity of a pending order. Only reducing the quantity keeps the place of the order in the queue.
+
+        Args:
+            id (int): the id of the limit order
+            price (float, optional): the new limit price. Defaults to None (unchanged).
+            qty (int, optional): the new quantity. Defaults to None (unchanged).
+
+        Returns:
+            Union[LimitOrder,None]: the amended order. None if it does not exists or has already been filled/cancelled
+        """
+        return self.exchange.amend_order(id, price=price, qty=qty)
+
+    def submit_batch(self, orders:List[dict]) -> List[dict]:
+        """Submits many limit, market and cancel instructions at once. See Exchange.submit_batch for their format; the creator is filled in with the name of the agent.
+
+        Args:
+            orders (List[dict]): the instructions, e.g. {'type': 'limit_buy', 'ticker': 'XYZ', 'price': 99.5, 'qty': 1} or {'type': 'cancel', 'id': 42}
+
+        Returns:
+            List[dict]: the resulting 'order' and 'fills' of each instruction, in the same order.
+        """
+        return self.exchange.submit_batch([dict(order, creator=self.name) for order in orders])
 
     def cancel_all_orders(self, ticker:str):
         """Cancels all remaining orders that the agent has on an asset.
@@ -487,84 +1113,340 @@ class Agent():
         """
         self.exchange.cancel_all_orders(self.name,ticker)
 
+    def open_orders(self, ticker:str) -> List[LimitOrder]:
+        """Returns the pending limit orders that the agent has on an asset.
 
-    def get_price_bars(self, bar_size='1D'):
-        return  self.exchange.get_price_bars(bar_size)
+        Args:
+            ticker (str): the ticker of the asset.
 
+        Returns:
+            List[LimitOrder]: the pending orders, in order of submission
+        """
+        return self.exchange.get_open_orders(self.name, ticker)
+
+
+    def get_price_bars(self, ticker:str, bar_size:str='1D') -> pd.DataFrame:
+        """Returns the OHLCV bars of an asset
+
+        Args:
+            ticker (str): the ticker of the asset
+            bar_size (str, optional): a pandas frequency string. Defaults to '1D'.
+
+        Returns:
+            pd.DataFrame: a dataframe with the columns open, high, low, close and volume.
+        """
+        return self.exchange.get_price_bars(ticker, bar_size)
+
+    def get_current_bar(self, ticker:str, bar_size:str='1D') -> dict:
+        """Returns the bar that is currently open for an asset, updated with every trade.
+
+        Args:
+            ticker (str): the ticker of the asset
+            bar_size (str, optional): a fixed-size pandas frequency string. Defaults to '1D'.
+
+        Returns:
+            dict: the start (dt), open, high, low, close and volume of the bar.
+        """
+        return self.exchange.get_current_bar(ticker, bar_size)
+
+
+    def decide(self, snapshot:MarketSnapshot) -> List[dict]:
+        """Returns the instructions of the agent for the current step (in the format of Exchange.submit_batch, without the creator),
+        computed only from a read-only snapshot of the market and of the agent's own balances.
+
+        This is an optional hook: agents that do not override it act through next() instead. Agents that implement decide instead
+        of next can have their decisions computed in parallel worker processes (see the parallel_agents argument of Simulator).
+        In that case, any change to the agent's attributes made in decide is copied back to the agent, and the snapshot reflects
+        the market at the start of the step. In sequential mode the snapshot only holds the assets of the agent.
+        """
+        return []
+
+    def _decides(self) -> bool:
+        return type(self).decide is not Agent.decide
 
     def next(self):  
-        pass
+        if self._decides():
+            self.submit_batch(self.decide(MarketSnapshot.from_exchange(self.exchange, self, self.tickers)))
 
 class Simulator():
-    def __init__(self, from_date=datetime(2022,1,1), to_date=datetime(2022,12,31), time_unit='day'):
-        self.datetime_range = iter(get_datetime_range(from_date,to_date,time_unit))
+    def __init__(self, from_date=datetime(2022,1,1), to_date=datetime(2022,12,31), time_unit='day', shards:int=None,
+                 parallel_agents:bool=False, processes:int=None, intent_order:str='round_robin', seed:int=None, sink=None):
+        """_summary_
+
+        Args:
+            from_date (datetime, optional): the start of the simulation. Defaults to datetime(2022,1,1).
+            to_date (datetime, optional): the end of the simulation (excluded). Defaults to datetime(2022,12,31).
+            time_unit (str, optional): the length of a step: 'second', 'minute', 'hour' or 'day'. Defaults to 'day'.
+            shards (int, optional): if set, the order books are split across this many worker processes and matched in parallel at the end of each step (see ShardedExchange). Defaults to None (a single in-process Exchange).
+            parallel_agents (bool, optional): whether agents that implement Agent.decide compute their decisions in a process pool (see AgentPool). The actions are still applied in the registration order, but the deciding agents see the market at the start of the step, so a run only matches a sequential one if their decisions do not depend on the actions of the agents before them in the step. Defaults to False.
+            processes (int, optional): the number of processes of the agent pool. Defaults to None (the number of CPUs).
+            intent_order (str, optional): the order in which the intents of parallel agents are applied: 'fixed', 'round_robin' or 'random'. Defaults to 'round_robin'.
+            seed (int, optional): the seed of the simulation. The agent pool and every agent without a seed of its own
+                get independent random generators spawned from it, so runs with the same seed are identical. Defaults to None.
+            sink (ArrowSink, optional): if set, the trade log and the fills of the agents are written to files in chunks while the
+                simulation runs, and only the rows not written yet are kept in memory. Defaults to None.
+        """
+        self.clock: DatetimeRange = get_datetime_range(from_date,to_date,time_unit)
+        # the first step of the clock is the starting point, agents act from the second one
+        self.scheduler = EventScheduler(self.clock)
         self.dt = from_date
-        self.agents = []
-        self.exchange = Exchange(datetime=from_date)
+        self.agents: List[Agent] = []
+        self._agents_by_name: Dict[str, Agent] = {}
+        if shards:
+            from .sharding import ShardedExchange
+            self.exchange = ShardedExchange(shards, datetime=from_date)
+        else:
+            self.exchange = Exchange(datetime=from_date)
+        self._seed_sequence = np.random.SeedSequence(seed)
+        pool_seed = self._seed_sequence.spawn(1)[0]
+        self.agent_pool: AgentPool = AgentPool(processes, intent_order, pool_seed) if parallel_agents else None
+        self.sink = sink
+        if sink is not None:
+            self.exchange.trade_log.attach_sink(sink)
+        self.depth_recorders: List[DepthRecorder] = []
+        self.profiler: Profiler = None
         self._from_date = from_date
         self._to_date = to_date
         self._time_unit = time_unit
 
-        # Move to first dt for easier postprocessing holdings
-        next(self.datetime_range)
-
     
     def add_agent(self,agent:Agent):
-        # TODO: check that no existing agent already has the same name
+        """Registers an agent in the simulation and connects it to the exchange.
+
+        Raises:
+            ValueError: if another agent already has the same name.
+        """
+        if agent.name in self._agents_by_name:
+            raise ValueError(f"An agent named '{agent.name}' already exists.")
         agent._set_exchange(self.exchange)
+        self.scheduler.add(agent)
+        if self.sink is not None:
+            agent.ledger.attach_sink(self.sink, agent.name)
+        if agent.seed is None:
+            # streams are spawned in order of registration, so they only depend on the seed of the simulation
+            agent.rng = np.random.default_rng(self._seed_sequence.spawn(1)[0])
         self.agents.append(agent)
+        self._agents_by_name[agent.name] = agent
 
     def next(self):
-        try:
-            self.dt = next(self.datetime_range)
-            self.exchange._set_datetime(self.dt)
+        """Advances to the next step where some agent is due and lets the due agents act, in order of registration.
+
+        Returns:
+            bool: False once the end of the clock is reached.
+        """
+        step = self.scheduler.next_step()
+        if step is None:
+            return False
+        due = self.scheduler.pop_due(step)
+        self.dt = self.clock[step]
+        self.exchange._set_datetime(self.dt)
+        agents = [agent for agent in self.agents if agent.wake_every_step or agent.name in due]
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.start_step(step, self.exchange)
+        watched = self.scheduler.watch(self.exchange)
+        if self.agent_pool is not None:
+            self.__next_parallel(agents)
+        elif profiler is None:
+            for agent in agents:
+                agent.next()
+        else:
+            for agent in agents:
+                start = perf_counter_ns()
+                agent.next()
+                profiler.record_agent(agent.name, start, perf_counter_ns())
+        if profiler is not None:
+            profiler.mark('agents')
+        self.exchange.flush()
+        if profiler is not None:
+            profiler.mark('flush')
+        self.__update_agents_cash()
+        if profiler is not None:
+            profiler.mark('settle')
+        for agent in agents:
+            self.scheduler.update(agent)
+        self.scheduler.fire(self.exchange, watched)
+        if profiler is not None:
+            profiler.mark('schedule')
+        if self.sink is not None:
+            self.exchange.trade_log.spill()
             for agent in self.agents:
+                agent.ledger.spill()
+            if profiler is not None:
+                profiler.mark('persist')
+        if self.depth_recorders:
+            for recorder in self.depth_recorders:
+                recorder.record(step, self.exchange)
+            if profiler is not None:
+                profiler.mark('depth')
+        if profiler is not None:
+            profiler.end_step(self.exchange)
+        return True
+
+    def __next_parallel(self, agents:List[Agent]):
+        # deciding agents work from a snapshot taken before anyone acts, while the other agents run in this process. The actions
+        # are applied in the registration order: each deciding agent's place gets the next intents in the intent order
+        deciders = [agent for agent in agents if agent._decides()]
+        if not deciders:
+            for agent in agents:
                 agent.next()
-            self.__update_agents_cash()
-            return True
-        except StopIteration:
-            return False
+            return
+        tickers = list(dict.fromkeys(ticker for agent in deciders for ticker in agent.tickers))
+        pending = self.agent_pool.decide(deciders, MarketSnapshot.from_exchange(self.exchange, tickers=tickers))
+        intents = None
+        for agent in agents:
+            if not agent._decides():
+                agent.next()
+                continue
+            if intents is None:
+                intents = iter(self.agent_pool.collect(deciders, pending))
+            orders = next(intents)
+            if orders:
+                self.exchange.submit_batch(orders)
+
     def run(self):
-        while True:
-            if not self.next():
-                break
+        try:
+            while True:
+                if not self.next():
+                    break
+        finally:
+            if self.agent_pool is not None:
+                self.agent_pool.close()
+
+    def close(self):
+        """Stops the worker processes of the simulation, if any.
+        """
+        if self.agent_pool is not None:
+            self.agent_pool.close()
+        if hasattr(self.exchange, 'close'):
+            self.exchange.close()
+
+    def record_depth(self, n_levels:int=10, tickers:List[str]=None, dtype=np.float64, chunk_size:int=4096) -> DepthRecorder:
+        """Starts recording the depth of the best price levels of some assets at the end of every step, see DepthRecorder.
+
+        Args:
+            n_levels (int, optional): the number of price levels of each side. Defaults to 10.
+            tickers (List[str], optional): the tickers of the assets. Defaults to None (all the assets of the exchange).
+            dtype (optional): the dtype of the recorded arrays. Defaults to np.float64.
+            chunk_size (int, optional): the number of steps the arrays have room for initially. Defaults to 4096.
+
+        Returns:
+            DepthRecorder: the recorder, which also holds the current state of the books.
+        """
+        recorder = DepthRecorder(self.clock, tickers if tickers is not None else list(self.exchange.books), n_levels, dtype, chunk_size)
+        recorder.record(self.scheduler.step, self.exchange)
+        self.depth_recorders.append(recorder)
+        return recorder
+
+    def enable_profiling(self, capacity:int=1_000_000) -> Profiler:
+        """Starts recording per-step timings and counters of the simulation, see Profiler.
+
+        Args:
+            capacity (int, optional): the number of rows kept by the ring buffer of the profiler. Defaults to 1_000_000.
+
+        Returns:
+            Profiler: the profiler, which can be exported with to_frame() or to_chrome_trace().
+        """
+        self.disable_profiling()
+        self.profiler = Profiler(self.clock, capacity)
+        self.profiler.attach(self.exchange)
+        return self.profiler
+
+    def disable_profiling(self):
+        """Stops recording and restores the plain entry points of the exchange.
+        """
+        if self.profiler is not None:
+            self.profiler.detach(self.exchange)
+            self.profiler = None
+
+    def __getstate__(self):
+        # the profiler belongs to the current process, a restored simulation starts without it
+        state = self.__dict__.copy()
+        state['profiler'] = None
+        return state
+
+    def checkpoint(self, path:str):
+        """Saves the whole state of the simulation (clock position, books, trade log, agents and random generators) to a file.
+
+        Books and trades are stored as columns of NumPy arrays. The agents are pickled, so their classes must be importable when the
+        checkpoint is restored. With a sink, the checkpoint refers to the files already written, which restore() copies to the
+        directory of the restored simulation.
+
+        Raises:
+            ValueError: if the exchange is sharded.
+        """
+        if hasattr(self.exchange, 'close'):
+            raise ValueError("Simulations with a sharded exchange cannot be checkpointed.")
+        with open(path, 'wb') as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def restore(cls, path:str, sink_path:str=None) -> 'Simulator':
+        """Loads a simulation saved by checkpoint(). It resumes from the step after the one it was saved at, and every restore
+        of the same checkpoint is an independent copy, so a warmed-up market can be forked into many scenarios.
+
+        Only the object graph of the returned Simulator is live: orders, agents, books or dataframes obtained before the
+        checkpoint still refer to the original simulation and are detached from the restored one. Look them up again through
+        the restored Simulator (e.g. get_agent, exchange.get_order).
+
+        Args:
+            path (str): the path of the checkpoint.
+            sink_path (str, optional): for a simulation with a sink, a new empty directory: the files written before the
+                checkpoint are copied there, and the restored simulation writes its files there. Defaults to None.
+
+        Raises:
+            ValueError: if the simulation has a sink and no sink_path is given, so that forks never write to the same files.
+        """
+        with open(path, 'rb') as f:
+            sim = pickle.load(f)
+        if sim.sink is not None:
+            if sink_path is None:
+                raise ValueError("A simulation with a sink needs a new sink_path to be restored.")
+            # the trade log and the ledgers share the sink object, so they all follow it
+            sim.sink.relocate(sink_path)
+        return sim
 
     def get_price_bars(self, ticker, bar_size='1D'):
         return self.exchange.get_price_bars(ticker, bar_size)
 
-    def get_portfolio_history(self,agent):
-        agent = self.get_agent(agent)
-        bar_size =  get_pandas_time(self._time_unit)
-        portfolio = pd.DataFrame(index=get_datetime_range(self._from_date,self._to_date,self._time_unit))
-        transactions = pd.DataFrame(agent._transactions).set_index('dt')
-        for ticker in list(self.exchange.books.keys()):
-            qty_asset = pd.DataFrame(transactions[transactions['ticker']==ticker]['qty'])
-            qty_asset = qty_asset.resample(bar_size).agg('sum').cumsum()
-            price = pd.DataFrame(index=get_datetime_range(self._from_date,self._to_date,self._time_unit))
-            price = price.join(self.get_price_bars(ticker=ticker,bar_size=bar_size)['close']).ffill()
-            price = price.join(qty_asset).ffill()
-            portfolio[ticker] = (price['close'] * price['qty'])
-        portfolio['cash'] = transactions['cash_flow'].resample(bar_size).agg('sum').ffill()
-        portfolio.fillna(0,inplace=True)
-        portfolio['cash'] = portfolio['cash'].cumsum()
-        portfolio['aum'] = portfolio.sum(axis=1)
-        return portfolio
+    def get_portfolio_history(self, agent:str) -> pd.DataFrame:
+        """Returns the value of the holdings of an agent at each period of the simulation
+
+        Args:
+            agent (str): the name of the agent
+
+        Returns:
+            pd.DataFrame: a dataframe with the value of each asset, the cash and the aum of the agent.
+        """
+        return self.get_portfolio_histories([agent])[agent].rename_axis(columns=None)
+
+    def get_portfolio_histories(self, agents:List[str]=None) -> pd.DataFrame:
+        """Returns the value of the holdings of many agents at each period of the simulation, computed in a single batch.
+
+        Args:
+            agents (List[str], optional): the names of the agents. Defaults to None (all agents).
+
+        Returns:
+            pd.DataFrame: a dataframe with (agent, field) columns, where field is each ticker, 'cash' and 'aum'. Use frame[agent] for the history of a single agent.
+        """
+        if agents is None:
+            agents = [agent.name for agent in self.agents]
+        return get_portfolio_histories(self.exchange.trade_log, agents, list(self.exchange.books.keys()), self.clock.to_index())
 
     @property
     def trades(self):
         return self.exchange.trades
 
     def __update_agents_cash(self):
+        # fills of each agent over the step, settled in one batch per agent
+        fills = {}
         for update in self.exchange.agents_cash_updates:
-            agent_idx = self.__get_agent_index(update['agent'])
-            # Check if not None because initial seed is not an agent
-            if agent_idx is not None:
-                self.agents[agent_idx].cash += update['cash_flow']
-                self.agents[agent_idx]._transactions.append({'dt':self.dt,'cash_flow':update['cash_flow'],'ticker':update['ticker'],'qty':update['qty']})
+            # initial seed is not an agent
+            if update['agent'] in self._agents_by_name:
+                fills.setdefault(update['agent'], []).append((update['ticker'], update['qty'], update['cash_flow']))
+        for name, agent_fills in fills.items():
+            self._agents_by_name[name]._settle(self.dt, agent_fills)
         self.exchange.agents_cash_updates = []
 
-    def get_agent(self, agent_name):
-        return next((d for (index, d) in enumerate(self.agents) if d.name == agent_name), None)
-
-    def __get_agent_index(self,agent_name):
-        return next((index for (index, d) in enumerate(self.agents) if d.name == agent_name), None)
\ No newline at end of file
+    def get_agent(self, agent_name:str) -> Union[Agent, None]:
+        return self._agents_by_name.get(agent_name)
\ No newline at end of file
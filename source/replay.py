@@ -0,0 +1,252 @@
+import os
+from datetime import datetime
+from typing import Dict, Iterator, List, Union
+import numpy as np
+import pandas as pd
+from .qmr_exchange import Agent
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow is optional, it is only needed to replay Parquet files
+    pq = None
+
+
+class TickFile():
+    """Reads a file of recorded trades or quotes in chunks, in order of datetime.
+
+    Only one chunk is held in memory at a time: CSV files are memory-mapped and parsed chunk by chunk, and Parquet files are
+    memory-mapped and read one record batch at a time. The rows must be sorted by datetime.
+
+    The columns of a trades file are dt, ticker, price, qty and optionally side ('buy' or 'sell', the side of the aggressor).
+    The columns of a quotes file are dt, ticker, bid, bid_qty, ask and ask_qty (the best quotes). Files of a single asset
+    may leave out the ticker column and give it as an argument instead.
+    """
+    COLUMNS = {
+        'trades': ['dt', 'ticker', 'price', 'qty'],
+        'quotes': ['dt', 'ticker', 'bid', 'bid_qty', 'ask', 'ask_qty'],
+    }
+    FORMATS = {'.csv': 'csv', '.parquet': 'parquet', '.pq': 'parquet'}
+
+    def __init__(self, path:str, kind:str, format:str=None, chunk_size:int=1_000_000, ticker:str=None, columns:Dict[str, str]=None):
+        """_summary_
+
+        Args:
+            path (str): the path of the file.
+            kind (str): 'trades' or 'quotes'.
+            format (str, optional): 'csv' or 'parquet'. Defaults to None (from the extension of the file).
+            chunk_size (int, optional): the number of rows read at a time. Defaults to 1_000_000.
+            ticker (str, optional): the ticker of all the rows, for files without a ticker column. Defaults to None.
+            columns (Dict[str, str], optional): renames the columns of the file to the expected names, e.g. {'timestamp': 'dt'}. Defaults to None.
+
+        Raises:
+            ImportError: if the file is a Parquet file and pyarrow is not installed.
+        """
+        if kind not in self.COLUMNS:
+            raise ValueError(f"kind must be one of {list(self.COLUMNS)}.")
+        if format is None:
+            format = self.FORMATS.get(os.path.splitext(path)[1].lower())
+        if format not in ('csv', 'parquet'):
+            raise ValueError("format must be 'csv' or 'parquet'.")
+        if format == 'parquet' and pq is None:
+            raise ImportError("Replaying Parquet files requires pyarrow.")
+        self.path = path
+        self.kind = kind
+        self.format = format
+        self.chunk_size = chunk_size
+        self.ticker = ticker
+        self.columns = columns or {}
+        self._reset()
+
+    def __repr__(self):
+        return f'<TickFile: {self.path} ({self.kind})>'
+
+    def __getstate__(self):
+        # open readers cannot be pickled: the file is reopened and the rows already read are skipped
+        state = self.__dict__.copy()
+        for name in ('_chunks', '_chunk', '_dts', '_pos', '_offset', '_skip'):
+            del state[name]
+        state['_consumed'] = self._offset + self._pos
+        return state
+
+    def __setstate__(self, state):
+        consumed = state.pop('_consumed')
+        self.__dict__.update(state)
+        self._reset()
+        self._skip = consumed
+
+    def next_datetime(self) -> Union[datetime, None]:
+        """Returns the datetime of the next row, None at the end of the file.
+        """
+        if not self._ensure():
+            return None
+        return pd.Timestamp(self._dts[self._pos])
+
+    def read_until(self, dt:datetime) -> Iterator[Dict[str, np.ndarray]]:
+        """Yields the next rows up to a given datetime (included), one piece of a chunk at a time.
+
+        Each piece holds the values of each column (tickers as an object array). The side of trades is given as a boolean
+        'buy' column, where the file has one.
+        """
+        end = np.datetime64(pd.Timestamp(dt).to_datetime64(), 'ns')
+        while self._ensure():
+            stop = int(np.searchsorted(self._dts, end, side='right'))
+            if stop <= self._pos:
+                return
+            piece = {name: values[self._pos:stop] for name, values in self._chunk.items()}
+            self._pos = stop
+            yield piece
+
+    def _reset(self):
+        self._chunks = None
+        self._chunk: Dict[str, np.ndarray] = None
+        self._dts: np.ndarray = None
+        self._pos = 0
+        # rows of the previous chunks, and rows to skip when the file is reopened
+        self._offset = 0
+        self._skip = 0
+
+    def _open(self):
+        if self.format == 'csv':
+            return pd.read_csv(self.path, chunksize=self.chunk_size, memory_map=True)
+        return (batch.to_pandas() for batch in pq.ParquetFile(self.path, memory_map=True).iter_batches(batch_size=self.chunk_size))
+
+    def _ensure(self) -> bool:
+        # loads chunks until there is a row left to read
+        if self._chunks is None:
+            self._chunks = self._open()
+        while self._chunk is None or self._pos >= len(self._dts):
+            last = self._dts[-1] if self._dts is not None and len(self._dts) else None
+            if self._chunk is not None:
+                self._offset += len(self._dts)
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                self._chunk = self._dts = None
+                self._pos = 0
+                self._chunks = iter(())
+                return False
+            self._chunk = self._normalize(chunk)
+            self._dts = self._chunk['dt']
+            self._pos = 0
+            if (last is not None and len(self._dts) and self._dts[0] < last) or np.any(self._dts[1:] < self._dts[:-1]):
+                raise ValueError(f"The rows of {self.path} must be sorted by datetime.")
+            if self._skip:
+                self._pos = min(self._skip, len(self._dts))
+                self._skip -= self._pos
+        return True
+
+    def _normalize(self, chunk:pd.DataFrame) -> Dict[str, np.ndarray]:
+        chunk = chunk.rename(columns=self.columns)
+        if 'ticker' not in chunk.columns:
+            if self.ticker is None:
+                raise ValueError(f"{self.path} has no ticker column, and no ticker was given.")
+            chunk['ticker'] = self.ticker
+        missing = [name for name in self.COLUMNS[self.kind] if name not in chunk.columns]
+        if missing:
+            raise ValueError(f"{self.path} has no column {missing}.")
+        # converted once per chunk, so that the pieces are plain slices
+        columns = {name: chunk[name].to_numpy() for name in self.COLUMNS[self.kind]}
+        columns['dt'] = pd.to_datetime(chunk['dt']).to_numpy(dtype='datetime64[ns]')
+        columns['ticker'] = chunk['ticker'].astype(str).to_numpy(dtype=object)
+        if self.kind == 'trades' and 'side' in chunk.columns:
+            columns['buy'] = chunk['side'].astype(str).str.lower().str.startswith('b').to_numpy(dtype=bool)
+        return columns
+
+
+class ReplayAgent(Agent):
+    """Replays recorded trades and quotes into the exchange on the clock of the simulation, so other agents trade against them.
+
+    At each step the agent acts, it applies the rows of its files up to the current datetime:
+        - the trades are printed as trades of the replay agent with itself (see Exchange.record_trades), in bulk. They set the
+          latest trade and the bars of the asset, but never fill resting orders of other agents: those only trade against the
+          replayed quotes. The side column of the file is not used.
+        - the last quote of each asset replaces the orders of the agent, one bid and one ask. Quotes that cross resting orders
+          of other agents fill them.
+    Trades are applied before the quotes of the same step. The seed orders of the assets are cancelled at the first step.
+
+    The agent only wakes at the steps where its files have rows, so it works with the event-driven clock. Its cash and
+    positions are those of the replayed market and are not meaningful.
+    """
+    wake_every_step = False
+
+    def __init__(self, name:str, tickers:List[str], trades:Union[str, TickFile]=None, quotes:Union[str, TickFile]=None,
+                 aum:float=1e12, keep_transactions:bool=False):
+        """_summary_
+
+        Args:
+            name (str): the name of the agent, which is the creator of the replayed orders.
+            tickers (List[str]): the tickers of the assets to replay. Rows of other assets are ignored.
+            trades (Union[str, TickFile], optional): a file of trades, or its path. Defaults to None.
+            quotes (Union[str, TickFile], optional): a file of quotes, or its path. Defaults to None.
+            aum (float, optional): the initial cash of the agent. Defaults to 1e12.
+            keep_transactions (bool, optional): whether the fills of the agent are kept. Defaults to False.
+        """
+        Agent.__init__(self, name, tickers, aum, keep_transactions)
+        if isinstance(trades, str):
+            trades = TickFile(trades, 'trades')
+        if isinstance(quotes, str):
+            quotes = TickFile(quotes, 'quotes')
+        self.trade_file: TickFile = trades
+        self.quote_file: TickFile = quotes
+        # last replayed quote of each asset: (bid, bid_qty, ask, ask_qty)
+        self._quotes: Dict[str, tuple] = {}
+        self._tickers = set(tickers)
+        self._ticker_array = np.array(sorted(self._tickers), dtype=object)
+        self._started = False
+
+    def __repr__(self):
+        return f'<ReplayAgent: {self.name}>'
+
+    def next(self):
+        dt = self.exchange.datetime
+        if not self._started:
+            self.exchange.submit_batch([{'type': 'cancel_all', 'ticker': ticker, 'creator': 'init_seed'} for ticker in self.tickers])
+            self._started = True
+        if self.trade_file is not None:
+            for piece in self.trade_file.read_until(dt):
+                self._record_trades(piece)
+        orders = []
+        quoted = set()
+        if self.quote_file is not None:
+            tickers = self._tickers
+            for piece in self.quote_file.read_until(dt):
+                # only the last quote of each asset is posted
+                for ticker, bid, bid_qty, ask, ask_qty in zip(piece['ticker'].tolist(), piece['bid'].tolist(), piece['bid_qty'].tolist(),
+                                                              piece['ask'].tolist(), piece['ask_qty'].tolist()):
+                    if ticker in tickers:
+                        self._quotes[ticker] = (bid, bid_qty, ask, ask_qty)
+                        quoted.add(ticker)
+        name = self.name
+        for ticker in quoted:
+            orders.append({'type': 'cancel_all', 'ticker': ticker, 'creator': name})
+            quote = self._quotes.get(ticker)
+            if quote is None:
+                continue
+            bid, bid_qty, ask, ask_qty = quote
+            if bid_qty > 0 and bid == bid:
+                orders.append({'type': 'limit_buy', 'ticker': ticker, 'price': bid, 'qty': int(bid_qty), 'creator': name})
+            if ask_qty > 0 and ask == ask:
+                orders.append({'type': 'limit_sell', 'ticker': ticker, 'price': ask, 'qty': int(ask_qty), 'creator': name})
+        if orders:
+            self.exchange.submit_batch(orders)
+        self._schedule()
+
+    def _record_trades(self, piece:Dict[str, np.ndarray]):
+        tickers = piece['ticker']
+        keep = np.isin(tickers, self._ticker_array)
+        if not keep.all():
+            tickers, prices, qtys = tickers[keep], piece['price'][keep], piece['qty'][keep]
+        else:
+            prices, qtys = piece['price'], piece['qty']
+        if not len(tickers):
+            return
+        # runs of consecutive trades of the same asset are recorded at once, so the order of the file is kept
+        starts = np.flatnonzero(np.r_[True, tickers[1:] != tickers[:-1]])
+        ends = np.r_[starts[1:], len(tickers)]
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            self.exchange.record_trades(tickers[start], qtys[start:end], prices[start:end], self.name)
+
+    def _schedule(self):
+        upcoming = [f.next_datetime() for f in (self.trade_file, self.quote_file) if f is not None]
+        upcoming = [dt for dt in upcoming if dt is not None]
+        if upcoming:
+            self.wake_at(min(upcoming))
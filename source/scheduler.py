@@ -0,0 +1,115 @@
+from heapq import heappop, heappush
+from itertools import count
+from typing import Dict, List, Set, Tuple, Union
+from ._utils import DatetimeRange
+
+
+class EventScheduler():
+    """Decides which agents act at each step of a simulation clock, so the Simulator can jump straight to the next step where something happens.
+
+    Agents that wake every step (the default) are always due, and then every step of the clock is visited. The other agents are
+    woken by the wake-up times they request, kept in a heap keyed by step, and by their triggers: a trade or a change of the best
+    quotes of a subscribed ticker wakes the agent at the following step.
+    """
+    def __init__(self, clock:DatetimeRange):
+        self.clock = clock
+        # position in the clock of the current step
+        self.step = 0
+        self._every_step: Set[str] = set()
+        # (step, sequence, agent name)
+        self._wakeups: List[Tuple[int, int, str]] = []
+        self._sequence = count()
+        self._triggered: Set[str] = set()
+        self._trade_subscribers: Dict[str, Set[str]] = {}
+        self._quote_subscribers: Dict[str, Set[str]] = {}
+
+    def __repr__(self):
+        return f'<EventScheduler: step {self.step}, {len(self._wakeups)} wake-ups>'
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        sequence = next(self._sequence)
+        self._sequence = count(sequence)
+        state['_sequence'] = sequence
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._sequence = count(state['_sequence'])
+
+    def add(self, agent):
+        """Registers an agent, which acts at the next step and then according to its own requests.
+        """
+        if not agent.wake_every_step:
+            self.schedule(agent.name, self.step + 1)
+        self.update(agent)
+
+    def update(self, agent):
+        """Applies the wake-up requests and subscriptions made by an agent since the last call.
+        """
+        if agent.wake_every_step:
+            self._every_step.add(agent.name)
+        else:
+            self._every_step.discard(agent.name)
+        events, agent._events = agent._events, []
+        for event in events:
+            kind = event[0]
+            if kind == 'at':
+                self.schedule(agent.name, self._get_step(event[1]))
+            elif kind == 'in':
+                self.schedule(agent.name, self._get_step(self.clock[self.step] + event[1]))
+            else:
+                subscribers = (self._trade_subscribers if kind == 'trade' else self._quote_subscribers).setdefault(event[1], set())
+                if event[2]:
+                    subscribers.add(agent.name)
+                else:
+                    subscribers.discard(agent.name)
+
+    def schedule(self, name:str, step:int):
+        """Wakes an agent at a given step of the clock (at the next step if it is not in the future).
+        """
+        heappush(self._wakeups, (max(step, self.step + 1), next(self._sequence), name))
+
+    def next_step(self) -> Union[int, None]:
+        """Returns the position in the clock of the next step where some agent is due, None if there is none before the end.
+        """
+        if self._every_step or self._triggered:
+            step = self.step + 1
+        elif self._wakeups:
+            step = self._wakeups[0][0]
+        else:
+            return None
+        return step if step < len(self.clock) else None
+
+    def pop_due(self, step:int) -> Set[str]:
+        """Moves to a step and returns the names of the agents woken at it (besides those that wake every step).
+        """
+        self.step = step
+        due, self._triggered = self._triggered, set()
+        while self._wakeups and self._wakeups[0][0] <= step:
+            due.add(heappop(self._wakeups)[2])
+        return due
+
+    def watch(self, exchange) -> Tuple[int, Dict[str, dict]]:
+        """Records the state that the triggers are compared against, before the agents act.
+        """
+        quotes = {ticker: exchange.get_quotes(ticker) for ticker, subscribers in self._quote_subscribers.items() if subscribers}
+        return len(exchange.trade_log), quotes
+
+    def fire(self, exchange, watched:Tuple[int, Dict[str, dict]]):
+        """Wakes at the next step the subscribers of the tickers that traded or whose quotes changed since watch().
+        """
+        first_trade, quotes = watched
+        if self._trade_subscribers and len(exchange.trade_log) > first_trade:
+            for ticker in exchange.trade_log.traded_since(first_trade):
+                self._triggered.update(self._trade_subscribers.get(ticker, ()))
+        for ticker, before in quotes.items():
+            if exchange.get_quotes(ticker) != before:
+                self._triggered.update(self._quote_subscribers[ticker])
+
+    def _get_step(self, dt) -> int:
+        # first step at or after dt
+        step = self.clock.index_of(dt)
+        if step < 0 or self.clock[step] < dt:
+            step += 1
+        return step
@@ -0,0 +1,337 @@
+from itertools import count, islice
+import multiprocessing as mp
+from typing import Dict, List, Union
+from .qmr_exchange import Exchange, LimitOrder, OrderBook, OrderSide
+from .trade_log import TradeLog
+
+
+class _ShardExchange(Exchange):
+    """The Exchange that runs inside a worker process and owns the books of a group of tickers.
+    """
+    def __init__(self, shard:int, n_shards:int, snapshot_depth:int):
+        Exchange.__init__(self)
+        # orders created by the shard itself (the seed orders of create_asset) get negative ids, distinct across shards,
+        # so they never collide with the ids assigned by the parent process
+        self._order_ids = count(-shard - 1, -n_shards)
+        self._snapshot_depth = snapshot_depth
+        self._removed: List[int] = []
+
+    def _unindex_order(self, order:LimitOrder):
+        Exchange._unindex_order(self, order)
+        self._removed.append(order.id)
+
+    def cancel_all_orders(self, agent, ticker):
+        self._removed.extend(self._agent_orders.get((agent, ticker), {}))
+        return Exchange.cancel_all_orders(self, agent, ticker)
+
+    def _batch_order_id(self, order:dict) -> int:
+        # limit orders and the orders replacing amended ones get their ids in the parent process, which sends them with the instructions
+        return order['new_id'] if order['type'] == 'amend' else order['id']
+
+    def setup_asset(self, dt, ticker, seed_price, seed_bid, seed_ask, tick_size):
+        self._set_datetime(dt)
+        self.create_asset(ticker, seed_price, seed_bid, seed_ask, tick_size)
+        return self._collect([ticker])
+
+    def run_batch(self, dt, instructions:List[dict], wanted:List[int]):
+        """Applies the instructions, and returns what _collect returns together with the results of the instructions at the wanted positions.
+        """
+        self._set_datetime(dt)
+        tickers = {i['ticker'] for i in instructions if 'ticker' in i}
+        tickers.update(self._orders[i['id']].ticker for i in instructions if 'ticker' not in i and i['id'] in self._orders)
+        results = self.submit_batch(instructions)
+        for instruction, result in zip(instructions, results):
+            order = result['order']
+            # limit orders that were completely filled on entry never rested in the book
+            if instruction['type'] in ('limit_buy', 'limit_sell') and order.qty == 0:
+                self._removed.append(order.id)
+            # the id reserved for a replacing order is released if the amendment kept the order, or if the replacement never rested
+            elif instruction['type'] == 'amend' and (order is None or order.id != instruction['new_id'] or order.qty == 0):
+                self._removed.append(instruction['new_id'])
+        return self._collect(tickers), [results[idx] for idx in wanted]
+
+    def _collect(self, tickers):
+        """Returns the trades printed since the last call, the ids of the orders that left the books and the top of the books that changed.
+        """
+        columns = self.trade_log.columns()
+        trade_log = self.trade_log
+        trades = list(zip(
+            [trade_log._tickers[c] for c in columns['ticker']],
+            columns['qty'].tolist(),
+            columns['price'].tolist(),
+            [trade_log._agents[c] for c in columns['buyer']],
+            [trade_log._agents[c] for c in columns['seller']],
+        ))
+        # only the parent keeps the history
+        self.trade_log = TradeLog()
+        self.agents_cash_updates = []
+        removed, self._removed = self._removed, []
+        snapshots = {
+            ticker: (self._top_orders(self.books[ticker].bids), self._top_orders(self.books[ticker].asks))
+            for ticker in tickers if ticker in self.books
+        }
+        return trades, removed, snapshots
+
+    def _top_orders(self, side):
+        # all the orders of the best levels, so that the quantities and counts of those levels are complete in the parent
+        return [order for level in islice(side.levels, self._snapshot_depth) for order in level.orders if order not in side._cancelled]
+
+
+class DeferredResult():
+    """The result of an instruction queued by a ShardedExchange, which is only known once the step is flushed.
+    """
+    def __init__(self):
+        self._done = False
+        self._value = None
+
+    def __repr__(self):
+        return f'<DeferredResult: {self._value if self._done else "pending"}>'
+
+    @property
+    def done(self) -> bool:
+        """Whether the step of the instruction has been flushed.
+        """
+        return self._done
+
+    def result(self):
+        """Returns the result the instruction would have returned on an Exchange.
+
+        Raises:
+            RuntimeError: if the step of the instruction has not been flushed yet.
+        """
+        if not self._done:
+            raise RuntimeError("The result is only known once the step is flushed (see ShardedExchange.flush).")
+        return self._value
+
+    def _set(self, value):
+        self._value = value
+        self._done = True
+
+
+def _run_shard(conn, shard:int, n_shards:int, snapshot_depth:int):
+    exchange = _ShardExchange(shard, n_shards, snapshot_depth)
+    while True:
+        method, args = conn.recv()
+        if method is None:
+            break
+        try:
+            conn.send((True, getattr(exchange, method)(*args)))
+        except Exception as e:
+            conn.send((False, e))
+    conn.close()
+
+
+class ShardedExchange(Exchange):
+    """An Exchange whose order books are split across worker processes, so that different tickers are matched in parallel.
+
+    Orders, cancels and amendments are queued during a simulation step and sent to the workers by flush(), which the Simulator
+    calls once all agents have acted. Each worker applies the instructions of its tickers in the order they were submitted, so
+    every book evolves exactly as it would in a single Exchange. The trades are then gathered back in a fixed (shard, submission)
+    order into the trade log of the parent, and settled like any other trade, which keeps runs deterministic.
+
+    Limit orders get their id when they are queued, so limit_buy and limit_sell return the new LimitOrder right away (its quantity
+    is not updated by the fills). cancel_order, amend_order and submit_batch return a DeferredResult instead, whose result() is what
+    an Exchange would have returned, and is available once the step is flushed.
+
+    During a step, reads of the books (quotes, depth, best bid/ask, get_order_book) return the state at the end of the previous step
+    and do not reflect the orders queued in the current one. get_order_book only holds the orders of the first snapshot_depth price
+    levels of each side; use get_full_order_book for a complete copy.
+    """
+    def __init__(self, n_shards:int=None, datetime=None, snapshot_depth:int=10):
+        """_summary_
+
+        Args:
+            n_shards (int, optional): the number of worker processes. Defaults to None (the number of CPUs).
+            datetime (datetime, optional): the initial datetime of the exchange. Defaults to None.
+            snapshot_depth (int, optional): the number of price levels of each side of the book that are sent back after each step. Defaults to 10.
+        """
+        Exchange.__init__(self, datetime)
+        self.n_shards = n_shards or mp.cpu_count()
+        self._shard_of: Dict[str, int] = {}
+        # ticker of every order that may still be resting, to route cancels and amendments
+        self._order_tickers: Dict[int, str] = {}
+        self._pending: List[dict] = []
+        # (position in _pending of the first instruction, number of instructions, result, whether it is a list) of each DeferredResult
+        self._deferred: List[tuple] = []
+        self._connections = []
+        self._processes = []
+        for shard in range(self.n_shards):
+            parent_conn, child_conn = mp.Pipe()
+            process = mp.Process(target=_run_shard, args=(child_conn, shard, self.n_shards, snapshot_depth), daemon=True)
+            process.start()
+            child_conn.close()
+            self._connections.append(parent_conn)
+            self._processes.append(process)
+
+    def __repr__(self):
+        return f'<ShardedExchange: {self.n_shards} shards>'
+
+    def create_asset(self, ticker: str, seed_price=100, seed_bid=.99, seed_ask=1.01, tick_size=0.01):
+        shard = len(self._shard_of) % self.n_shards
+        self._shard_of[ticker] = shard
+        self.books[ticker] = OrderBook(ticker, tick_size)
+        self._apply(shard, self._call(shard, 'setup_asset', self.datetime, ticker, seed_price, seed_bid, seed_ask, tick_size))
+
+    def limit_buy(self, ticker: str, price: float, qty: int, creator: str):
+        return self._queue_limit(ticker, price, qty, creator, OrderSide.BUY)
+
+    def limit_sell(self, ticker: str, price: float, qty: int, creator: str):
+        return self._queue_limit(ticker, price, qty, creator, OrderSide.SELL)
+
+    def market_buy(self, ticker: str, qty: int, buyer: str):
+        self._pending.append({'type': 'market_buy', 'ticker': ticker, 'qty': qty, 'creator': buyer})
+
+    def market_sell(self, ticker: str, qty: int, seller: str):
+        self._pending.append({'type': 'market_sell', 'ticker': ticker, 'qty': qty, 'creator': seller})
+
+    def cancel_order(self, id:int) -> DeferredResult:
+        """Queues the cancellation of an order.
+
+        Returns:
+            DeferredResult: the cancelled order (or None), once the step is flushed.
+        """
+        return self._defer([{'type': 'cancel', 'id': id}], False)
+
+    def amend_order(self, id:int, price:float=None, qty:int=None) -> DeferredResult:
+        """Queues the amendment of an order. An order that replaces the amended one gets an id assigned here, like queued limit orders.
+
+        Returns:
+            DeferredResult: the amended (or replacing) order (or None), once the step is flushed.
+        """
+        return self._defer([self._amend_instruction({'type': 'amend', 'id': id, 'price': price, 'qty': qty})], False)
+
+    def cancel_all_orders(self, agent, ticker):
+        self._pending.append({'type': 'cancel_all', 'ticker': ticker, 'creator': agent})
+
+    def submit_batch(self, orders: List[dict]) -> DeferredResult:
+        """Queues many instructions at once.
+
+        Raises:
+            ValueError: if an instruction is invalid (see Exchange.submit_batch). Nothing is queued in that case.
+
+        Returns:
+            DeferredResult: the results of the instructions (as returned by Exchange.submit_batch), once the step is flushed.
+        """
+        for idx, order in enumerate(orders):
+            self._check_instruction(idx, order)
+        instructions = []
+        for order in orders:
+            if order['type'] in ('limit_buy', 'limit_sell'):
+                instructions.append(self._limit_instruction(order['ticker'], order['price'], order['qty'], order['creator'], order['type'])[1])
+            elif order['type'] == 'amend':
+                instructions.append(self._amend_instruction(dict(order)))
+            else:
+                instructions.append(order)
+        return self._defer(instructions, True)
+
+    def get_order(self, id:int) -> Union[LimitOrder,None]:
+        ticker = self._order_tickers.get(id)
+        if ticker is None:
+            return None
+        return self._call(self._shard_of[ticker], 'get_order', id)
+
+    def get_open_orders(self, agent:str, ticker:str) -> List[LimitOrder]:
+        return self._call(self._shard_of[ticker], 'get_open_orders', agent, ticker)
+
+    def get_full_order_book(self, ticker:str) -> OrderBook:
+        """Returns a copy of the complete OrderBook of an asset, as of the end of the last flushed step.
+        """
+        return self._call(self._shard_of[ticker], 'get_order_book', ticker)
+
+    def flush(self):
+        """Sends the queued instructions to the workers, which match them in parallel, and records the resulting trades.
+        """
+        if not self._pending:
+            return
+        batches = [[] for _ in range(self.n_shards)]
+        # (shard, position in its batch) of every instruction, None for the ones that refer to unknown orders
+        routes = []
+        for instruction in self._pending:
+            if 'ticker' in instruction:
+                ticker = instruction['ticker']
+            else:
+                ticker = self._order_tickers.get(instruction['id'])
+                if ticker is None:
+                    routes.append(None)
+                    continue
+            batch = batches[self._shard_of[ticker]]
+            routes.append((self._shard_of[ticker], len(batch)))
+            batch.append(instruction)
+        deferred = self._deferred
+        self._pending, self._deferred = [], []
+        wanted = [[] for _ in range(self.n_shards)]
+        for start, n, _, _ in deferred:
+            for route in routes[start:start + n]:
+                if route is not None:
+                    wanted[route[0]].append(route[1])
+        shards = [shard for shard, batch in enumerate(batches) if batch]
+        for shard in shards:
+            self._connections[shard].send(('run_batch', (self.datetime, batches[shard], wanted[shard])))
+        results = {}
+        for shard in shards:
+            collected, shard_results = self._receive(shard)
+            self._apply(shard, collected)
+            results.update(((shard, idx), result) for idx, result in zip(wanted[shard], shard_results))
+        for start, n, result, many in deferred:
+            values = [results[route] if route is not None else {'order': None, 'fills': []} for route in routes[start:start + n]]
+            result._set(values if many else values[0]['order'])
+
+    def close(self):
+        """Stops the worker processes.
+        """
+        for conn, process in zip(self._connections, self._processes):
+            if process.is_alive():
+                conn.send((None, None))
+                process.join()
+        self._connections, self._processes = [], []
+
+    def _queue_limit(self, ticker, price, qty, creator, side):
+        order, instruction = self._limit_instruction(ticker, price, qty, creator, 'limit_buy' if side == OrderSide.BUY else 'limit_sell')
+        self._pending.append(instruction)
+        return order
+
+    def _limit_instruction(self, ticker, price, qty, creator, kind):
+        book = self.books[ticker]
+        ticks = book.to_ticks(price)
+        side = OrderSide.BUY if kind == 'limit_buy' else OrderSide.SELL
+        order = LimitOrder(ticker, book.to_price(ticks), qty, creator, side, self.datetime, next(self._order_ids), ticks)
+        self._order_tickers[order.id] = ticker
+        return order, {'type': kind, 'ticker': ticker, 'price': order.price, 'qty': qty, 'creator': creator, 'id': order.id}
+
+    def _amend_instruction(self, instruction:dict) -> dict:
+        # reserves the id of the order that may replace the amended one
+        instruction['new_id'] = next(self._order_ids)
+        ticker = self._order_tickers.get(instruction['id'])
+        if ticker is not None:
+            self._order_tickers[instruction['new_id']] = ticker
+        return instruction
+
+    def _defer(self, instructions:List[dict], many:bool) -> DeferredResult:
+        result = DeferredResult()
+        self._deferred.append((len(self._pending), len(instructions), result, many))
+        self._pending.extend(instructions)
+        return result
+
+    def _apply(self, shard, result):
+        trades, removed, snapshots = result
+        for trade in trades:
+            self._process_trade(*trade)
+        for id in removed:
+            self._order_tickers.pop(id, None)
+        for ticker, (bids, asks) in snapshots.items():
+            book = OrderBook(ticker, self.books[ticker].tick_size)
+            for order in bids + asks:
+                book.get_side(order.type).insert(order)
+                if order.id < 0:
+                    self._order_tickers[order.id] = ticker
+            self.books[ticker] = book
+
+    def _call(self, shard, method, *args):
+        self._connections[shard].send((method, args))
+        return self._receive(shard)
+
+    def _receive(self, shard):
+        ok, result = self._connections[shard].recv()
+        if not ok:
+            raise result
+        return result
@@ -0,0 +1,90 @@
+from itertools import product
+import multiprocessing as mp
+from typing import Callable, Dict, Iterator, List, Tuple, Union
+import pandas as pd
+
+
+def get_parameter_grid(grid:Union[Dict[str, list], List[dict]]) -> List[dict]:
+    """Expands a dictionary of parameter values into the list of all their combinations. A list of dictionaries is returned as is.
+
+    Example:
+        get_parameter_grid({'prob_buy': [.1, .2], 'seed': [1, 2]}) returns 4 dictionaries.
+    """
+    if isinstance(grid, dict):
+        keys = list(grid)
+        return [dict(zip(keys, values)) for values in product(*(grid[k] for k in keys))]
+    return list(grid)
+
+
+def summarize(sim) -> dict:
+    """Default metrics of a finished simulation: the number of trades, the last price of each asset and the final aum,
+    cash and realized PnL of each agent.
+    """
+    exchange = sim.exchange
+    prices = {ticker: exchange.get_latest_trade(ticker).price for ticker in exchange.books}
+    metrics = {'n_trades': len(exchange.trade_log)}
+    for ticker, price in prices.items():
+        metrics[f'{ticker}_close'] = price
+    for agent in sim.agents:
+        holdings = sum(qty * prices[ticker] for ticker, qty in agent.ledger.positions.items())
+        metrics[f'{agent.name}_aum'] = agent.cash + holdings
+        metrics[f'{agent.name}_cash'] = agent.cash
+        metrics[f'{agent.name}_realized_pnl'] = agent.get_realized_pnl()
+    return metrics
+
+
+def _run_simulation(payload):
+    run, factory, params, metrics, bar_size = payload
+    sim = factory(**params)
+    try:
+        sim.run()
+        summary = metrics(sim)
+        bars = None
+        if bar_size is not None:
+            bars = {ticker: sim.get_price_bars(ticker, bar_size) for ticker in sim.exchange.books}
+    finally:
+        sim.close()
+    return run, params, summary, bars
+
+
+def iter_sweep(factory:Callable, grid:Union[Dict[str, list], List[dict]], metrics:Callable=summarize, bar_size:str=None,
+               processes:int=None) -> Iterator[Tuple[int, dict, dict, Dict[str, pd.DataFrame]]]:
+    """Runs one simulation per combination of parameters in a process pool, yielding the results as soon as each run finishes.
+
+    Only the metrics (and the price bars, if requested) are sent back from the workers, never the trade logs or the agents,
+    so the memory of the parent does not grow with the size of the simulations.
+
+    Args:
+        factory (Callable): a picklable (module level) function that takes the parameters as keyword arguments and returns a Simulator ready to run.
+        grid (Union[Dict[str, list], List[dict]]): the values of each parameter, or an explicit list of parameter dictionaries.
+        metrics (Callable, optional): a picklable function that takes the finished Simulator and returns a dictionary of metrics. Defaults to summarize.
+        bar_size (str, optional): if set, the OHLCV bars of every asset at this bar size are sent back as well. Defaults to None.
+        processes (int, optional): the number of worker processes. Defaults to None (the number of CPUs).
+
+    Yields:
+        Tuple[int, dict, dict, Dict[str, pd.DataFrame]]: the run number, its parameters, its metrics and its bars by ticker (None if no bar_size).
+    """
+    payloads = [(run, factory, params, metrics, bar_size) for run, params in enumerate(get_parameter_grid(grid))]
+    with mp.Pool(processes) as pool:
+        yield from pool.imap_unordered(_run_simulation, payloads)
+
+
+def run_sweep(factory:Callable, grid:Union[Dict[str, list], List[dict]], metrics:Callable=summarize, bar_size:str=None,
+              processes:int=None) -> Union[pd.DataFrame, Tuple[pd.DataFrame, pd.DataFrame]]:
+    """Runs one simulation per combination of parameters in a process pool and combines their metrics. See iter_sweep.
+
+    Returns:
+        Union[pd.DataFrame, Tuple[pd.DataFrame, pd.DataFrame]]: a dataframe indexed by run number with the parameters and metrics
+        of each run. If bar_size is set, also a dataframe of the bars indexed by (run, ticker, dt).
+    """
+    rows, bars = {}, {}
+    for run, params, summary, run_bars in iter_sweep(factory, grid, metrics, bar_size, processes):
+        rows[run] = {**params, **summary}
+        if run_bars is not None:
+            for ticker, df in run_bars.items():
+                bars[(run, ticker)] = df
+    results = pd.DataFrame.from_dict(rows, orient='index').sort_index().rename_axis('run')
+    if bar_size is None:
+        return results
+    bars = pd.concat(bars, names=['run', 'ticker']).sort_index(level=['run', 'ticker'], sort_remaining=False) if bars else pd.DataFrame()
+    return results, bars
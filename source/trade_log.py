@@ -0,0 +1,323 @@
+from bisect import bisect_right
+from datetime import datetime
+from typing import Dict, Iterator, List, Union
+import numpy as np
+import pandas as pd
+
+
+class Trade():
+    __slots__ = ('ticker', 'qty', 'price', 'buyer', 'seller', 'dt')
+
+    def __init__(self, ticker, qty, price, buyer, seller, dt=None):
+        self.ticker = ticker
+        self.qty = qty
+        self.price = price
+        self.buyer = buyer
+        self.seller = seller
+        self.dt = dt if dt else datetime.now()
+
+    def __repr__(self):
+        return f'<Trade: {self.ticker} {self.qty}@{self.price} {self.dt}>'
+
+    def to_dict(self):
+        return {
+            'dt': self.dt,
+            'ticker': self.ticker,
+            'qty': self.qty,
+            'price': self.price,
+            'buyer': self.buyer,
+            'seller': self.seller
+        }
+
+
+class TradeLog():
+    """Append-only, columnar store of all the trades printed by an Exchange.
+
+    Every field is kept in a NumPy array that grows geometrically, and tickers and agent names are interned as integer codes.
+    The positions of the trades of each ticker are indexed as well, so per-ticker queries never scan the whole log.
+    Trade objects are only created when a single trade is requested.
+
+    With a sink attached (see ArrowSink), full chunks of trades are written to files by spill() and dropped from memory. Positions
+    in the log keep counting the written trades, and queries over the whole log read them back. The last rows read back are kept
+    until the next spill, so repeated queries of the same asset only read the files once.
+    """
+    def __init__(self, capacity:int=1024):
+        """_summary_
+
+        Args:
+            capacity (int, optional): number of trades preallocated. The arrays double in size whenever they are full. Defaults to 1024.
+        """
+        self._size = 0
+        self._dt = np.empty(capacity, dtype='datetime64[ns]')
+        self._price = np.empty(capacity, dtype=np.float64)
+        self._qty = np.empty(capacity, dtype=np.int64)
+        self._ticker = np.empty(capacity, dtype=np.int32)
+        self._buyer = np.empty(capacity, dtype=np.int32)
+        self._seller = np.empty(capacity, dtype=np.int32)
+        self._tickers: List[str] = []
+        self._ticker_codes: Dict[str, int] = {}
+        self._agents: List[str] = []
+        self._agent_codes: Dict[str, int] = {}
+        # row numbers of the trades of each ticker code, and how many of them are in use
+        self._ticker_rows: List[np.ndarray] = []
+        self._ticker_sizes: List[int] = []
+        # latest Trade of each ticker code, built on request and dropped when the ticker trades again
+        self._last_trades: Dict[int, Trade] = {}
+        # trades of the same simulation step share their timestamp, so the last conversion is reused
+        self._last_dt = None
+        self._last_dt64 = None
+        # number of trades written to the sink, which are no longer held in memory, and the position of the first trade of each file
+        self._offset = 0
+        self._file_offsets: List[int] = []
+        self._sink = None
+        # last rows read back from the sink: (offset, ticker or file, columns)
+        self._written = None
+
+    def __repr__(self):
+        return f'<TradeLog: {len(self)} trades>'
+
+    def __getstate__(self):
+        # only the used part of the preallocated arrays is stored
+        state = self.__dict__.copy()
+        for name in ('_dt', '_price', '_qty', '_ticker', '_buyer', '_seller'):
+            state[name] = state[name][:self._size].copy()
+        state['_written'] = None
+        state['_ticker_rows'] = [rows[:max(size, 64)].copy() for rows, size in zip(self._ticker_rows, self._ticker_sizes)]
+        return state
+
+    def __len__(self):
+        return self._offset + self._size
+
+    def __getitem__(self, idx:int) -> Trade:
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError('TradeLog index out of range')
+        if idx < self._offset:
+            # only the file that holds the trade is read
+            file = bisect_right(self._file_offsets, idx) - 1
+            return self._build_trade(self._read_written(('file', file), file=file), idx - self._file_offsets[file])
+        return self._build_trade(self._memory_columns(), idx - self._offset)
+
+    def __iter__(self) -> Iterator[Trade]:
+        columns = self.columns()
+        for idx in range(len(self)):
+            yield self._build_trade(columns, idx)
+
+    @property
+    def tickers(self) -> List[str]:
+        """All tickers that have printed at least one trade, in order of appearance.
+        """
+        return list(self._tickers)
+
+    def append(self, ticker:str, qty:int, price:float, buyer:str, seller:str, dt:datetime=None):
+        """Records a new trade at the end of the log.
+        """
+        idx = self._size
+        if idx == len(self._price):
+            self._grow()
+        if dt is None:
+            dt = datetime.now()
+        if dt is not self._last_dt:
+            self._last_dt = dt
+            self._last_dt64 = np.datetime64(dt, 'ns')
+        self._dt[idx] = self._last_dt64
+        self._price[idx] = price
+        self._qty[idx] = qty
+        code = self._intern_ticker(ticker)
+        self._ticker[idx] = code
+        n = self._ticker_sizes[code]
+        if n == len(self._ticker_rows[code]):
+            self._ticker_rows[code] = np.concatenate([self._ticker_rows[code], np.empty(n, dtype=np.int64)])
+        self._ticker_rows[code][n] = idx
+        self._ticker_sizes[code] = n + 1
+        self._last_trades.pop(code, None)
+        self._buyer[idx] = self._intern_agent(buyer)
+        self._seller[idx] = self._intern_agent(seller)
+        self._size = idx + 1
+
+    def extend(self, ticker:str, qty:np.ndarray, price:np.ndarray, buyer:str, seller:str, dt:datetime):
+        """Records many trades of an asset between the same buyer and seller, all at the same datetime, at the end of the log.
+        """
+        n = len(qty)
+        if not n:
+            return
+        start = self._size
+        while start + n > len(self._price):
+            self._grow()
+        if dt is not self._last_dt:
+            self._last_dt = dt
+            self._last_dt64 = np.datetime64(dt, 'ns')
+        end = start + n
+        self._dt[start:end] = self._last_dt64
+        self._price[start:end] = price
+        self._qty[start:end] = qty
+        code = self._intern_ticker(ticker)
+        self._ticker[start:end] = code
+        size = self._ticker_sizes[code]
+        rows = self._ticker_rows[code]
+        if size + n > len(rows):
+            rows = self._ticker_rows[code] = np.concatenate([rows, np.empty(max(size, n), dtype=np.int64)])
+        rows[size:size + n] = np.arange(start, end)
+        self._ticker_sizes[code] = size + n
+        self._last_trades.pop(code, None)
+        self._buyer[start:end] = self._intern_agent(buyer)
+        self._seller[start:end] = self._intern_agent(seller)
+        self._size = end
+
+    def columns(self, ticker:str=None) -> Dict[str, np.ndarray]:
+        """Returns the raw columns of the log. Without a ticker, and as long as nothing was spilled to a sink, the arrays are views over the underlying storage and must not be modified.
+
+        Args:
+            ticker (str, optional): only return the trades of this asset. Defaults to None (all trades).
+
+        Returns:
+            Dict[str, np.ndarray]: arrays for dt, price, qty and the ticker, buyer and seller codes.
+        """
+        columns = self._memory_columns()
+        if ticker is not None:
+            rows = self.rows(ticker)
+            columns = {k: v[rows] for k, v in columns.items()}
+        if self._offset and (ticker is None or ticker in self._ticker_codes):
+            # trades written to the sink are read back (only those of the ticker) and put in front of the ones in memory
+            written = self._read_written(('ticker', ticker), where=None if ticker is None else ('ticker', ticker))
+            columns = {k: np.concatenate([written[k].astype(v.dtype), v]) for k, v in columns.items()}
+        return columns
+
+    def traded_since(self, start:int) -> List[str]:
+        """Returns the tickers of the trades recorded from position start onwards.
+        """
+        return [self._tickers[code] for code in np.unique(self._ticker[max(start - self._offset, 0):self._size])]
+
+    def attach_sink(self, sink):
+        """Sets the ArrowSink that the trades are written to by spill().
+        """
+        self._sink = sink
+
+    def spill(self, force:bool=False):
+        """Writes the trades held in memory to the sink and drops them, once there are at least chunk_size of them (or any, if forced).
+        """
+        n = self._size
+        if self._sink is None or not n or (n < self._sink.chunk_size and not force):
+            return
+        # the latest trade of each ticker stays available without reading the files
+        memory = self._memory_columns()
+        for code, size in enumerate(self._ticker_sizes):
+            if size and code not in self._last_trades:
+                self._last_trades[code] = self._build_trade(memory, int(self._ticker_rows[code][size - 1]))
+        self._sink.write(
+            'trades',
+            {'dt': self._dt[:n], 'ticker': self._ticker[:n], 'qty': self._qty[:n], 'price': self._price[:n], 'buyer': self._buyer[:n], 'seller': self._seller[:n]},
+            dictionaries={'ticker': self._tickers, 'buyer': self._agents, 'seller': self._agents},
+        )
+        self._file_offsets.append(self._offset)
+        self._offset += n
+        self._size = 0
+        self._ticker_sizes = [0] * len(self._ticker_sizes)
+
+    def rows(self, ticker:str) -> np.ndarray:
+        """Returns the positions in memory of the trades of a given asset that were not written to a sink, in chronological order. The array is a view and must not be modified.
+        """
+        code = self._ticker_codes.get(ticker)
+        if code is None:
+            return np.empty(0, dtype=np.int64)
+        return self._ticker_rows[code][:self._ticker_sizes[code]]
+
+    def to_frame(self, ticker:str=None, agent:str=None, categorical:bool=False) -> pd.DataFrame:
+        """Returns the trades as a dataframe indexed by datetime.
+
+        Args:
+            ticker (str, optional): only return the trades of this asset. Defaults to None (all trades).
+            agent (str, optional): only return the trades where this agent is the buyer or the seller. Defaults to None (all trades).
+            categorical (bool, optional): whether tickers and agent names are categorical columns built on top of the stored codes,
+                which is faster and smaller than decoding them into object columns. Defaults to False.
+
+        Returns:
+            pd.DataFrame: a dataframe with the columns ticker, qty, price, buyer and seller.
+        """
+        columns = self.columns(ticker)
+        if agent is not None:
+            code = self._agent_codes.get(agent, -1)
+            mask = (columns['buyer'] == code) | (columns['seller'] == code)
+            columns = {k: v[mask] for k, v in columns.items()}
+        if categorical:
+            decode = pd.Categorical.from_codes
+        else:
+            def decode(codes, categories):
+                return np.array(categories, dtype=object)[codes] if len(categories) else np.empty(len(codes), dtype=object)
+        return pd.DataFrame(
+            {
+                'ticker': decode(columns['ticker'], self._tickers),
+                'qty': columns['qty'],
+                'price': columns['price'],
+                'buyer': decode(columns['buyer'], self._agents),
+                'seller': decode(columns['seller'], self._agents),
+            },
+            index=pd.DatetimeIndex(columns['dt'], name='dt'),
+            copy=False,
+        )
+
+    def last(self, ticker:str) -> Union[Trade, None]:
+        """Returns the most recent trade of a given asset, if any.
+        """
+        code = self._ticker_codes.get(ticker)
+        if code is None:
+            return None
+        trade = self._last_trades.get(code)
+        if trade is None:
+            trade = self._build_trade(self._memory_columns(), int(self._ticker_rows[code][self._ticker_sizes[code] - 1]))
+            self._last_trades[code] = trade
+        return trade
+
+    def _read_written(self, key:tuple, **kwargs) -> Dict[str, np.ndarray]:
+        # reads rows back from the sink, reusing the last read while nothing new was written
+        if self._written is not None and self._written[0] == self._offset and self._written[1] == key:
+            return self._written[2]
+        written = self._sink.read('trades', codes={'ticker': self._ticker_codes, 'buyer': self._agent_codes, 'seller': self._agent_codes}, **kwargs)
+        self._written = (self._offset, key, written)
+        return written
+
+    def _memory_columns(self) -> Dict[str, np.ndarray]:
+        n = self._size
+        return {
+            'dt': self._dt[:n],
+            'price': self._price[:n],
+            'qty': self._qty[:n],
+            'ticker': self._ticker[:n],
+            'buyer': self._buyer[:n],
+            'seller': self._seller[:n],
+        }
+
+    def _build_trade(self, columns:Dict[str, np.ndarray], idx:int) -> Trade:
+        return Trade(
+            self._tickers[columns['ticker'][idx]],
+            int(columns['qty'][idx]),
+            float(columns['price'][idx]),
+            self._agents[columns['buyer'][idx]],
+            self._agents[columns['seller'][idx]],
+            pd.Timestamp(columns['dt'][idx]),
+        )
+
+    def _grow(self):
+        capacity = max(2 * len(self._price), 1)
+        for name in ('_dt', '_price', '_qty', '_ticker', '_buyer', '_seller'):
+            old = getattr(self, name)
+            new = np.empty(capacity, dtype=old.dtype)
+            new[:self._size] = old[:self._size]
+            setattr(self, name, new)
+
+    def _intern_ticker(self, ticker):
+        code = self._ticker_codes.get(ticker)
+        if code is None:
+            code = self._ticker_codes[ticker] = len(self._tickers)
+            self._tickers.append(ticker)
+            self._ticker_rows.append(np.empty(64, dtype=np.int64))
+            self._ticker_sizes.append(0)
+        return code
+
+    def _intern_agent(self, agent):
+        code = self._agent_codes.get(agent)
+        if code is None:
+            code = self._agent_codes[agent] = len(self._agents)
+            self._agents.append(agent)
+        return code
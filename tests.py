@@ -1,9 +1,75 @@
+import random
+import tempfile
 import unittest
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
 from source.qmr_exchange import Simulator, Exchange, Agent
+from source.agents import NaiveMarketMaker, RandomMarketTaker, RandomMarketTakerPopulation
+from source._utils import get_datetime_range
+from source.sweep import run_sweep
+from source.sharding import ShardedExchange
+from source.persistence import ArrowSink, pa
+from source.replay import ReplayAgent, TickFile
+from benchmarks import compare, run_benchmarks
 
 
 
 
+class CyclicTaker(Agent):
+    """Buys one unit per step until it holds max_position, then sells everything."""
+    def __init__(self, name, tickers, aum=10_000, max_position=3):
+        Agent.__init__(self, name, tickers, aum)
+        self.max_position = max_position
+        self.steps = 0
+
+    def decide(self, snapshot):
+        self.steps += 1
+        orders = []
+        for ticker in self.tickers:
+            if snapshot.get_position(ticker) < self.max_position:
+                orders.append({'type': 'market_buy', 'ticker': ticker, 'qty': 1})
+            else:
+                orders.append({'type': 'market_sell', 'ticker': ticker, 'qty': snapshot.get_position(ticker)})
+        return orders
+
+
+class SleepyTaker(Agent):
+    """Buys one unit every ten minutes."""
+    wake_every_step = False
+
+    def __init__(self, name, tickers, aum=10_000):
+        Agent.__init__(self, name, tickers, aum)
+        self.wakes = []
+
+    def next(self):
+        self.wakes.append(self.exchange.datetime)
+        self.market_buy(self.tickers[0], 1)
+        self.wake_in(timedelta(minutes=10))
+
+
+class TradeWatcher(Agent):
+    """Only acts after the trades of its tickers."""
+    wake_every_step = False
+
+    def __init__(self, name, tickers, aum=10_000):
+        Agent.__init__(self, name, tickers, aum)
+        self.wakes = []
+        for ticker in tickers:
+            self.wake_on_trade(ticker)
+
+    def next(self):
+        self.wakes.append(self.exchange.datetime)
+
+
+def build_sweep_simulator(max_position, seed):
+    sim = Simulator(datetime(2022, 1, 1), datetime(2022, 1, 1, 1), 'minute', seed=seed)
+    sim.exchange.create_asset('XYZ')
+    sim.add_agent(NaiveMarketMaker(name='market_maker', tickers=['XYZ'], aum=1_000, spread_pct=0.005, qty_per_order=4))
+    sim.add_agent(CyclicTaker(name='taker', tickers=['XYZ'], max_position=max_position))
+    return sim
+
+
 class TestAgent(unittest.TestCase):
     def setUp(self):
         pass
@@ -11,24 +77,663 @@ class TestAgent(unittest.TestCase):
     def test_agent(self):
         pass
 
+    def test_ledger(self):
+        agent = Agent('a', ['XYZ'], aum=1_000)
+        agent.ledger.record(datetime(2022, 1, 1), 'XYZ', 2, -200)
+        agent.ledger.record(datetime(2022, 1, 2), 'XYZ', 2, -220)
+        self.assertEqual(agent.get_position('XYZ'), 4)
+        self.assertAlmostEqual(agent.get_avg_cost('XYZ'), 105)
+        agent.ledger.record(datetime(2022, 1, 3), 'XYZ', -5, 600)
+        self.assertEqual(agent.get_position('XYZ'), -1)
+        self.assertAlmostEqual(agent.get_realized_pnl('XYZ'), 60)
+        self.assertAlmostEqual(agent.get_avg_cost('XYZ'), 120)
+        self.assertAlmostEqual(agent.cash, 1_180)
+        self.assertEqual(len(agent._transactions), 3)
+        self.assertEqual(list(agent.get_cash_history()['cash']), [800, 580, 1_180])
+
     def test_naivemarketmaker(self):
         pass
 
     def test_randommarkettaker(self):
-        pass
+        seed_function = random.seed
+        agents = [RandomMarketTaker('taker', ['XYZ', 'ABC'], seed=42) for _ in range(2)]
+        self.assertIs(random.seed, seed_function)
+        self.assertEqual(agents[0].rng.random(5).tolist(), agents[1].rng.random(5).tolist())
 
 class TestSimulator(unittest.TestCase):
     def setUp(self):
-        pass
+        self.sim = Simulator(datetime(2022, 1, 1), datetime(2022, 1, 1, 3), 'minute')
+        self.sim.exchange.create_asset('XYZ')
+        self.sim.exchange.create_asset('ABC')
+        self.sim.add_agent(NaiveMarketMaker(name='market_maker', tickers=['XYZ', 'ABC'], aum=1_000, spread_pct=0.005, qty_per_order=4))
+        self.sim.add_agent(RandomMarketTaker(name='market_taker', tickers=['XYZ', 'ABC'], aum=1_000, prob_buy=.2, prob_sell=.2, qty_per_order=1))
+
+    def test_clock(self):
+        clock = get_datetime_range(datetime(2022, 1, 1), datetime(2022, 1, 1, 0, 10, 30), 'minute')
+        self.assertEqual(len(clock), 11)
+        self.assertEqual(list(clock), list(clock.to_index()))
+        self.assertEqual(clock[-1], datetime(2022, 1, 1, 0, 10))
+        self.assertEqual(clock.index_of(datetime(2022, 1, 1, 0, 3, 59)), 3)
+        self.assertEqual(clock.index_of(datetime(2021, 1, 1)), -1)
+
+    def test_seed(self):
+        def build(seed):
+            sim = Simulator(datetime(2022, 1, 1), datetime(2022, 1, 1, 1), 'minute', seed=seed)
+            sim.exchange.create_asset('XYZ')
+            sim.add_agent(NaiveMarketMaker(name='market_maker', tickers=['XYZ'], aum=1_000, spread_pct=0.005, qty_per_order=4))
+            for i in range(3):
+                sim.add_agent(RandomMarketTaker(name=f'taker_{i}', tickers=['XYZ'], aum=1_000, prob_buy=.3, prob_sell=.3))
+            # draws from the global generator must not change the run
+            random.random()
+            sim.run()
+            return sim.get_portfolio_histories()
+        first, second, other = build(1), build(1), build(2)
+        pd.testing.assert_frame_equal(first, second)
+        self.assertFalse(first.equals(other))
+        # each agent has its own stream
+        self.assertFalse(first['taker_0'].equals(first['taker_1']))
+
+    def test_population(self):
+        crowd = RandomMarketTakerPopulation('crowd', ['XYZ', 'ABC'], 500, aum=100, prob_buy=.05, prob_sell=.05)
+        self.sim.add_agent(crowd)
+        self.sim.run()
+        self.assertEqual(crowd.member_positions.sum(axis=0).tolist(), [crowd.get_position('XYZ'), crowd.get_position('ABC')])
+        self.assertTrue((crowd.member_positions >= 0).all())
+        self.assertAlmostEqual(crowd.member_cash.sum(), crowd.cash)
+        fills = crowd.get_member_fills()
+        self.assertEqual(fills.groupby('member')['qty'].sum().sum(), crowd.member_positions.sum())
+        portfolios = crowd.get_member_portfolios()
+        self.assertEqual(len(portfolios), 500)
+        pd.testing.assert_series_equal(portfolios['aum'], portfolios[['XYZ', 'ABC', 'cash']].sum(axis=1), check_names=False)
+
+    def test_event_driven_clock(self):
+        sim = Simulator(datetime(2022, 1, 1), datetime(2022, 1, 1, 1), 'second')
+        sim.exchange.create_asset('XYZ')
+        sim.add_agent(SleepyTaker('sleepy', ['XYZ']))
+        sim.add_agent(TradeWatcher('watcher', ['XYZ']))
+        steps = 0
+        while sim.next():
+            steps += 1
+        start = datetime(2022, 1, 1, 0, 0, 1)
+        self.assertEqual(sim.get_agent('sleepy').wakes, [start + timedelta(minutes=10 * i) for i in range(6)])
+        # only the first purchase finds the seed ask
+        self.assertEqual(sim.get_agent('watcher').wakes, [start, start + timedelta(seconds=1)])
+        self.assertEqual(steps, 7)
+
+    @unittest.skipIf(pa is None, 'pyarrow is not installed')
+    def test_sink(self):
+        def build(sink):
+            sim = Simulator(datetime(2022, 1, 1), datetime(2022, 1, 1, 3), 'minute', seed=5, sink=sink)
+            sim.exchange.create_asset('XYZ')
+            sim.exchange.create_asset('ABC')
+            sim.add_agent(NaiveMarketMaker(name='market_maker', tickers=['XYZ', 'ABC'], aum=1_000, spread_pct=0.005, qty_per_order=4))
+            sim.add_agent(RandomMarketTaker(name='market_taker', tickers=['XYZ', 'ABC'], aum=1_000, prob_buy=.3, prob_sell=.3))
+            sim.run()
+            return sim
+        memory = build(None)
+        for format in ArrowSink.FORMATS:
+            with tempfile.TemporaryDirectory() as path:
+                persisted = build(ArrowSink(path, format, chunk_size=20))
+                trade_log = persisted.exchange.trade_log
+                self.assertEqual(len(trade_log), len(memory.exchange.trade_log))
+                self.assertLess(trade_log._size, 20)
+                self.assertGreater(len(persisted.sink.files('trades')), 1)
+                for ticker in ('XYZ', 'ABC'):
+                    pd.testing.assert_frame_equal(persisted.exchange.get_trades(ticker), memory.exchange.get_trades(ticker))
+                pd.testing.assert_frame_equal(persisted.exchange.trades, memory.exchange.trades)
+                # frames read back from the files are cached like the others, and the files are only read again after a spill
+                self.assertIs(persisted.exchange.get_trades('XYZ'), persisted.exchange.get_trades('XYZ'))
+                reads = []
+                read = persisted.sink.read
+                persisted.sink.read = lambda *args, **kwargs: reads.append(kwargs) or read(*args, **kwargs)
+                for _ in range(2):
+                    trade_log.columns('ABC')
+                self.assertEqual(len(reads), 1)
+                # a single trade is read from the one file that holds it
+                self.assertEqual(trade_log[25].to_dict(), memory.exchange.trade_log[25].to_dict())
+                self.assertEqual(reads[-1]['file'], 1)
+                del persisted.sink.read
+                written = persisted.sink.read('trades', where=('ticker', 'ABC'))
+                self.assertEqual(set(written['ticker']), {'ABC'})
+                pd.testing.assert_frame_equal(persisted.exchange.get_price_bars('XYZ', '15min'), memory.exchange.get_price_bars('XYZ', '15min'))
+                pd.testing.assert_frame_equal(persisted.get_portfolio_histories(), memory.get_portfolio_histories())
+                for agent in memory.agents:
+                    pd.testing.assert_frame_equal(persisted.get_agent(agent.name).ledger.to_frame(), agent.ledger.to_frame())
+
+    def test_checkpoint(self):
+        self.sim.add_agent(RandomMarketTakerPopulation('crowd', ['XYZ', 'ABC'], 50, aum=100, prob_buy=.05, prob_sell=.05))
+        for _ in range(60):
+            self.sim.next()
+        with tempfile.TemporaryDirectory() as path:
+            self.sim.checkpoint(f'{path}/checkpoint')
+            forks = [Simulator.restore(f'{path}/checkpoint') for _ in range(2)]
+        self.assertEqual(forks[0].dt, self.sim.dt)
+        self.assertIsNot(forks[0].exchange, forks[1].exchange)
+        self.assertIs(forks[0].get_agent('market_maker').exchange, forks[0].exchange)
+        self.sim.run()
+        for fork in forks:
+            fork.run()
+            pd.testing.assert_frame_equal(fork.get_portfolio_histories(), self.sim.get_portfolio_histories())
+            pd.testing.assert_frame_equal(fork.exchange.trades, self.sim.exchange.trades)
+            pd.testing.assert_frame_equal(fork.get_agent('crowd').get_member_fills(), self.sim.get_agent('crowd').get_member_fills())
+            for ticker in ['XYZ', 'ABC']:
+                for side in ['bids', 'asks']:
+                    self.assertEqual([o.to_dict() for o in getattr(fork.exchange.books[ticker], side)],
+                                     [o.to_dict() for o in getattr(self.sim.exchange.books[ticker], side)])
+                self.assertEqual([o.to_dict() for o in fork.exchange.get_open_orders('market_maker', ticker)],
+                                 [o.to_dict() for o in self.sim.exchange.get_open_orders('market_maker', ticker)])
+
+    def test_checkpoint_resume(self):
+        def build():
+            sim = Simulator(datetime(2022, 1, 1), datetime(2022, 1, 1, 2), 'minute', seed=11)
+            sim.exchange.create_asset('XYZ')
+            sim.add_agent(NaiveMarketMaker(name='market_maker', tickers=['XYZ'], aum=1_000, spread_pct=0.005, qty_per_order=4))
+            sim.add_agent(RandomMarketTaker(name='market_taker', tickers=['XYZ'], aum=1_000, prob_buy=.3, prob_sell=.3))
+            return sim
+        uninterrupted = build()
+        uninterrupted.run()
+        sim = build()
+        for _ in range(45):
+            sim.next()
+        order = sim.exchange.get_open_orders('market_maker', 'XYZ')[0]
+        with tempfile.TemporaryDirectory() as path:
+            sim.checkpoint(f'{path}/checkpoint')
+            restored = Simulator.restore(f'{path}/checkpoint')
+        # references taken before the checkpoint are detached from the restored simulation
+        self.assertIsNot(restored.exchange.get_order(order.id), order)
+        restored.run()
+        trades, expected = restored.exchange.trades, uninterrupted.exchange.trades
+        self.assertEqual(len(trades), len(expected))
+        for i in range(len(expected)):
+            self.assertEqual(trades.iloc[i].to_dict(), expected.iloc[i].to_dict())
+        pd.testing.assert_frame_equal(restored.get_portfolio_histories(), uninterrupted.get_portfolio_histories())
+        self.assertEqual([o.to_dict() for o in restored.exchange.get_open_orders('market_maker', 'XYZ')],
+                         [o.to_dict() for o in uninterrupted.exchange.get_open_orders('market_maker', 'XYZ')])
+
+    @unittest.skipIf(pa is None, 'pyarrow is not installed')
+    def test_checkpoint_with_sink(self):
+        with tempfile.TemporaryDirectory() as path:
+            sim = Simulator(datetime(2022, 1, 1), datetime(2022, 1, 1, 3), 'minute', seed=5, sink=ArrowSink(f'{path}/run', chunk_size=10))
+            sim.exchange.create_asset('XYZ')
+            sim.add_agent(NaiveMarketMaker(name='market_maker', tickers=['XYZ'], aum=1_000, spread_pct=0.005, qty_per_order=4))
+            sim.add_agent(RandomMarketTaker(name='market_taker', tickers=['XYZ'], aum=1_000, prob_buy=.3, prob_sell=.3))
+            for _ in range(60):
+                sim.next()
+            sim.checkpoint(f'{path}/checkpoint')
+            with self.assertRaises(ValueError):
+                Simulator.restore(f'{path}/checkpoint')
+            forks = [Simulator.restore(f'{path}/checkpoint', f'{path}/fork{i}') for i in range(2)]
+            forks[0].get_agent('market_taker').rng = np.random.default_rng(1)
+            forks[0].run()
+            trades = forks[0].exchange.get_trades('XYZ')
+            forks[1].run()
+            sim.run()
+            # each fork reads back its own files, which the other runs did not overwrite
+            forks[0].exchange._market_data.clear()
+            pd.testing.assert_frame_equal(forks[0].exchange.get_trades('XYZ'), trades)
+            pd.testing.assert_frame_equal(forks[1].exchange.get_trades('XYZ'), sim.exchange.get_trades('XYZ'))
+            self.assertFalse(forks[0].exchange.get_trades('XYZ').equals(sim.exchange.get_trades('XYZ')))
+
+    def test_depth_recorder(self):
+        recorder = self.sim.record_depth(n_levels=3, tickers=['XYZ'], chunk_size=16)
+        self.assertEqual(recorder.data['XYZ'].shape, (16, 3, 6))
+        self.sim.run()
+        data = recorder.get('XYZ')
+        self.assertEqual(data.shape, (180, 3, 6))
+        # grown by doubling, up to the length of the clock
+        self.assertEqual(len(recorder.data['XYZ']), 180)
+        depth = self.sim.exchange.get_depth('XYZ', 3)
+        np.testing.assert_array_equal(data[-1, :len(depth['bids']), :3], depth['bids'])
+        np.testing.assert_array_equal(data[-1, :len(depth['asks']), 3:], depth['asks'])
+        # the seed orders are the only ones before the first step
+        self.assertEqual(data[0, 0].tolist(), [99, 1, 1, 101, 1, 1])
+        self.assertEqual(recorder.to_frame('XYZ')[(0, 'bid_p')].iloc[-1], depth['bids'][0, 0])
+
+    def test_profiling(self):
+        profiler = self.sim.enable_profiling(capacity=100_000)
+        n_trades = len(self.sim.exchange.trade_log)
+        n_steps = 0
+        while self.sim.next():
+            n_steps += 1
+        df = profiler.to_frame()
+        counters = df[df['category'] == 'counter'].groupby('name', observed=True)['value'].sum()
+        self.assertEqual(counters['fills'], len(self.sim.exchange.trade_log) - n_trades)
+        steps = df[(df['category'] == 'phase') & (df['name'] == 'step')]
+        self.assertEqual(len(steps), n_steps)
+        self.assertEqual(set(df.loc[df['category'] == 'agent', 'name']), {agent.name for agent in self.sim.agents})
+        self.sim.disable_profiling()
+        self.assertNotIn('limit_buy', vars(self.sim.exchange))
+        # a small buffer only keeps the latest rows
+        small = Simulator(datetime(2022, 1, 1), datetime(2022, 1, 1, 1), 'minute', seed=1)
+        small.exchange.create_asset('XYZ')
+        small.add_agent(RandomMarketTaker(name='market_taker', tickers=['XYZ'], aum=1_000))
+        profiler = small.enable_profiling(capacity=50)
+        small.run()
+        df = profiler.to_frame()
+        self.assertEqual(len(df), 50)
+        self.assertEqual(df['step'].iloc[-1], 59)
+        self.assertTrue(df['step'].is_monotonic_increasing)
+
+    def test_replay(self):
+        trades = pd.DataFrame({
+            'dt': pd.to_datetime(['2022-01-01 00:00:30', '2022-01-01 00:01:10', '2022-01-01 00:02:05', '2022-01-01 00:02:40']),
+            'price': [50.0, 50.1, 49.8, 50.2],
+            'qty': [3, 2, 5, 1],
+            'side': ['buy', 'buy', 'sell', 'buy'],
+        })
+        quotes = pd.DataFrame({
+            'dt': pd.to_datetime(['2022-01-01 00:00:20', '2022-01-01 00:01:30', '2022-01-01 00:02:50']),
+            'ticker': 'XYZ', 'bid': [49.9, 50.0, 50.1], 'bid_qty': [10, 10, 10], 'ask': [50.1, 50.2, 50.3], 'ask_qty': [10, 10, 10],
+        })
+        formats = ['csv', 'parquet'] if pa is not None else ['csv']
+        for format in formats:
+            with tempfile.TemporaryDirectory() as path:
+                files = {}
+                for kind, df in (('trades', trades), ('quotes', quotes)):
+                    files[kind] = f'{path}/{kind}.{format}'
+                    if format == 'csv':
+                        df.to_csv(files[kind], index=False)
+                    else:
+                        df.to_parquet(files[kind])
+                sim = Simulator(datetime(2022, 1, 1), datetime(2022, 1, 1, 1), 'minute')
+                sim.exchange.create_asset('XYZ', seed_price=50)
+                sim.add_agent(ReplayAgent('tape', ['XYZ'], trades=TickFile(files['trades'], 'trades', ticker='XYZ', chunk_size=2), quotes=files['quotes']))
+                sim.run()
+                replayed = sim.exchange.trades.iloc[1:]
+                self.assertEqual(replayed['price'].tolist(), trades['price'].tolist())
+                self.assertEqual(replayed['qty'].tolist(), trades['qty'].tolist())
+                self.assertEqual(replayed.index[0], datetime(2022, 1, 1, 0, 1))
+                self.assertEqual(sim.exchange.get_quotes('XYZ'), {'ticker': 'XYZ', 'bid_qty': 10, 'bid_p': 50.1, 'ask_qty': 10, 'ask_p': 50.3})
+        # replayed trades never fill the resting orders of other agents
+        with tempfile.TemporaryDirectory() as path:
+            trades.to_csv(f'{path}/trades.csv', index=False)
+            sim = Simulator(datetime(2022, 1, 1), datetime(2022, 1, 1, 1), 'minute')
+            sim.exchange.create_asset('XYZ', seed_price=50)
+            sim.add_agent(ReplayAgent('tape', ['XYZ'], trades=TickFile(f'{path}/trades.csv', 'trades', ticker='XYZ')))
+            order = sim.exchange.limit_sell('XYZ', 49.95, 2, 'seller')
+            sim.run()
+            self.assertEqual(sim.exchange.trades.iloc[1][['price', 'qty', 'buyer', 'seller']].tolist(), [50.0, 3, 'tape', 'tape'])
+            self.assertEqual(sim.exchange.get_order(order.id).qty, 2)
+            self.assertEqual(sim.exchange.get_latest_trade('XYZ').price, 50.2)
+            self.assertEqual(sim.get_agent('tape').cash, 1e12)
+
+    def test_profiling_counts(self):
+        class Trader(Agent):
+            def next(self):
+                buy = self.limit_buy('XYZ', 98, 1)
+                sell = self.limit_sell('XYZ', 102, 1)
+                self.submit_batch([{'type': 'cancel', 'id': buy.id}, {'type': 'limit_buy', 'ticker': 'XYZ', 'price': 97, 'qty': 1}])
+                self.amend_order(sell.id, price=103)
+                self.cancel_all_orders('XYZ')
+
+        sim = Simulator(datetime(2022, 1, 1), datetime(2022, 1, 1, 0, 2), 'minute')
+        sim.exchange.create_asset('XYZ')
+        sim.add_agent(Trader('trader', ['XYZ']))
+        profiler = sim.enable_profiling()
+        sim.run()
+        df = profiler.to_frame()
+        values = df[df['category'].isin(['exchange', 'counter'])].set_index('name', drop=True)['value']
+        self.assertEqual(values['orders'], 3)
+        self.assertEqual(values['cancels'], 2)
+        self.assertEqual(values['limit_buy'], 1)
+        self.assertEqual(values['submit_batch'], 1)
+        self.assertEqual(values['amend_order'], 1)
+        self.assertEqual(values['cancel_all_orders'], 1)
+        self.assertNotIn('cancel_order', values.index)
+
+    def test_unique_agent_names(self):
+        with self.assertRaises(ValueError):
+            self.sim.add_agent(Agent('market_maker', ['XYZ']))
+
+    def test_settlement(self):
+        self.sim.run()
+        for agent in self.sim.agents:
+            for ticker in ['XYZ', 'ABC']:
+                self.assertEqual(agent.get_position(ticker), sum(t['qty'] for t in agent._transactions if t['ticker'] == ticker))
+            self.assertAlmostEqual(agent.cash, agent.initial_cash + sum(t['cash_flow'] for t in agent._transactions))
+        self.assertEqual(self.sim.exchange.agents_cash_updates, [])
+
+    def test_sharded_exchange(self):
+        def build(shards):
+            sim = Simulator(datetime(2022, 1, 1), datetime(2022, 1, 1, 1), 'minute', shards=shards, seed=7)
+            tickers = ['XYZ', 'ABC', 'DEF']
+            for ticker in tickers:
+                sim.exchange.create_asset(ticker)
+            sim.add_agent(NaiveMarketMaker(name='market_maker', tickers=tickers, aum=1_000, spread_pct=0.005, qty_per_order=4))
+            sim.add_agent(RandomMarketTaker(name='market_taker', tickers=tickers, aum=1_000, prob_buy=.2, prob_sell=.2, qty_per_order=1))
+            sim.run()
+            return sim
+        single, sharded = build(None), build(2)
+        try:
+            pd.testing.assert_frame_equal(single.get_portfolio_histories(), sharded.get_portfolio_histories())
+            for ticker in ['XYZ', 'ABC', 'DEF']:
+                self.assertEqual(single.exchange.get_quotes(ticker), sharded.exchange.get_quotes(ticker))
+                self.assertEqual(len(single.exchange.get_trades(ticker)), len(sharded.exchange.get_trades(ticker)))
+            self.assertEqual(
+                [o.id for o in sharded.exchange.get_open_orders('market_maker', 'ABC')],
+                [o.id for o in sharded.exchange.get_full_order_book('ABC').bids if o.creator == 'market_maker'] +
+                [o.id for o in sharded.exchange.get_full_order_book('ABC').asks if o.creator == 'market_maker'])
+        finally:
+            sharded.exchange.close()
+
+    def test_sharded_results(self):
+        def run(exchange):
+            exchange.create_asset('XYZ')
+            order = exchange.limit_buy('XYZ', 99, 5, 'a')
+            cancelled = exchange.cancel_order(exchange.limit_sell('XYZ', 102, 1, 'a').id)
+            amended = exchange.amend_order(order.id, price=99.5)
+            batch = exchange.submit_batch([{'type': 'market_buy', 'ticker': 'XYZ', 'qty': 2, 'creator': 'b'},
+                                           {'type': 'cancel', 'id': 12345}])
+            return order, cancelled, amended, batch
+        order, cancelled, amended, batch = run(Exchange())
+        sharded = ShardedExchange(n_shards=2)
+        try:
+            sharded_order, *deferred = run(sharded)
+            with self.assertRaises(RuntimeError):
+                deferred[1].result()
+            sharded.flush()
+            sharded_cancelled, sharded_amended, sharded_batch = [result.result() for result in deferred]
+            self.assertEqual(sharded_cancelled.price, cancelled.price)
+            # the replacing order gets its id in the parent, like any other queued limit order
+            self.assertGreater(sharded_amended.id, sharded_order.id)
+            self.assertEqual((sharded_amended.price, sharded_amended.qty), (amended.price, amended.qty))
+            self.assertEqual(sharded.get_order(sharded_amended.id).price, 99.5)
+            self.assertEqual([len(r['fills']) for r in sharded_batch], [len(r['fills']) for r in batch])
+            self.assertIsNone(sharded_batch[1]['order'])
+        finally:
+            sharded.close()
+
+    def test_parallel_agents(self):
+        def build(parallel_agents):
+            sim = Simulator(datetime(2022, 1, 1), datetime(2022, 1, 1, 1), 'minute', parallel_agents=parallel_agents, processes=2, intent_order='fixed')
+            sim.exchange.create_asset('XYZ')
+            sim.add_agent(NaiveMarketMaker(name='market_maker', tickers=['XYZ'], aum=1_000, spread_pct=0.005, qty_per_order=4))
+            sim.add_agent(CyclicTaker(name='taker_1', tickers=['XYZ'], max_position=2))
+            # acts through next(), between the deciding agents
+            sim.add_agent(SleepyTaker(name='sleepy', tickers=['XYZ']))
+            sim.add_agent(CyclicTaker(name='taker_2', tickers=['XYZ'], max_position=3))
+            sim.run()
+            return sim
+        sequential, parallel = build(False), build(True)
+        pd.testing.assert_frame_equal(sequential.get_portfolio_histories(), parallel.get_portfolio_histories())
+        # the actions are applied in the registration order, as in sequential mode
+        pd.testing.assert_frame_equal(sequential.exchange.get_trades('XYZ'), parallel.exchange.get_trades('XYZ'))
+        self.assertEqual(parallel.get_agent('taker_1').steps, 59)
+        self.assertIsNotNone(parallel.get_agent('taker_1').exchange)
+
+    def test_portfolio_history(self):
+        self.sim.run()
+        histories = self.sim.get_portfolio_histories()
+        self.assertEqual(len(histories), 180)
+        for agent in self.sim.agents:
+            history = self.sim.get_portfolio_history(agent.name)
+            self.assertEqual(list(history.columns), ['XYZ', 'ABC', 'cash', 'aum'])
+            self.assertAlmostEqual(history['cash'].iloc[-1], agent.cash - agent.initial_cash)
+            for ticker in ['XYZ', 'ABC']:
+                self.assertAlmostEqual(history[ticker].iloc[-1], agent.get_position(ticker) * self.sim.exchange.get_latest_trade(ticker).price)
+            pd.testing.assert_series_equal(history['aum'], history[['XYZ', 'ABC', 'cash']].sum(axis=1), check_names=False)
+
+    def test_sweep(self):
+        results, bars = run_sweep(build_sweep_simulator, {'max_position': [2, 3], 'seed': [1, 2]}, bar_size='15min', processes=2)
+        self.assertEqual(list(results.index), [0, 1, 2, 3])
+        self.assertEqual(list(results['max_position']), [2, 2, 3, 3])
+        sim = build_sweep_simulator(3, 2)
+        sim.run()
+        self.assertEqual(results.loc[3, 'n_trades'], len(sim.exchange.trade_log))
+        self.assertAlmostEqual(results.loc[3, 'taker_cash'], sim.get_agent('taker').cash)
+        pd.testing.assert_frame_equal(bars.loc[(3, 'XYZ')], sim.get_price_bars('XYZ', '15min'))
 
 class TestExchange(unittest.TestCase):
     def setUp(self):
-        pass
+        self.exchange = Exchange()
+        self.exchange.create_asset('XYZ', seed_price=100, seed_bid=.99, seed_ask=1.01)
+
+    def test_book_priority(self):
+        self.exchange.limit_buy('XYZ', 99.5, 1, 'a')
+        self.exchange.limit_buy('XYZ', 99.5, 2, 'b')
+        self.exchange.limit_buy('XYZ', 98, 3, 'c')
+        book = self.exchange.get_order_book('XYZ')
+        self.assertEqual([o.creator for o in book.bids], ['a', 'b', 'init_seed', 'c'])
+        self.assertEqual(self.exchange.get_best_bid('XYZ').creator, 'a')
+        self.assertEqual(book.bids[1].creator, 'b')
+        self.assertEqual(list(book.df['bids']['price']), [99.5, 99.5, 99, 98])
+
+    def test_limit_order_matching(self):
+        self.exchange.limit_sell('XYZ', 101, 2, 'a')
+        order = self.exchange.limit_buy('XYZ', 101, 4, 'b')
+        self.assertEqual(order.qty, 1)
+        self.assertEqual(self.exchange.get_best_bid('XYZ').creator, 'b')
+        self.assertEqual(self.exchange.get_best_ask('XYZ'), None)
+        self.assertEqual(len(self.exchange.get_order_book('XYZ').asks), 0)
+
+    def test_filled_limit_order_does_not_rest(self):
+        order = self.exchange.limit_sell('XYZ', 99, 1, 'a')
+        self.assertEqual(order.qty, 0)
+        self.assertEqual(self.exchange.get_best_bid('XYZ'), None)
+        self.assertEqual(self.exchange.get_best_ask('XYZ').creator, 'init_seed')
+
+    def test_market_orders(self):
+        self.exchange.limit_sell('XYZ', 102, 2, 'a')
+        self.exchange.market_buy('XYZ', 2, 'b')
+        self.assertEqual(self.exchange.get_best_ask('XYZ').price, 102)
+        self.assertEqual(self.exchange.get_best_ask('XYZ').qty, 1)
+        self.assertEqual(self.exchange.get_latest_trade('XYZ').price, 102)
+        self.exchange.market_sell('XYZ', 5, 'b')
+        self.assertEqual(self.exchange.get_best_bid('XYZ'), None)
+
+    def test_tick_size(self):
+        self.exchange.create_asset('ABC', seed_price=10, tick_size=0.25)
+        a = self.exchange.limit_buy('ABC', 9.6, 1, 'a')
+        b = self.exchange.limit_buy('ABC', 9.4, 1, 'b')
+        self.assertEqual((a.price, a.ticks), (9.5, 38))
+        self.assertEqual(b.price, 9.5)
+        self.assertGreater(b.id, a.id)
+        self.assertEqual(self.exchange.get_order_book('ABC').bids.best_level().qty, 2)
+        self.assertEqual(self.exchange.limit_buy('XYZ', 99.456, 1, 'c').price, 99.46)
+
+    def test_trade_log(self):
+        self.exchange.create_asset('ABC', seed_price=10)
+        self.exchange.market_buy('XYZ', 1, 'a')
+        self.exchange.market_sell('ABC', 1, 'b')
+        trade_log = self.exchange.trade_log
+        self.assertEqual(len(trade_log), 4)
+        self.assertEqual(trade_log[-1].to_dict()['seller'], 'b')
+        trades = self.exchange.trades
+        self.assertEqual(list(trades.columns), ['ticker', 'qty', 'price', 'buyer', 'seller'])
+        self.assertEqual(list(self.exchange.get_trades('XYZ')['price']), [100, 101])
+        self.assertEqual(list(trade_log.to_frame(agent='b')['ticker']), ['ABC'])
+        self.assertEqual(self.exchange.get_latest_trade('ABC').price, 9.9)
+        # names are plain strings by default, as in a frame built from the trades, and categorical on request
+        records = pd.DataFrame.from_records([t.to_dict() for t in trade_log if t.ticker == 'XYZ']).set_index('dt')
+        pd.testing.assert_frame_equal(self.exchange.get_trades('XYZ'), records, check_index_type=False)
+        self.assertEqual(trade_log.to_frame(categorical=True)['buyer'].dtype, 'category')
+
+    def test_latest_trade(self):
+        self.exchange.create_asset('ABC', seed_price=10)
+        for i in range(100):
+            self.exchange.limit_sell('XYZ', 100 + i, 1, 'a')
+            self.exchange.market_buy('XYZ', 1, 'b')
+        self.assertEqual(self.exchange.get_latest_trade('ABC').price, 10)
+        self.assertEqual(self.exchange.get_latest_trade('XYZ').price, 198)
+        self.assertIs(self.exchange.get_latest_trade('XYZ'), self.exchange.get_latest_trade('XYZ'))
+        self.assertEqual(len(self.exchange.get_trades('XYZ')), 101)
+        self.assertEqual(list(self.exchange.trade_log.rows('ABC')), [1])
+
+    def test_price_bars(self):
+        exchange = Exchange(datetime=datetime(2022, 1, 1))
+        exchange.create_asset('XYZ')
+        exchange.get_price_bars('XYZ', '15Min')
+        for i in range(60):
+            exchange._set_datetime(datetime(2022, 1, 1) + timedelta(minutes=7 * i))
+            exchange.limit_sell('XYZ', 100 + i % 5, 2, 'a')
+            exchange.market_buy('XYZ', 1 + i % 3, 'b')
+        for bar_size in ['15Min', '1h', '1D']:
+            pd.testing.assert_frame_equal(
+                exchange.get_price_bars('XYZ', bar_size),
+                exchange._resample_price_bars('XYZ', bar_size),
+                check_freq=False)
+        self.assertEqual(exchange.get_current_bar('XYZ', '15Min')['close'], exchange.get_latest_trade('XYZ').price)
+
+    def test_cancel_order(self):
+        a = self.exchange.limit_buy('XYZ', 99.5, 1, 'a')
+        b = self.exchange.limit_buy('XYZ', 99.5, 2, 'b')
+        c = self.exchange.limit_buy('XYZ', 99.5, 3, 'c')
+        self.assertIs(self.exchange.cancel_order(b.id), b)
+        self.assertIsNone(self.exchange.cancel_order(b.id))
+        book = self.exchange.get_order_book('XYZ')
+        self.assertEqual([o.creator for o in book.bids], ['a', 'c', 'init_seed'])
+        self.assertEqual(book.bids.best_level().qty, 4)
+        self.exchange.market_sell('XYZ', 4, 'd')
+        self.assertIsNone(self.exchange.get_order(a.id))
+        self.assertIsNone(self.exchange.get_order(c.id))
+        self.assertEqual(self.exchange.get_best_bid('XYZ').creator, 'init_seed')
+
+    def test_amend_order(self):
+        a = self.exchange.limit_buy('XYZ', 99.5, 3, 'a')
+        self.exchange.limit_buy('XYZ', 99.5, 2, 'b')
+        self.assertIs(self.exchange.amend_order(a.id, qty=1), a)
+        self.assertEqual(self.exchange.get_best_bid('XYZ').creator, 'a')
+        self.assertEqual(self.exchange.get_order_book('XYZ').bids.best_level().qty, 3)
+        replaced = self.exchange.amend_order(a.id, qty=5)
+        self.assertIsNone(self.exchange.get_order(a.id))
+        self.assertEqual(self.exchange.get_best_bid('XYZ').creator, 'b')
+        replaced = self.exchange.amend_order(replaced.id, price=101)
+        self.assertEqual(replaced.qty, 4)
+        self.assertEqual(self.exchange.get_best_bid('XYZ').creator, 'a')
+        self.assertIsNone(self.exchange.amend_order(replaced.id, qty=0))
+        self.assertEqual(self.exchange.get_best_bid('XYZ').creator, 'b')
+
+    def test_submit_batch(self):
+        sequential, batch = Exchange(datetime(2022, 1, 1)), Exchange(datetime(2022, 1, 1))
+        for exchange in (sequential, batch):
+            exchange.create_asset('XYZ')
+            exchange.create_asset('ABC', seed_price=10)
+        orders = [
+            {'type': 'limit_sell', 'ticker': 'XYZ', 'price': 100.5, 'qty': 2, 'creator': 'a'},
+            {'type': 'limit_buy', 'ticker': 'ABC', 'price': 9.95, 'qty': 3, 'creator': 'a'},
+            {'type': 'market_buy', 'ticker': 'XYZ', 'qty': 3, 'creator': 'b'},
+            {'type': 'limit_buy', 'ticker': 'XYZ', 'price': 101, 'qty': 2, 'creator': 'b'},
+            {'type': 'market_sell', 'ticker': 'ABC', 'qty': 1, 'creator': 'b'},
+            {'type': 'cancel', 'id': 1},
+        ]
+        for order in orders:
+            kind = order['type']
+            if kind == 'cancel':
+                sequential.cancel_order(order['id'])
+            elif kind.startswith('limit'):
+                getattr(sequential, kind)(order['ticker'], order['price'], order['qty'], order['creator'])
+            else:
+                getattr(sequential, kind)(order['ticker'], order['qty'], order['creator'])
+        results = batch.submit_batch(orders)
+        for ticker in ('XYZ', 'ABC'):
+            pd.testing.assert_frame_equal(sequential.get_trades(ticker), batch.get_trades(ticker), check_categorical=False)
+            for side in ('bids', 'asks'):
+                self.assertEqual(
+                    [(o.price, o.qty, o.creator) for o in getattr(sequential.get_order_book(ticker), side)],
+                    [(o.price, o.qty, o.creator) for o in getattr(batch.get_order_book(ticker), side)])
+        self.assertEqual([t.qty for t in results[2]['fills']], [2, 1])
+        self.assertEqual(results[3]['order'].qty, 2)
+        self.assertEqual(results[4]['fills'][0].seller, 'b')
+        self.assertEqual(results[5]['order'].creator, 'init_seed')
+        with self.assertRaises(ValueError):
+            batch.submit_batch([{'type': 'stop', 'ticker': 'XYZ'}])
+        # invalid instructions are rejected before any instruction is applied
+        n_trades = len(batch.trade_log)
+        resting = len(batch.get_order_book('XYZ').asks)
+        for invalid in ({'type': 'limit_buy', 'ticker': 'DEF', 'price': 10, 'qty': 1, 'creator': 'c'},
+                        {'type': 'limit_sell', 'ticker': 'ABC', 'qty': 1, 'creator': 'c'},
+                        {'type': 'cancel'}):
+            with self.assertRaises(ValueError):
+                batch.submit_batch([{'type': 'market_buy', 'ticker': 'XYZ', 'qty': 1, 'creator': 'c'}, invalid])
+        self.assertEqual(len(batch.trade_log), n_trades)
+        self.assertEqual(len(batch.get_order_book('XYZ').asks), resting)
+        # cancels and amends can refer to orders placed earlier in the same batch, and ids follow the order of submission
+        last_id = batch.limit_buy('XYZ', 90, 1, 'e').id
+        results = batch.submit_batch([
+            {'type': 'limit_buy', 'ticker': 'XYZ', 'price': 93, 'qty': 1, 'creator': 'd'},
+            {'type': 'limit_sell', 'ticker': 'ABC', 'price': 12, 'qty': 3, 'creator': 'd'},
+            {'type': 'cancel', 'id': last_id + 1},
+            {'type': 'amend', 'id': last_id + 2, 'qty': 1},
+        ])
+        self.assertEqual([results[0]['order'].id, results[1]['order'].id], [last_id + 1, last_id + 2])
+        self.assertEqual(results[2]['order'].id, last_id + 1)
+        self.assertEqual(batch.get_open_orders('d', 'XYZ'), [])
+        self.assertEqual(batch.get_order(last_id + 2).qty, 1)
+        # ids of new orders are assigned by the exchange, even if the instruction has one
+        first = batch.submit_batch([{'type': 'limit_buy', 'ticker': 'XYZ', 'price': 90, 'qty': 1, 'creator': 'c', 'id': 1000}])[0]['order']
+        second = batch.submit_batch([{'type': 'limit_buy', 'ticker': 'XYZ', 'price': 91, 'qty': 1, 'creator': 'c', 'id': 1000}])[0]['order']
+        self.assertNotEqual(first.id, second.id)
+        self.assertEqual(len(batch.get_open_orders('c', 'XYZ')), 2)
+
+    def test_cancel_all_orders(self):
+        self.exchange.limit_buy('XYZ', 99.5, 1, 'a')
+        self.exchange.limit_sell('XYZ', 100.5, 1, 'a')
+        self.exchange.limit_buy('XYZ', 99.5, 1, 'b')
+        self.assertEqual(len(self.exchange.get_open_orders('a', 'XYZ')), 2)
+        self.exchange.cancel_all_orders('a', 'XYZ')
+        self.assertEqual(self.exchange.get_open_orders('a', 'XYZ'), [])
+        quotes = self.exchange.get_quotes('XYZ')
+        self.assertEqual((quotes['bid_p'], quotes['ask_p']), (99.5, 101))
+        self.assertEqual(self.exchange.get_best_bid('XYZ').creator, 'b')
+
+    def test_open_orders_after_fill(self):
+        self.exchange.limit_sell('XYZ', 100.5, 1, 'a')
+        order = self.exchange.limit_sell('XYZ', 100.5, 1, 'a')
+        self.exchange.market_buy('XYZ', 1, 'b')
+        self.assertEqual(self.exchange.get_open_orders('a', 'XYZ'), [order])
+
+    def test_depth(self):
+        self.exchange.limit_buy('XYZ', 99, 2, 'a')
+        self.exchange.limit_buy('XYZ', 98.5, 3, 'b')
+        self.exchange.limit_buy('XYZ', 98.5, 4, 'c')
+        order = self.exchange.limit_buy('XYZ', 99, 5, 'd')
+        self.exchange.cancel_order(order.id)
+        depth = self.exchange.get_depth('XYZ', 2)
+        self.assertEqual(depth['bids'].tolist(), [[99, 3, 2], [98.5, 7, 2]])
+        self.assertEqual(depth['asks'].tolist(), [[101, 1, 1]])
+        quotes = self.exchange.get_quotes('XYZ')
+        self.assertEqual((quotes['bid_p'], quotes['bid_qty']), (99, 3))
+        self.exchange.market_buy('XYZ', 1, 'e')
+        self.assertIsNone(self.exchange.get_quotes('XYZ')['ask_p'])
+        self.assertIsNone(self.exchange.get_midprice('XYZ'))
+        self.assertEqual(self.exchange.get_depth('XYZ')['asks'].shape, (0, 3))
+
+    def test_market_data_cache(self):
+        self.exchange.create_asset('ABC')
+        quotes, other_quotes, trades = self.exchange.get_quotes('XYZ'), self.exchange.get_quotes('ABC'), self.exchange.get_trades('XYZ')
+        builds = self.exchange._market_data_builds
+        # the quotes are copies of the cached ones, so modifying them does not affect other callers
+        quotes['bid_p'] = 0
+        self.assertEqual(self.exchange.get_quotes('XYZ')['bid_p'], 99)
+        self.assertIs(self.exchange.get_trades('XYZ'), trades)
+        self.assertEqual(self.exchange._market_data_builds, builds)
+        self.exchange.limit_buy('XYZ', 99.5, 2, 'a')
+        self.assertEqual(self.exchange.get_quotes('XYZ')['bid_p'], 99.5)
+        self.assertIs(self.exchange.get_trades('XYZ'), trades)
+        self.assertEqual(self.exchange.get_quotes('ABC'), other_quotes)
+        self.assertEqual(self.exchange._market_data_builds, builds + 1)
+        self.exchange.market_sell('XYZ', 1, 'b')
+        self.assertEqual(self.exchange.get_quotes('XYZ')['bid_qty'], 1)
+        self.assertEqual(len(self.exchange.get_trades('XYZ')), len(trades) + 1)
+        agent = Agent('a', ['XYZ'])
+        agent._set_exchange(self.exchange)
+        self.assertEqual(agent.get_midprice('XYZ'), (99.5 + 101) / 2)
 
 
 
 
 
+class TestBenchmarks(unittest.TestCase):
+    def test_benchmarks(self):
+        results = run_benchmarks(['deep_book', 'market_makers', 'analytics'], scale=0.005, repeat=1)
+        self.assertEqual(list(results), ['deep_book', 'market_makers', 'analytics'])
+        self.assertGreater(results['deep_book']['instructions_per_sec'], 0)
+        # the market maker cancels and reposts both sides of every asset at every step
+        result = results['market_makers']
+        self.assertGreaterEqual(result['instructions'], result['steps'] * 20 * 3 * 3)
+        self.assertEqual(compare(results, results), [])
+        slower = {name: dict(result, seconds=result['seconds'] * 2) for name, result in results.items()}
+        self.assertEqual(len(compare(slower, results)), 3)
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file